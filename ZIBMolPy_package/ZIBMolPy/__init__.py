@@ -19,6 +19,7 @@ ZIBgridfree essential pipeline:
 Convenience:
 ============
 	- L{zgf_extract_conformations}
+	- L{zgf_bootstrap}
 	- L{zgf_cleanup}
 	- L{zgf_remove_nodes}
 	- L{zgf_solvate_nodes}
@@ -32,8 +33,8 @@ Testing:
 	- L{zgf_test}
 
 
-@group base: internals, pool, node, restraint, phi
-@group helpers: algorithms, constants, gromacs, ui, utils, topology, io
+@group base: internals, pool, pool_context, pool_index, node, trajectory_cache, restraint, phi
+@group helpers: algorithms, checkpoint, constants, gromacs, ui, utils, topology, io
 @group browser: plots
 """
 #EOF
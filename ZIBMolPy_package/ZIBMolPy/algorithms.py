@@ -2,51 +2,253 @@
 
 import numpy as np
 import sys
+import time
+from ZIBMolPy.internals import InternalArray, DihedralCoordinate
+from ZIBMolPy.utils import parallel_map
 
 #===============================================================================
-def kmeans(frames, k, threshold=1e-4, max_iterations=50, fixed_clusters=None):
+def kmeans(frames, k, threshold=1e-4, max_iterations=50, fixed_clusters=None, n_restarts=1, n_procs=None, mode="full", batch_size=1000, init="random"):
 	""" 
-	Centroids for new cluster centers are calculated by mean_weighted.
+	Weighted k-means.
+	Centroids for new cluster centers are weighted means - circular for dihedrals, 
+	just like mean_weighted. Clusters, which lose all their members, keep their center.
 	U{K-Means <http://en.wikipedia.org/wiki/K-means_clustering>}
 	
-	@param frames: Sampling points to clusters
+	In mode "minibatch" the centers are moved after each batch of frames with per-cluster 
+	learning rates - U{Sculley, Web-Scale K-Means Clustering <http://dx.doi.org/10.1145/1772690.1772862>}.
+	Here an iteration is one pass over all frames and the frames can be streamed 
+	chunk-wise, so that they never have to be in memory all at once.
+	
+	@param frames: Sampling points to clusters - in mode "minibatch" this can also be a function, 
+	which returns an iterable of InternalArray-chunks with frameweights, e.g. C{lambda: node.iter_trajectory()}
 	@type frames:  L{InternalArray}
 	@param k: Number of clusters
 	@type k: positiv integer
 	@param fixed_clusters: additional cluster-centers, which can have members but are never moved.
 	This is used in L{zgf_refine} to create additional nodes. 
 	@type fixed_clusters: list of L{InternalArray}. 
+	@param n_restarts: number of independent runs - the one with the lowest inertia is returned (only mode "full")
+	@param n_procs: number of processes for the restarts, default: number of cpus
+	@param mode: "full" or "minibatch"
+	@param batch_size: number of frames per batch in mode "minibatch"
+	@param init: "random" picks the initial centers from randomly shuffled frames, "kmeans++" uses 
+	weighted k-means++ seeding, which also keeps clear of the fixed clusters
 	"""
-	assert(frames.has_frameweights)
+	assert(mode in ("full", "minibatch"))
+	assert(init in ("random", "kmeans++"))
+	assert(n_restarts >= 1)
 	if(fixed_clusters==None):
 		fixed_clusters = []
-	# pick initial means randomly
-	start_frames = np.arange(len(frames))
-	# using numpy-random because python-random differes beetween 32 and 64bit 
-	np.random.shuffle(start_frames)
-	start_frames = start_frames[:k]
-	means = [ frames.getframe(i) for i in start_frames ]
-	means += fixed_clusters
+	fixed = None
+	if(len(fixed_clusters) > 0):
+		fixed = np.row_stack([c.array for c in fixed_clusters])
+	
+	if(mode == "minibatch"):
+		assert(n_restarts == 1)
+		chunks = frames
+		if(isinstance(frames, InternalArray)):
+			chunks = lambda: [frames]
+		seed = np.random.randint(0, 2**31-1)
+		(converter, result) = _kmeans_minibatch(chunks, k, fixed, threshold, max_iterations, batch_size, seed, init)
+		results = [result]
+	
+	else:
+		assert(frames.has_frameweights)
+		converter = frames.converter
+		periodic = _periodic_mask(converter)
+		if(fixed is None):
+			fixed = np.zeros((0, len(converter)))
+		jobs = []
+		for dummy in range(n_restarts):
+			# using numpy-random because python-random differes beetween 32 and 64bit 
+			if(init == "random"):
+				# pick initial means randomly
+				start_frames = np.arange(len(frames))
+				np.random.shuffle(start_frames)
+				jobs.append( (start_frames[:k], None) )
+			else:
+				jobs.append( (None, np.random.randint(0, 2**31-1)) )
+		shared = (frames.array, frames.frameweights, periodic, fixed, k, threshold, max_iterations, n_restarts==1)
+		results = parallel_map(_kmeans_run, jobs, n_procs, shared)
+	
+	for (i, (inertia, n_iter, _)) in enumerate(results):
+		print("k-means run %2d - iterations: %2d, inertia: %g"%(i, n_iter, inertia))
+	(inertia, n_iter, means) = min(results, key=lambda r: r[0])
+	return([ InternalArray(converter, m[None,:]) for m in means ])
+
+
+#===============================================================================
+def closest_frames(frames, means):
+	""" Finds for each of the given means its closest frame - within a single pass over the frames.
+	@param frames: L{InternalArray} or iterable of InternalArray-chunks, e.g. C{node.iter_trajectory()}
+	@param means: list of L{InternalArray}s, e.g. as returned by L{kmeans}
+	@return: list of frame indices and list of the frames as L{InternalArray}s
+	"""
+	if(isinstance(frames, InternalArray)):
+		frames = [frames]
+	best_idx = np.zeros(len(means), dtype=np.int)
+	best_dist2 = np.inf * np.ones(len(means))
+	best_frames = [None]*len(means)
+	offset = 0
+	for chunk in frames:
+		# assigning the means to the frames yields the closest frame of each mean
+		(idx, dist2) = _kmeans_assign(np.row_stack([m.array for m in means]), chunk.array, _periodic_mask(chunk.converter))
+		for j in np.flatnonzero(dist2 < best_dist2):
+			best_idx[j] = idx[j] + offset
+			best_dist2[j] = dist2[j]
+			best_frames[j] = chunk.getframe(int(idx[j]))
+		offset += chunk.n_frames
+	return([ int(i) for i in best_idx ], best_frames)
+
+
+#===============================================================================
+def _periodic_mask(converter):
+	return( np.array([isinstance(c, DihedralCoordinate) for c in converter]) )
+
+
+#===============================================================================
+def _kmeans_run(shared, job):
+	""" A single k-means run on plain arrays - runs within a worker process. """
+	(X, w, periodic, fixed, k, threshold, max_iterations, verbose) = shared
+	(start, seed) = job
+	if(start is None):
+		means = _kmeans_seed(X, w, periodic, fixed, k, np.random.RandomState(seed))
+	else:
+		means = X[start].astype(np.float64)
+	
 	for j in range(max_iterations):
+		(members, _) = _kmeans_assign(X, np.row_stack([means, fixed]), periodic)
+		new_means = _kmeans_centroids(X, w, periodic, members, means)
+		progress = np.mean( np.sum(np.square(_wrapped_diff(means, new_means, periodic)), axis=1) )
+		means = new_means
+		if(verbose):
+			print("k-means iteration %2d - Progress: %g"%(j, progress))
+		if(progress < threshold):
+			if(verbose):
+				print "k-means has converged - quitting"
+			break
+	
+	(_, dist2) = _kmeans_assign(X, np.row_stack([means, fixed]), periodic)
+	inertia = np.dot(w, dist2)
+	return(inertia, j+1, means)
 
-		# distances of all frames to all nodes
-		diffs = np.row_stack( (frames-m).norm2() for m in means )         
-		# list specifying to which node each frame belongs
-		members = np.argmin(diffs, axis=0)
-		new_means = []
-		for i in range(k):
-			# from the list of all frames belonging to i-th node...
-			member_frames_idx = np.atleast_1d(np.squeeze(np.argwhere(members == i)))
-			# ...calculate the new centroid of i-th node
-			new_means.append( frames.getframes(member_frames_idx).mean_weighted() )
-		progress = np.mean( [(a-b).norm2() for (a,b) in zip(means, new_means)] )
-		means = new_means + fixed_clusters
-		print("k-means iteration %2d - Progress: %g"%(j, progress))
+
+#===============================================================================
+def _kmeans_minibatch(chunks, k, fixed, threshold, max_iterations, batch_size, seed, init):
+	""" Mini-batch k-means on a stream of chunks - see L{kmeans}.
+	@return: (converter, (inertia, iterations, means)) """
+	rng = np.random.RandomState(seed)
+	
+	# seeding on a uniform random sample of all frames, which is gathered in one pass
+	sample_size = max(batch_size, 10*k)
+	(X, w, keys) = (None, None, None)
+	for c in chunks():
+		assert(c.has_frameweights)
+		converter = c.converter
+		if(X is None):
+			(X, w, keys) = (c.array, c.frameweights, rng.random_sample(c.n_frames))
+		else:
+			(X, w, keys) = (np.row_stack([X, c.array]), np.concatenate([w, c.frameweights]), np.concatenate([keys, rng.random_sample(c.n_frames)]))
+		keep = np.argsort(keys)[:sample_size]
+		(X, w, keys) = (X[keep], w[keep], keys[keep])
+	
+	periodic = _periodic_mask(converter)
+	if(fixed is None):
+		fixed = np.zeros((0, len(converter)))
+	if(init == "random"):
+		means = X[rng.permutation(len(X))[:k]].astype(np.float64)
+	else:
+		means = _kmeans_seed(X, w, periodic, fixed, k, rng)
+	counts = np.zeros(k) # accumulated frameweights per cluster, they determine the learning rates
+	
+	for j in range(max_iterations):
+		old_means = means.copy()
+		inertia = 0.0
+		for c in chunks():
+			order = rng.permutation(c.n_frames) # batches of consecutive frames would be correlated
+			for start in range(0, c.n_frames, batch_size):
+				idx = order[start:start+batch_size]
+				(X, w) = (c.array[idx], c.frameweights[idx])
+				(members, dist2) = _kmeans_assign(X, np.row_stack([means, fixed]), periodic)
+				inertia += np.dot(w, dist2)
+				batch_means = _kmeans_centroids(X, w, periodic, members, means)
+				mine = members < k
+				batch_weights = np.bincount(members[mine], weights=w[mine], minlength=k)
+				counts += batch_weights
+				eta = batch_weights / np.where(counts > 0, counts, 1)
+				means = means + eta[:,None] * _wrapped_diff(batch_means, means, periodic)
+				means[:,periodic] = np.mod(means[:,periodic] + np.pi, 2*np.pi) - np.pi
+		
+		progress = np.mean( np.sum(np.square(_wrapped_diff(old_means, means, periodic)), axis=1) )
+		print("mini-batch k-means iteration %2d - Progress: %g"%(j, progress))
 		if(progress < threshold):
-			print "k-means has converged - quitting"
+			print "mini-batch k-means has converged - quitting"
 			break
 	
-	return(means[:k])
+	return(converter, (inertia, j+1, means))
+
+
+#===============================================================================
+def _kmeans_seed(X, w, periodic, fixed, k, rng):
+	""" k-means++: each new center is drawn with probability proportional to frameweight * squared distance to the nearest center. """
+	dist2 = np.inf * np.ones(len(X))
+	for c in fixed: # new centers should keep away from the fixed ones, too
+		dist2 = np.minimum(dist2, _kmeans_assign(X, c[None,:], periodic)[1])
+	means = []
+	for _ in range(k):
+		p = w * dist2
+		if(np.isinf(dist2[0])): # no centers yet
+			p = w.astype(np.float64)
+		if(np.sum(p) <= 0): # all remaining frames coincide with centers or have zero weight
+			p = np.ones(len(X))
+		i = rng.choice(len(X), p=p/np.sum(p))
+		means.append(X[i])
+		dist2 = np.minimum(dist2, _kmeans_assign(X, X[i][None,:], periodic)[1])
+	return(np.row_stack(means).astype(np.float64))
+
+
+#===============================================================================
+def _wrapped_diff(a, b, periodic):
+	""" Differences a-b, dihedrals are wrapped into [-pi, pi) - see L{DihedralCoordinate.sub} """
+	diffs = a - b
+	diffs[..., periodic] = np.mod(diffs[..., periodic] + np.pi, 2*np.pi) - np.pi
+	return(diffs)
+
+
+#===============================================================================
+def _kmeans_assign(X, means, periodic, block_bytes=2**25):
+	""" Assigns every frame to its nearest center - the distance matrix is computed in blocks of frames.
+	@return: (index of nearest center, squared distance to it) for every frame """
+	members = np.empty(len(X), dtype=np.int)
+	dist2 = np.empty(len(X))
+	block = max(1, block_bytes // (8 * means.size))
+	for start in range(0, len(X), block):
+		diffs = _wrapped_diff(X[start:start+block, None, :], means[None, :, :], periodic)
+		d2 = np.sum(np.square(diffs), axis=2)
+		members[start:start+block] = np.argmin(d2, axis=1)
+		dist2[start:start+block] = d2[np.arange(len(d2)), members[start:start+block]]
+	return(members, dist2)
+
+
+#===============================================================================
+def _kmeans_centroids(X, w, periodic, members, old_means):
+	""" Weighted means of the clusters - members of fixed clusters (index >= k) are ignored. """
+	k = len(old_means)
+	mine = members < k
+	(members, X, w) = (members[mine], X[mine], w[mine])
+	weight_sums = np.bincount(members, weights=w, minlength=k)
+	new_means = np.empty_like(old_means)
+	for i in range(X.shape[1]):
+		if(periodic[i]):
+			# U{http://en.wikipedia.org/wiki/Mean_of_circular_quantities}
+			sin_sum = np.bincount(members, weights=w*np.sin(X[:,i]), minlength=k)
+			cos_sum = np.bincount(members, weights=w*np.cos(X[:,i]), minlength=k)
+			new_means[:,i] = np.arctan2(sin_sum, cos_sum)
+		else:
+			new_means[:,i] = np.bincount(members, weights=w*X[:,i], minlength=k) / np.where(weight_sums > 0, weight_sums, 1)
+	empty = weight_sums <= 0
+	new_means[empty] = old_means[empty] # empty clusters keep their center
+	return(new_means)
 	
 
 #===============================================================================
@@ -54,32 +256,51 @@ def gelman_rubin(frames, n_chains, threshold, log=sys.stdout):
 	# split into chains of equal or near-equal(!) length
 	assert(frames.has_frameweights)
 	assert(frames.n_frames >= n_chains)
-	chains = frames.array_split(n_chains)
+	# chain lengths as in InternalArray.array_split
+	(base_len, n_longer) = divmod(frames.n_frames, n_chains)
+	lengths = [base_len+1]*n_longer + [base_len]*(n_chains-n_longer)
+	starts = np.cumsum([0] + lengths[:-1])
+	chain_ids = np.repeat(np.arange(n_chains), lengths)
+	w = frames.frameweights
 	
 	# catch runaway sampling
-	for c in chains:		
-		if( np.max(c.frameweights) == 0):
-			log.write("### Convergence summary: Gelman-Rubin not possible.\n")
-			log.write("WARNING: This usually means the sampling has left the support of its basis function!\n")
-			log.write("### Convergence not achieved\n")
-			return(False)
+	if( np.any(np.maximum.reduceat(w, starts) == 0) ):
+		log.write("### Convergence summary: Gelman-Rubin not possible.\n")
+		log.write("WARNING: This usually means the sampling has left the support of its basis function!\n")
+		log.write("### Convergence not achieved\n")
+		return(False)
 
 	#TODO: evtl. mögliche Vereinfachung: B_total_var = W_chain_var*n_frames 
+	# The chains can not be reshaped into a (chains, frames, D) view, as their lengths may differ by one.
+	# Instead, the per-frame work is done for all chains at once and summed per chain via np.add.reduceat.
+	X = frames.array
+	periodic = _periodic_mask(frames.converter)
+	
+	def chain_means(weights=None):
+		""" mean of each chain - computed exactly like InternalArray.mean() and mean_weighted() """
+		means = []
+		for (start, length) in zip(starts, lengths):
+			chain_weights = None
+			if(weights != None):
+				chain_weights = weights[start:start+length]
+			means.append([ c.mean(X[start:start+length, i], chain_weights) for (i, c) in enumerate(frames.converter) ])
+		return(np.array(means))
+	
+	# weighted intra-chain variance W - deviations are taken from the unweighted chain means, like var_weighted
+	diffs = _wrapped_diff(X, chain_means()[chain_ids], periodic)
+	var_per_chain = np.add.reduceat(w[:,None]*np.square(diffs), starts, axis=0) / np.add.reduceat(w, starts)[:,None]
+	W_chain_var = np.sum(var_per_chain, axis=0) / n_chains
+	
 	# calculate weighted inter-chain variance B, without factor n
-	var_per_chain = [c.var_weighted().array for c in chains]
-	sum_chain_var = np.sum(var_per_chain, axis=0)[0]
-	W_chain_var = sum_chain_var / n_chains
-		
-	mean_total = frames.mean_weighted()
-	square_diffs = [(c.mean_weighted() - mean_total).square().array for c in chains]
-	sum_square_diffs = np.sum(square_diffs, axis=0)[0]
-	B_total_var = sum_square_diffs / (n_chains-1) # TODO why -1?
+	mean_total = frames.mean_weighted().array
+	square_diffs = np.square(_wrapped_diff(chain_means(w), mean_total, periodic))
+	B_total_var = np.sum(square_diffs, axis=0) / (n_chains-1) # TODO why -1?
 	
 	print "W_chain_vars", W_chain_var
 	print "B_total_var", B_total_var
 	
 	# calculate variance estimate
-	chain_len = float(len(chains[1]))
+	chain_len = float(lengths[1])
 	V_hat = (1-(1/chain_len)) * W_chain_var + B_total_var
 	sqrt_R = np.sqrt(V_hat/W_chain_var)
 
@@ -108,30 +329,19 @@ def cluster_by_isa(eigenvectors, n_clusters):
     # the actual ISA algorithm
 	c = eigenvectors[:, range(n_clusters)]
 	ortho_sys = np.copy(c)
-	max_dist = 0.0
 	ind = np.zeros(n_clusters, dtype=np.int32)
 
 	# first two representatives with maximum distance
-	for (i, row) in enumerate(c):        
-		if np.linalg.norm(row, 2) > max_dist:
-			max_dist = np.linalg.norm(row, 2)
-			ind[0] = i
+	ind[0] = np.argmax(_row_norms(c))
 
 	ortho_sys -= c[ind[0], None]
 	
 	# further representatives via Gram-Schmidt orthogonalization
 	for k in range(1, n_clusters):
-		max_dist = 0.0
 		temp = np.copy(ortho_sys[ind[k-1]])
-		
-
-		for (i, row) in enumerate(ortho_sys):
-			row -= np.dot( np.dot(temp, np.transpose(row)), temp )
-			distt = np.linalg.norm(row, 2)
-			if distt > max_dist:
-				max_dist = distt
-				ind[k] = i
-
+		# project all rows at once onto the complement of temp
+		ortho_sys -= np.outer(np.dot(ortho_sys, temp), temp)
+		ind[k] = np.argmax(_row_norms(ortho_sys))
 		ortho_sys /= np.linalg.norm( ortho_sys[ind[k]], 2 )
 
 	# linear transformation of eigenvectors
@@ -149,15 +359,61 @@ def cluster_by_isa(eigenvectors, n_clusters):
 	return (c_f, indic, chi, rot_mat)
 
 
+#===============================================================================
+def _row_norms(matrix):
+	""" Euclidean norm of every row - argmax picks the first maximum, as the old loops did """
+	return( np.sqrt(np.sum(matrix*matrix, axis=1)) )
+
+
+#===============================================================================
+def _spectral_norm(matrix):
+	""" 2-norm of a square matrix, symmetric matrices are handled by eigvalsh instead of a full SVD.
+	For scipy.sparse matrices only the largest eigen- or singular value is computed via ARPACK. """
+	import scipy.sparse
+	if(scipy.sparse.issparse(matrix)):
+		if(matrix.nnz == 0):
+			return(0.0)
+		if(min(matrix.shape) < 3):
+			return( _spectral_norm(matrix.toarray()) )
+		from scipy.sparse.linalg import eigsh, svds
+		if((matrix - matrix.T).nnz == 0):
+			return( np.max(np.abs(eigsh(matrix, k=1, which="LM", return_eigenvectors=False))) )
+		return( np.max(svds(matrix, k=1, return_singular_vectors=False)) )
+	
+	if(np.array_equal(matrix, matrix.T)):
+		return( np.max(np.abs(np.linalg.eigvalsh(matrix))) )
+	return( np.linalg.norm(matrix, 2) )
+
+
+#===============================================================================
+def _scale_rows(factors, matrix):
+	""" Returns diag(factors)*matrix - for numpy arrays as well as for scipy.sparse matrices """
+	import scipy.sparse
+	if(scipy.sparse.issparse(matrix)):
+		return( scipy.sparse.diags(factors, 0).dot(matrix).tocsr() )
+	return( factors[:,None] * matrix )
+
+
+#===============================================================================
+def _row_sums(matrix):
+	return( np.asarray(matrix.sum(axis=1)).ravel() )
+
+
 #===============================================================================
 def symmetrize(matrix, weights, correct_weights=False, error=1E-02):
+	"""
+	Scales the rows of matrix to the given weights and symmetrizes it until both hold up to the given error. 
+	The matrix can also be a scipy.sparse matrix, the result is of the same kind then.
+	@param correct_weights: replace weights by the left eigenvector of matrix beforehand
+	@return: stochastic matrix and weights
+	"""
 	weights_new = weights
  
 	if correct_weights:
 		diff = 1		
 		while diff >= error:
   			# left eigenvector of matrix yields weights_new
-			weights_new = np.dot(np.transpose(matrix), weights)
+			weights_new = matrix.T.dot(weights)
 			# iterate until we are below the error
 			diff = np.linalg.norm(weights - weights_new, 2)
 			weights = weights_new
@@ -165,15 +421,15 @@ def symmetrize(matrix, weights, correct_weights=False, error=1E-02):
 	diff = 1
 	while diff >= error:
 		# scaling row sum of matrix to the respective weight yields matrix_new
-		matrix_new = np.dot( np.diag( (1/np.sum(matrix, axis=1))*weights ), matrix )
+		matrix_new = _scale_rows( (1/_row_sums(matrix))*weights, matrix )
 		# make matrix_new symmetric
-		matrix_new = 0.5*( matrix_new + np.transpose(matrix_new) )
+		matrix_new = 0.5*( matrix_new + matrix_new.T )
 		# iterate until we are below the error
-		diff = np.linalg.norm(matrix - matrix_new, 2)
+		diff = _spectral_norm(matrix - matrix_new)
 		matrix = matrix_new
 		
 	# make matrix_new stochastic
-	matrix_new = np.dot( np.diag( (1/np.sum(matrix_new, axis=1)) ), matrix_new )
+	matrix_new = _scale_rows( 1/_row_sums(matrix_new), matrix_new )
 	
 	return(matrix_new, weights_new)
 
@@ -190,35 +446,71 @@ def orthogonalize(eigenvalues, eigenvectors, weights):
 
 	if perron > 1:
 		# look for most constant eigenvector
-		max_scal = 0.0
-	
-		for i in range(perron):
-			scal = np.dot( np.transpose(eigenvectors[:,i]), weights )
-			if np.abs(scal) > max_scal:
-				max_scal = np.abs(scal)
-				max_i = i
+		scal = np.dot( np.transpose(eigenvectors[:,:perron]), weights )
+		max_i = np.argmax(np.abs(scal))
 
 		# swap non-constant eigenvector
 		eigenvectors[:,max_i] = eigenvectors[:,0]
-		eigenvectors[:,0] = np.ones(eigenvectors.shape[1])
+		eigenvectors[:,0] = np.ones(eigenvectors.shape[0])
 
 		# weight-orthogonalize all other eigenvectors
 		for i in range(1, perron):
 			for j in range(i):
-				scal = np.dot( np.dot( np.transpose(eigenvectors[:,j]), np.diag(weights) ), eigenvectors[:,i] ) 
+				scal = np.dot( eigenvectors[:,j]*weights, eigenvectors[:,i] )
 				eigenvectors[:,i] -= scal * eigenvectors[:,j]
 
 	# normalize
-	for eigvec in np.transpose(eigenvectors):
-		weighted_norm = np.dot( np.dot( np.transpose(eigvec), np.diag(weights) ), eigvec )
-		eigvec /= np.sqrt(weighted_norm)
+	weighted_norms = np.sum( eigenvectors*eigenvectors*weights[:,None], axis=0 )
+	eigenvectors /= np.sqrt(weighted_norms)
 
-	eigenvectors[:,0] = np.ones(eigenvectors.shape[1])
+	eigenvectors[:,0] = np.ones(eigenvectors.shape[0])
 	return eigenvectors
 
 
 #===============================================================================
-def opt_soft(eigvectors, rot_matrix, n_clusters):
+def eig_reversible(matrix, weights, n_eigvals):
+	"""
+	Computes the leading eigenvalues and right eigenvectors of a matrix, which is 
+	reversible with respect to the given weights - e.g. as returned by L{symmetrize}.
+	
+	The similarity transform W^(1/2)*S*W^(-1/2) with W=diag(weights) is symmetric, 
+	hence only the top part of the spectrum has to be computed by Lanczos (scipy's eigsh).
+	Works for numpy arrays as well as for scipy.sparse matrices.
+	
+	@param n_eigvals: number of eigenpairs, at most the size of matrix minus one
+	@return: eigenvalues in descending order and the corresponding eigenvectors as columns
+	"""
+	import scipy.sparse
+	from scipy.sparse.linalg import eigsh
+	sqrt_w = np.sqrt(weights)
+	if(scipy.sparse.issparse(matrix)):
+		sym = scipy.sparse.diags(sqrt_w, 0).dot(matrix).dot(scipy.sparse.diags(1/sqrt_w, 0))
+	else:
+		sym = sqrt_w[:,None] * matrix / sqrt_w[None,:]
+	# matrix is reversible only up to the error of symmetrize
+	sym = 0.5*( sym + sym.T )
+	n_eigvals = min(n_eigvals, matrix.shape[0]-1)
+	(eigvalues, eigvectors) = eigsh(sym, k=n_eigvals, which="LA")
+	order = np.argsort(-eigvalues)
+	return( eigvalues[order], eigvectors[:,order] / sqrt_w[:,None] )
+
+
+#===============================================================================
+def opt_soft(eigvectors, rot_matrix, n_clusters, method="lbfgs", n_starts=1, n_procs=None, verbose=True):
+	"""
+	Optimizes the rotation matrix of PCCA+ with respect to the crispness of chi.
+	
+	By default the objective is minimized by L-BFGS-B with its analytic gradient - 
+	the first start uses the given rot_matrix, further starts perturb it randomly and
+	are executed in parallel. The best result is returned, but never one worse than the given rot_matrix.
+	
+	@param method: "lbfgs" or "nelder-mead" (the old, slow scipy.optimize.fmin)
+	@param n_starts: number of L-BFGS-B runs
+	@param n_procs: number of processes for the runs, default: number of cpus
+	@param verbose: print objective and time of each run
+	"""
+	assert(method in ("lbfgs", "nelder-mead"))
+	assert(n_starts >= 1)
 
 	# only consider first n_clusters eigenvectors
 	eigvectors = eigvectors[:,:n_clusters]
@@ -230,23 +522,29 @@ def opt_soft(eigvectors, rot_matrix, n_clusters):
 	
 	# reshape rot_crop_matrix into linear vector
 	rot_crop_vec = np.reshape(rot_crop_matrix, x*y)
+	f_start = _susanna_func(rot_crop_vec, eigvectors)[0]
 
-	# target function for optimization
-	def susanna_func(rot_crop_vec, eigvectors):
-		# reshape into matrix
-		rot_crop_matrix = np.reshape(rot_crop_vec, (x, y))
-		# fill matrix
-		rot_matrix = fill_matrix(rot_crop_matrix, eigvectors)
-
-		result = 0
-		for i in range(0, n_clusters):
-			for j in range(1, n_clusters):
-				result += np.power(rot_matrix[j,i], 2) / rot_matrix[0,i]
-		return(-result)
-
-
-	from scipy.optimize import fmin
-	rot_crop_vec_opt = fmin( susanna_func, rot_crop_vec, args=(eigvectors,) )
+	if(method == "nelder-mead"):
+		from scipy.optimize import fmin
+		t = time.time()
+		rot_crop_vec_opt = fmin( lambda v: _susanna_func(v, eigvectors)[0], rot_crop_vec )
+		results = [ (_susanna_func(rot_crop_vec_opt, eigvectors)[0], rot_crop_vec_opt, time.time()-t) ]
+	
+	else:
+		starts = [rot_crop_vec]
+		rng = np.random.RandomState(np.random.randint(0, 2**31-1))
+		scale = 0.1*np.mean(np.abs(rot_crop_vec))
+		for i in range(1, n_starts):
+			starts.append( rot_crop_vec + rng.normal(scale=scale, size=rot_crop_vec.shape) )
+		results = parallel_map(_opt_soft_run, starts, n_procs, shared=eigvectors)
+
+	(f_opt, rot_crop_vec_opt, _) = min(results, key=lambda r: r[0])
+	if(verbose):
+		for (i, (f_run, _, runtime)) in enumerate(results):
+			print("opt_soft run %2d - objective: %f, time: %.2fs"%(i, f_run, runtime))
+		print("opt_soft objective - before: %f, after: %f"%(f_start, min(f_opt, f_start)))
+	if(f_opt > f_start):
+		rot_crop_vec_opt = rot_crop_vec
 	
 	rot_crop_matrix = np.reshape(rot_crop_vec_opt, (x, y))
 	rot_matrix = fill_matrix(rot_crop_matrix, eigvectors)
@@ -254,6 +552,49 @@ def opt_soft(eigvectors, rot_matrix, n_clusters):
 	return(rot_matrix)
 
 
+#===============================================================================
+def _opt_soft_run(eigvectors, rot_crop_vec):
+	""" A single L-BFGS-B run of opt_soft - runs within a worker process. """
+	from scipy.optimize import minimize
+	t = time.time()
+	res = minimize(_susanna_func, rot_crop_vec, args=(eigvectors,), jac=True, method="L-BFGS-B")
+	return(res.fun, res.x, time.time()-t)
+
+
+#===============================================================================
+def _susanna_func(rot_crop_vec, eigvectors):
+	"""
+	Target function of opt_soft and its gradient with respect to rot_crop_vec.
+	
+	With the rotation matrix A from L{fill_matrix}, the objective is
+	-sum_i sum_{j>0} A[j,i]^2 / A[0,i]. The column maxima in fill_matrix are
+	piecewise linear, hence the gradient is taken at the current maximizing rows.
+	"""
+	n_clusters = eigvectors.shape[1]
+	rot_crop_matrix = np.reshape(rot_crop_vec, (n_clusters-1, n_clusters-1))
+	
+	# same as fill_matrix, but keeping the intermediate results
+	rot_rest = np.column_stack([-np.sum(rot_crop_matrix, axis=1), rot_crop_matrix])
+	tmp = -np.dot(eigvectors[:,1:], rot_rest)
+	argmax_rows = np.argmax(tmp, axis=0)
+	col_max = tmp[argmax_rows, np.arange(n_clusters)]
+	col_max_sum = np.sum(col_max)
+	
+	# with A = [col_max; rot_rest]/col_max_sum the objective becomes -sum(q/col_max)/col_max_sum
+	q = np.sum(np.square(rot_rest), axis=0)
+	ratios = q / col_max
+	result = -np.sum(ratios) / col_max_sum
+	
+	# derivatives of col_max and col_max_sum with respect to rot_rest
+	d_max = -np.transpose(eigvectors[argmax_rows, 1:])
+	grad = -( 2*rot_rest/col_max - d_max*ratios/col_max ) / col_max_sum
+	grad += d_max * np.sum(ratios) / col_max_sum**2
+	
+	# chain rule through the first column of rot_rest, which is -row_sums
+	grad = grad[:,1:] - grad[:,0,None]
+	return(result, np.reshape(grad, -1))
+
+
 #===============================================================================
 def fill_matrix(rot_crop_matrix, eigvectors):
 
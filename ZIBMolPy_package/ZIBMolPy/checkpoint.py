@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+
+"""
+Checkpoints for long running analyses, e.g. the S matrix of L{zgf_analyze} or L{zgf_reweight}.
+
+A checkpoint file records the results of completed units (a row, a node, a frame...) of a
+computation. Each result is appended and synced to disk as soon as it is available, hence a rerun
+can skip all units, which were completed before the process got killed::
+
+	ckpt = Checkpoint(pool.analysis_dir+"s_mat.ckpt", key=inputs, dependencies=trr_files)
+	for i in range(n_rows):
+		if(i not in ckpt):
+			ckpt[i] = calc_row(i)
+	...
+	ckpt.remove() # final result was written
+
+The first record of the file is a digest of the given key. A checkpoint of a computation with
+different inputs is discarded. The dependencies are registered via
+L{register_file_dependency<ZIBMolPy.utils.register_file_dependency>}, therefore L{zgf_cleanup}
+removes outdated checkpoints just like outdated results.
+"""
+
+import os
+from os import path
+import cPickle
+from hashlib import md5
+from ZIBMolPy.utils import register_file_dependency, fn2dep
+
+
+#===============================================================================
+class Checkpoint(object):
+	def __init__(self, filename, key, dependencies=()):
+		"""
+		@param filename: checkpoint file - usually within the analysis directory
+		@param key: any picklable description of the inputs, e.g. a tuple of node names and parameters
+		@param dependencies: files the computation depends on
+		"""
+		self.filename = filename
+		self.key_digest = md5(cPickle.dumps(key, cPickle.HIGHEST_PROTOCOL)).hexdigest()
+		self.results = dict() # unit -> result
+
+		valid_size = self._load()
+		if(valid_size == 0):
+			f = open(self.filename, "wb")
+			cPickle.dump(self.key_digest, f, cPickle.HIGHEST_PROTOCOL)
+			f.close()
+			if(path.exists(fn2dep(self.filename))):
+				os.remove(fn2dep(self.filename))
+		else:
+			# cut off a partially written record
+			f = open(self.filename, "r+b")
+			f.truncate(valid_size)
+			f.close()
+			print("Resuming from checkpoint %s with %d completed units."%(self.filename, len(self.results)))
+
+		for fn in dependencies:
+			register_file_dependency(self.filename, fn)
+
+	#---------------------------------------------------------------------------
+	def _load(self):
+		""" Reads all complete records, returns the size of the valid part of the file - 0 means unusable """
+		if(not path.exists(self.filename)):
+			return(0)
+		f = open(self.filename, "rb")
+		try:
+			try:
+				if(cPickle.load(f) != self.key_digest):
+					print("Discarding checkpoint %s - its inputs changed."%self.filename)
+					return(0)
+			except Exception:
+				return(0)
+			valid_size = f.tell()
+			while(True):
+				try:
+					(unit, result) = cPickle.load(f)
+				except EOFError:
+					break
+				except Exception:
+					break # partially written record
+				self.results[unit] = result
+				valid_size = f.tell()
+			return(valid_size)
+		finally:
+			f.close()
+
+	#---------------------------------------------------------------------------
+	def __contains__(self, unit):
+		return(unit in self.results)
+
+	def __getitem__(self, unit):
+		return(self.results[unit])
+
+	def __len__(self):
+		return(len(self.results))
+
+	#---------------------------------------------------------------------------
+	def __setitem__(self, unit, result):
+		""" Records the result of a completed unit - it is on disk, when this returns """
+		f = open(self.filename, "ab")
+		cPickle.dump((unit, result), f, cPickle.HIGHEST_PROTOCOL)
+		f.flush()
+		os.fsync(f.fileno())
+		f.close()
+		self.results[unit] = result
+
+	#---------------------------------------------------------------------------
+	def remove(self):
+		""" Removes the checkpoint - call this after the final result was written """
+		remove_checkpoint(self.filename)
+
+
+#===============================================================================
+def file_stamp(filename):
+	""" Returns a string, which changes whenever the file is modified - useful as part of a checkpoint key """
+	if(not path.exists(filename)):
+		return("missing")
+	return("%d %r"%(path.getsize(filename), path.getmtime(filename)))
+
+
+#===============================================================================
+def remove_checkpoint(filename):
+	""" Removes the given checkpoint file along with its dependencies, if it exists """
+	for fn in (filename, fn2dep(filename)):
+		if(path.exists(fn)):
+			os.remove(fn)
+
+#===============================================================================
+#EOF
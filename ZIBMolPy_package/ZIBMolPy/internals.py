@@ -60,6 +60,7 @@ in L{zgf_create_nodes}, which determines the associated Gromacs restraints.
 
 import numpy as np
 import re
+from os import path
 from ZIBMolPy.io.pdb import PdbFile
 from ZIBMolPy.io.trr import TrrFile
 from ZIBMolPy.utils import all #pylint: disable=W0622
@@ -409,7 +410,7 @@ class PbcResolver(object):
 class Converter(tuple):
 	""" @note: Converter-Objects are read-only. """
 	
-	def __new__(cls, int_fn=None, coord_list=None):
+	def __new__(cls, int_fn=None, coord_list=None, root_dir=""):
 		r""" Creates a new Converter either by loading it from file or by creating
 		it from a given list of L{InternalCoordinate} objects.
 		
@@ -417,13 +418,14 @@ class Converter(tuple):
 		
 		@param int_fn: filename of an internal file
 		@param coord_list: list of L{InternalCoordinate} objects.
+		@param root_dir: directory, which int_fn is relative to - int_fn itself is kept as given
 		"""
 		
 		assert( (int_fn==None) ^ (coord_list==None) ) # "^" == XOR
 				
 		if(int_fn!=None): # load from file
 			assert(int_fn.endswith(".int"))
-			f = open(int_fn)
+			f = open(path.join(root_dir, int_fn))
 			raw = f.read()
 			f.close()
 			found_linear = False #needed to detect error and throw Exception - see below
@@ -518,21 +520,34 @@ class Converter(tuple):
 		@param fn: filename of a gromacs trr trajectory.
 		@return: L{InternalArray}
 		"""
+		return( self.iter_trajectory(fn, chunk_size=None).next() )
+	
+	def iter_trajectory(self, fn, chunk_size=10000, start=0, end=None):
+		"""
+		Like L{read_trajectory}, but yields the trajectory in chunks of at most chunk_size frames.
+		
+		@param chunk_size: None means all frames in one chunk
+		@param start: byte-offset of the first frame to read, see L{TrrFile}
+		@param end: byte-offset after the last frame to read, see L{TrrFile}
+		@return: generator of L{InternalArray}s
+		"""
 		required_atoms = set(sum([c.atoms for c in self], () ))	
 		atoms_start = min(required_atoms)
 		atoms_end   = max(required_atoms) + 1
-		f_trr = TrrFile(fn)
-		(frames_x, frames_box) = f_trr.read_frames(atoms_start, atoms_end, read_boxes=True)
-		f_trr.close()
-		pbc = PbcResolver(frames_box)
-		
-		def dx_provider(atom1, atom2):
-			ai = frames_x[:,atom1-atoms_start,:]
-			aj = frames_x[:,atom2-atoms_start,:]
-			return(pbc.rvec_sub(ai, aj))
-		
-		array = np.column_stack([ c.from_externals(dx_provider) for c in self ])
-		return( InternalArray(self, array) )
+		f_trr = TrrFile(fn, start, end)
+		try:
+			for (frames_x, frames_box) in f_trr.iter_frames(chunk_size, atoms_start, atoms_end, read_boxes=True):
+				pbc = PbcResolver(frames_box)
+				
+				def dx_provider(atom1, atom2):
+					ai = frames_x[:,atom1-atoms_start,:] #pylint: disable=W0640
+					aj = frames_x[:,atom2-atoms_start,:] #pylint: disable=W0640
+					return(pbc.rvec_sub(ai, aj)) #pylint: disable=W0640
+				
+				array = np.column_stack([ c.from_externals(dx_provider) for c in self ])
+				yield( InternalArray(self, array) )
+		finally:
+			f_trr.close()
 		
 	#---------------------------------------------------------------------------
 	# implementation for python 2.4
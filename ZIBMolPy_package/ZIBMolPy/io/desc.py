@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+
+"""
+Binary descriptor files for nodes (e.g. node0042_desc.bin).
+
+A descriptor file consists of three parts:
+	1. a magic line: "ZIBMolPy-desc <version>"
+	2. a single line of JSON, which holds the encoded object tree and the byte-offsets of the array-payloads
+	3. the concatenated payloads of all contained numpy-arrays in the .npy-format
+
+Objects, which can not be mapped onto JSON directly, are tagged with a
+single special key, e.g. C{{"__tuple__": [...]}} or C{{"__array__": 3}}.
+Objects unknown to the encoder are stored via their repr and eval'ed on reading -
+just like the old text-based descriptors.
+"""
+
+import json
+import hashlib
+import numpy as np
+from cStringIO import StringIO
+
+from ZIBMolPy.utils import write_atomic
+from ZIBMolPy.internals import InternalArray, Converter
+from ZIBMolPy.restraint import Restraint
+
+MAGIC = "ZIBMolPy-desc"
+VERSION = 1
+
+
+#===============================================================================
+def encode_desc(data):
+	""" @return: the content of a descriptor file for the given dict """
+	payload = StringIO()
+	offsets = []
+	tree = _encode(data, payload, offsets)
+	header = json.dumps({"version": VERSION, "arrays": offsets, "data": tree}, sort_keys=True)
+	return("%s %d\n%s\n%s"%(MAGIC, VERSION, header, payload.getvalue()))
+
+
+#===============================================================================
+def digest(content):
+	""" @return: fingerprint of a descriptor's content - used to detect unchanged nodes """
+	return(hashlib.md5(content).hexdigest())
+
+
+#===============================================================================
+def write_desc(filename, data, fsync_dir=True):
+	""" Writes the given dict into a new descriptor file. The file is replaced atomically. """
+	write_atomic(filename, encode_desc(data), fsync_dir)
+
+
+#===============================================================================
+def read_desc(filename, namespace):
+	""" Reads a descriptor file.
+
+	@param namespace: dict which provides the classes needed to restore the stored objects
+	(e.g. Node, DihedralRestraint) - it is also used to eval repr-encoded objects.
+	"""
+	return( load_desc(filename, namespace)[0] )
+
+
+#===============================================================================
+def load_desc(filename, namespace):
+	""" Like L{read_desc}, but also returns the L{digest} of the file's content.
+	@return: tuple (data, digest)
+	"""
+	content = open(filename, "rb").read()
+	f = StringIO(content)
+	(magic, version) = f.readline().split()
+	if(magic != MAGIC):
+		raise(Exception("Not a descriptor file: "+filename))
+	if(int(version) > VERSION):
+		raise(Exception("Descriptor file was written by a newer version of ZIBMolPy: "+filename))
+	header = json.loads(f.readline())
+	payload_start = f.tell()
+	arrays = []
+	for offset in header["arrays"]:
+		f.seek(payload_start + offset)
+		arrays.append( np.lib.format.read_array(f) )
+
+	return( _decode(header["data"], arrays, namespace), digest(content) )
+
+
+#===============================================================================
+def _encode(obj, payload, offsets):
+	#pylint: disable=R0911
+	from ZIBMolPy.node import Node #avoids circular imports
+
+	if(obj is None or isinstance(obj, (bool, int, long, float))):
+		return(obj)
+
+	if(isinstance(obj, basestring)):
+		return(obj)
+
+	if(isinstance(obj, np.ndarray) and obj.dtype != np.object):
+		offsets.append(payload.tell())
+		np.lib.format.write_array(payload, obj)
+		return({"__array__": len(offsets)-1})
+
+	if(isinstance(obj, np.generic) and not isinstance(obj, np.object_)):
+		return({"__scalar__": _encode(np.array(obj), payload, offsets)})
+
+	if(isinstance(obj, list)):
+		return([_encode(x, payload, offsets) for x in obj])
+
+	if(isinstance(obj, tuple) and type(obj) == tuple):
+		return({"__tuple__": [_encode(x, payload, offsets) for x in obj]})
+
+	if(isinstance(obj, dict)):
+		items = [ (k, _encode(v, payload, offsets)) for (k,v) in obj.items() ]
+		if(all([isinstance(k, basestring) and not k.startswith("__") for (k,v) in items])):
+			return(dict(items))
+		return({"__items__": [[_encode(k, payload, offsets), v] for (k,v) in items]})
+
+	if(isinstance(obj, Node)):
+		return({"__node__": obj.name})
+
+	if(isinstance(obj, Converter) and obj.filename != None):
+		return({"__converter__": obj.filename})
+
+	if(isinstance(obj, InternalArray)):
+		return({"__internals__": {
+			"converter": _encode(obj.converter, payload, offsets),
+			"array": _encode(obj.array, payload, offsets),
+			"frameweights": _encode(obj.frameweights, payload, offsets) }})
+
+	if(isinstance(obj, Restraint)):
+		return({"__restraint__": {
+			"class": obj.__class__.__name__,
+			"atoms": _encode(obj.atoms, payload, offsets),
+			"params": _encode(obj.params, payload, offsets) }})
+
+	# fallback - e.g. datetime-objects or Converters with coord_list
+	return({"__eval__": repr(obj)})
+
+
+#===============================================================================
+def _decode(obj, arrays, namespace):
+	#pylint: disable=R0911
+	if(isinstance(obj, unicode)):
+		try:
+			return(str(obj))
+		except UnicodeEncodeError:
+			return(obj)
+
+	if(isinstance(obj, list)):
+		return([_decode(x, arrays, namespace) for x in obj])
+
+	if(not isinstance(obj, dict)):
+		return(obj)
+
+	dec = lambda x: _decode(x, arrays, namespace)
+	if(len(obj) == 1):
+		(tag, value) = obj.items()[0]
+		if(tag == "__array__"):
+			return(arrays[value])
+		if(tag == "__scalar__"):
+			return(dec(value)[()])
+		if(tag == "__tuple__"):
+			return(tuple(dec(value)))
+		if(tag == "__items__"):
+			return(dict([ (dec(k), dec(v)) for (k,v) in value ]))
+		if(tag == "__node__"):
+			return(namespace["Node"](str(value)))
+		if(tag == "__converter__"):
+			return(namespace["Converter"](int_fn=str(value)))
+		if(tag == "__internals__"):
+			return(namespace["InternalArray"](dec(value["converter"]), dec(value["array"]), dec(value["frameweights"])))
+		if(tag == "__restraint__"):
+			cls = namespace[str(value["class"])]
+			return(cls(dec(value["atoms"]), *dec(value["params"])))
+		if(tag == "__eval__"):
+			return(eval(value, namespace))
+
+	return(dict([ (str(k), dec(v)) for (k,v) in obj.items() ]))
+
+#===============================================================================
+#EOF
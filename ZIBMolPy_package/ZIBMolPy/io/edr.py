@@ -0,0 +1,263 @@
+# -*- coding: utf-8 -*-
+
+"""
+Reader for GROMACS energy files (.edr) - replaces calls of g_energy.
+
+The names of the energy terms can be listed and any subset of terms can be
+read for all frames in a single pass::
+
+	edr = EdrFile(node.dir+"/ener.edr")
+	print edr.term_names
+	(times, energies) = edr.read_terms(["Potential", "Dih.-Rest."])
+
+Terms are looked up like g_energy does: case-insensitive and with dashes instead of blanks,
+e.g. "Proper-Dih." selects the term "Proper Dih.".
+"""
+
+import struct
+import numpy as np
+from warnings import warn
+
+#http://code.google.com/p/mdanalysis/source/browse/trunk/src/xdrfile/
+# gromacs/src/gmxlib/enxio.c
+
+# using big-endian due to XDR-standard
+#http://tools.ietf.org/html/rfc1014
+
+ENX_VERSION = 5
+NAMES_MAGIC = -55555
+FRAME_MAGIC = -7777777
+DTYPE_FLOAT = np.dtype(">f4")
+DTYPE_DOUBLE = np.dtype(">f8")
+
+# data types of sub-blocks (enum xdr_datatype in gromacs)
+XDR_INT, XDR_FLOAT, XDR_DOUBLE, XDR_LARGE_INT, XDR_CHAR, XDR_STRING = range(6)
+XDR_SIZES = {XDR_INT:4, XDR_FLOAT:4, XDR_DOUBLE:8, XDR_LARGE_INT:8, XDR_CHAR:4} # chars are padded to 4 bytes
+
+
+#===============================================================================
+class EdrFile(object):
+	def __init__(self, filename):
+		assert(filename.endswith(".edr"))
+		self.filename = filename
+		f = open(filename, "rb")
+		self.data = f.read()
+		f.close()
+
+		self.pos = 0
+		magic = self._int()
+		if(magic > 0):
+			# old format without version, magic is the number of terms
+			self.file_version = 1
+			n_terms = magic
+		else:
+			if(magic != NAMES_MAGIC):
+				raise(Exception("Not a GROMACS energy file: "+filename))
+			self.file_version = self._int()
+			if(self.file_version > ENX_VERSION):
+				raise(Exception("Energy file version %d not supported: %s"%(self.file_version, filename)))
+			n_terms = self._int()
+
+		self.term_names = []
+		self.units = []
+		for dummy in range(n_terms):
+			self.term_names.append(self._string())
+			if(self.file_version >= 2):
+				self.units.append(self._string())
+			else:
+				self.units.append("kJ/mol")
+		self.frames_start = self.pos
+
+		# files are written in single or double precision - try which one makes sense for the first frame
+		# (one without energies or blocks parses in both precisions)
+		candidates = []
+		for (i, dtype) in enumerate((DTYPE_FLOAT, DTYPE_DOUBLE)):
+			self.dtype = dtype
+			self.pos = self.frames_start
+			try:
+				frame = self._frame()
+			except struct.error:
+				frame = (None, []) # incomplete - can not tell
+			if(frame != None):
+				candidates.append( (len(frame[1]) != len(self.term_names), i, dtype) )
+		if(len(candidates) == 0):
+			raise(Exception("Energy file neither in single nor in double precision: "+filename))
+		self.dtype = min(candidates)[2]
+
+	#---------------------------------------------------------------------------
+	def find_terms(self, terms):
+		""" Returns the indices of the given terms - names are matched like g_energy does, missing terms are left out with a warning """
+		normalized = [ n.replace(" ", "-").lower() for n in self.term_names ]
+		indices = []
+		for t in terms:
+			if(t.replace(" ", "-").lower() in normalized):
+				indices.append( normalized.index(t.replace(" ", "-").lower()) )
+			else:
+				warn("Energy term '%s' not found in %s."%(t, self.filename))
+		return(indices)
+
+	#---------------------------------------------------------------------------
+	def read_terms(self, terms=None):
+		"""
+		Reads the given energy terms of all frames in one pass.
+		@param terms: names of the terms, None means all terms
+		@return: times (1D array) and energies (2D array, one column per term)
+		"""
+		if(terms == None):
+			indices = range(len(self.term_names))
+		else:
+			indices = self.find_terms(terms)
+			if(len(indices) != len(terms)):
+				raise(Exception("Energy terms missing in %s: %s"%(self.filename, terms)))
+
+		times = []
+		energies = []
+		self.pos = self.frames_start
+		while(self.pos < len(self.data)):
+			try:
+				frame = self._frame()
+			except struct.error:
+				break # frame is incomplete - e.g. the run was killed while writing it
+			if(frame == None):
+				raise(Exception("Corrupt frame in energy file: "+self.filename))
+			(t, values) = frame
+			if(len(values) == 0):
+				continue # frame without energies, g_energy skips those as well
+			times.append(t)
+			energies.append(values[indices])
+
+		return( np.array(times), np.array(energies, dtype=float).reshape(len(times), len(indices)) )
+
+	#---------------------------------------------------------------------------
+	def read_times(self):
+		""" Returns the times of all frames """
+		return(self.read_terms([])[0])
+
+	#---------------------------------------------------------------------------
+	def sum_terms(self, terms):
+		""" Like g_energy -sum: returns the sum of the given terms for every frame - terms, which do not exist, are left out """
+		indices = self.find_terms(terms)
+		if(len(indices) == 0):
+			raise(Exception("None of the energy terms found in %s: %s"%(self.filename, terms)))
+		energies = self.read_terms([ self.term_names[i] for i in indices ])[1]
+		return( np.sum(energies, axis=1) )
+
+	#---------------------------------------------------------------------------
+	def _frame(self):
+		""" Reads a frame, returns its time and energies or None if it does not match the precision """
+		header = self._header()
+		if(header == None):
+			return(None)
+		(t, nsum, nre, blocks) = header
+		# each term comes with its average and sum, if there are any
+		stride = 1
+		if(self.file_version == 1):
+			stride = 4
+		elif(nsum > 0):
+			stride = 3
+		values = self._reals(nre*stride)[::stride]
+		self._skip_blocks(blocks)
+		return(t, values)
+
+	#---------------------------------------------------------------------------
+	def _header(self):
+		""" Reads a frame header, returns time, nsum, number of energies and the sub-blocks or None if it does not match the precision """
+		# new formats start with the real -2e10 - read with the wrong precision it looks like an old header
+		first_real = self._reals(1)[0]
+		if(first_real > -1e10):
+			# old format: starts with the time
+			if(self.file_version != 1):
+				return(None)
+			t = first_real
+			step = self._int()
+			nsum = 1
+		else:
+			if(self._int() != FRAME_MAGIC):
+				return(None)
+			file_version = self._int()
+			if(file_version != self.file_version):
+				return(None)
+			t = self._double()
+			step = self._large_int()
+			nsum = self._int()
+			if(file_version >= 3):
+				self._large_int() # nsteps
+			if(file_version >= 5):
+				self._double() # dt
+
+		nre = self._int()
+		ndisre = self._int() # reserved since version 4
+		if(self.file_version >= 4):
+			ndisre = 0
+		nblock = self._int()
+		if(nre < 0 or ndisre < 0 or nblock < 0 or step < 0):
+			return(None)
+		if(nre > 0 and nre != len(self.term_names)):
+			return(None)
+
+		# sub-blocks as lists of (type, count)
+		blocks = []
+		if(ndisre > 0):
+			blocks.append( [("real", ndisre), ("real", ndisre)] )
+		for dummy in range(nblock):
+			if(self.file_version < 4):
+				blocks.append( [("real", self._int())] )
+			else:
+				self._int() # block id
+				nsub = self._int()
+				blocks.append( [ (self._int(), self._int()) for dummy in range(nsub) ] )
+
+		self._int() # e_size
+		self._int() # reserved
+		self._int() # reserved
+		return(t, nsum, nre, blocks)
+
+	#---------------------------------------------------------------------------
+	def _skip_blocks(self, blocks):
+		for block in blocks:
+			for (datatype, count) in block:
+				if(datatype == "real"):
+					self.pos += count*self.dtype.itemsize
+				elif(datatype == XDR_STRING):
+					for dummy in range(count):
+						self._int() # length including the terminating zero
+						self._string()
+				elif(datatype in XDR_SIZES):
+					self.pos += count*XDR_SIZES[datatype]
+				else:
+					raise(Exception("Unknown data type %d in energy file: %s"%(datatype, self.filename)))
+				if(self.pos > len(self.data)):
+					raise(struct.error("incomplete block"))
+
+	#---------------------------------------------------------------------------
+	def _int(self):
+		value = struct.unpack_from(">i", self.data, self.pos)[0]
+		self.pos += 4
+		return(value)
+
+	def _large_int(self):
+		value = struct.unpack_from(">q", self.data, self.pos)[0]
+		self.pos += 8
+		return(value)
+
+	def _double(self):
+		value = struct.unpack_from(">d", self.data, self.pos)[0]
+		self.pos += 8
+		return(value)
+
+	def _reals(self, count):
+		if(self.pos + count*self.dtype.itemsize > len(self.data)):
+			raise(struct.error("incomplete frame"))
+		values = np.frombuffer(self.data, self.dtype, count=count, offset=self.pos)
+		self.pos += count*self.dtype.itemsize
+		return(values)
+
+	def _string(self):
+		length = struct.unpack_from(">I", self.data, self.pos)[0]
+		value = self.data[self.pos+4 : self.pos+4+length]
+		self.pos += 4 + (length+3)/4*4
+		return(value.rstrip("\0"))
+
+
+#===============================================================================
+#EOF
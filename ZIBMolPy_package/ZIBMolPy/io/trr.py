@@ -22,11 +22,18 @@ DTYPE_DOUBLE = np.dtype(">f8")
 
 #===============================================================================
 class TrrFile(object):
-	def __init__(self, filename):
+	def __init__(self, filename, start=0, end=None):
+		"""
+		@param start: byte-offset of the first frame to read - used to read only newly appended frames
+		@param end: byte-offset after the last frame to read, default: end of file
+		"""
 		assert(filename.endswith(".trr"))
 		self.filename = filename
-		self.filesize = path.getsize(filename)
+		self.filesize = end
+		if(end == None):
+			self.filesize = path.getsize(filename)
 		self.fh = open(self.filename, "rb")
+		self.fh.seek(start)
 		self.first_frame = TrrFrame(self) 	
 	
 	#---------------------------------------------------------------------------
@@ -52,20 +59,30 @@ class TrrFile(object):
 		"""
 		@param read_boxes: introduced to keep backward-compatibility
 		"""
-		frames_x = []
-		frames_box = []
+		return( self.iter_frames(None, atoms_start, atoms_end, read_boxes).next() )
+	
+	#---------------------------------------------------------------------------
+	def iter_frames(self, chunk_size, atoms_start=0, atoms_end=None, read_boxes=False):
+		""" Like L{read_frames}, but yields the frames in chunks - so they never have to be in memory all at once.
+		@param chunk_size: maximal number of frames per chunk, None means all frames in one chunk
+		"""
 		frame = self.first_frame
-		while(True):
-			frames_x.append(   frame.read_positions(atoms_start, atoms_end) )
+		while(frame != None):
+			frames_x = []
+			frames_box = []
+			while(frame != None and (chunk_size == None or len(frames_x) < chunk_size)):
+				frames_x.append(   frame.read_positions(atoms_start, atoms_end) )
+				if(read_boxes):
+					frames_box.append( frame.read_box() )
+				if(frame.has_next()):
+					frame = frame.next()
+				else:
+					frame = None
+			
 			if(read_boxes):
-				frames_box.append( frame.read_box() )
-			if(not frame.has_next()): break
-			frame = frame.next()
-		
-		if(read_boxes):
-			return(np.array(frames_x), np.array(frames_box))
-		else:
-			return(np.array(frames_x))
+				yield(np.array(frames_x), np.array(frames_box))
+			else:
+				yield(np.array(frames_x))
 	
 		
 #===============================================================================
@@ -3,25 +3,102 @@
 
 from os import path
 import os
+import errno
 
 import numpy as np
-import itertools
 import traceback
 import socket
 import subprocess
+import threading
 import time
 from ZIBMolPy import utils
 from ZIBMolPy.phi import get_phi
+from ZIBMolPy.io import desc
+from ZIBMolPy.trajectory_cache import TrajectoryCache, TrajectoryCacheEntry
+from ZIBMolPy.pool_context import PoolContext
 
-#needed to eval node0042_desc.txt!!! 
+#needed to read node0042_desc.bin and node0042_desc.txt!!! 
 from ZIBMolPy.internals import InternalArray
 
 
+# Locks are leases: the lock-file holds an expiry time, which is renewed by
+# a heartbeat thread of the owning process. A lock expires when its owner died.
+LOCK_LEASE = float(os.environ.get("ZGF_LOCK_LEASE", 600)) # seconds
+
 #===============================================================================
-# this is what gets written to node.lock_fn during a lock
+# this is what gets written to node.lock_fn during a lock (followed by the expiry time)
 def my_lock_signature():
 	return( "%i %s"%(os.getpid(), socket.getfqdn()) )
-    
+
+
+#===============================================================================
+def read_lock(lock_fn):
+	""" @return: (pid, host, expiry) of the given lock-file - expiry is None for old-style locks """
+	fields = open(lock_fn).read().split()
+	if(len(fields) == 2):
+		return(fields[0], fields[1], None)
+	return(fields[0], fields[1], float(fields[2]))
+
+
+#===============================================================================
+def probe_pids(host, pids):
+	""" Checks which of the given pids exist on the given host - with a single ssh-call for remote hosts.
+	@return: set of the existing pids """
+	if(host == socket.getfqdn()):
+		return(set([p for p in pids if path.exists("/proc/"+p)])) # linux-way to check if a pid exists :-)
+	script = "for p in %s; do test -x /proc/$p && echo $p; done"%" ".join(pids)
+	cmd = ["ssh", "-o", "UserKnownHostsFile=/dev/null", "-o", "StrictHostKeyChecking=no", host, script]
+	p = subprocess.Popen(cmd, stdout=subprocess.PIPE)
+	(stdout, _) = p.communicate()
+	return(set(stdout.split()))
+
+
+#===============================================================================
+class LockHeartbeat(object):
+	""" Daemon-thread, which renews the leases of all locks held by this process. """
+	# Singleton-Pattern
+	_instance = None
+
+	def __new__(cls):
+		if(cls._instance != None):
+			return(cls._instance)
+
+		self = object.__new__(cls)
+		cls._instance = self
+
+		# actual init-code
+		self._held = dict() # lock_fn -> node
+		self._mutex = threading.Lock()
+		self._thread = None
+		return(self)
+
+	#---------------------------------------------------------------------------
+	def add(self, node):
+		with self._mutex:
+			self._held[node.lock_fn] = node
+			if(self._thread == None):
+				self._thread = threading.Thread(target=self._run, name="LockHeartbeat")
+				self._thread.daemon = True
+				self._thread.start()
+
+	def remove(self, node):
+		""" @return: True if the lock of the node was held """
+		with self._mutex:
+			return(self._held.pop(node.lock_fn, None) != None)
+
+	#---------------------------------------------------------------------------
+	def _run(self):
+		while(True):
+			time.sleep(LOCK_LEASE/3.0)
+			with self._mutex:
+				nodes = self._held.values()
+			for n in nodes:
+				try:
+					n.renew_lock()
+				except:
+					traceback.print_exc()
+					print("Warning: could not renew lock of %s"%n.name)
+
 
 
 #===============================================================================
@@ -37,46 +114,110 @@ class Store(dict):
 class Node(object):
 	#pylint: disable=W0404
 	
-	#Singleton-Pattern
-	_instances = dict()
-
-	def __new__(cls, name=None):
+	#Singleton-Pattern - one instance per name and L{PoolContext}
+	def __new__(cls, name=None, context=None):
 		""" Instanciates a node from a file, and (name=None) creates a new node
 		
-			Caution: Filenames are always given relative to the root-dir
+			Caution: Filenames are always given relative to the root-dir of the context
 			When no name is given, a new node is created. """
+		if(context == None):
+			context = PoolContext.default()
+		with context.lock:
+			return(cls._get_instance(name, context))
+	
+	@classmethod
+	def _get_instance(cls, name, context):
+		if(name!=None and context.nodes.has_key(name)):
+			return(context.nodes[name])
+		
+		pool = context.pool #Pool is a singleton - on first creation it instantiates all existing nodes
+		if(name!=None and context.nodes.has_key(name)):
+			return(context.nodes[name])
 		
-		if(name!=None and cls._instances.has_key(name)):
-			return(cls._instances[name])
-			
 		if(name==None):  # a new node, lets find a name
-			for i in itertools.count(0):
-				name = "node%.4d"%i
-				if(cls._instances.has_key(name)): continue# new nodes might not been saved, yet
-				if(path.exists("./nodes/"+name)): continue
-				break
-					
+			name = pool.reserve_names(1)[0]
 		
 		self = object.__new__(cls)
-		cls._instances[name] = self
+		context.nodes[name] = self
 
 		#actuall init-code
-		from ZIBMolPy.pool import Pool #avoids circular imports
-		self._pool = Pool() #Pool is a singleton
+		self._pool = pool
 		self._name = name
 		self._tmp = Store() #for thing that need to be stored temporarly
 		self._obs = Store()
+		self._summary = None # summary from the pool-index, used while the descriptor is not loaded
+		self._desc_mtime = None # mtimes of the files at the time they were loaded
+		self._obs_mtime = None
+		self._desc_digest = None # digests of the files' content at the time they were loaded or saved
+		self._obs_digest = None
+		self._loaded = True
+		self._obs_loaded = True
 		self.parent = None
 
 		if(path.exists(self.dir)):
-			self.reload()
+			# descriptor and observables are loaded on demand
+			self._make_lazy(self._pool.index_summary(self))
 		
 		#self.pool.append(self) #register with pool
 		return(self)
 	
 	#---------------------------------------------------------------------------
+	def __setattr__(self, name, value):
+		if(name[0] != '_' and not self._loaded):
+			self._load(self._load_desc) # otherwise loading would overwrite the new value later on
+		object.__setattr__(self, name, value)
+		if(name[0] != '_'): # persistent attribute changed - query results might have changed
+			self._pool._invalidate_caches() #pylint: disable=W0212
+	
+	def __getattr__(self, name):
+		# only called, when the attribute was not found in the usual places
+		if(name[0] != '_' and not self.__dict__.get("_loaded", True)):
+			self._load(self._load_desc)
+			return(getattr(self, name))
+		raise(AttributeError("'Node' object has no attribute '%s'"%name))
+	
+	#---------------------------------------------------------------------------
+	def _make_lazy(self, summary=None):
+		""" Drops all persistent data of the node, so that it gets loaded on next access.
+		Until then, the attributes contained in the given summary from the pool-index are used. """
+		from ZIBMolPy.pool_index import SUMMARY_ATTRS
+		for k in [k for k in self.__dict__.keys() if k[0] != '_']:
+			del(self.__dict__[k])
+		self._obs.clear()
+		self._desc_digest = None
+		self._obs_digest = None
+		self._summary = summary
+		self._loaded = False
+		self._obs_loaded = False
+		self._mtime = time.time() - 1
+		if(summary == None):
+			return
+		
+		for a in SUMMARY_ATTRS:
+			if(summary[a] != None):
+				self.__dict__[a] = summary[a]
+		if(isinstance(self.__dict__.get("state"), unicode)):
+			self.__dict__["state"] = str(self.state)
+		self.__dict__["parent"] = None
+		if(summary["parent"] != None):
+			self.__dict__["parent"] = Node(str(summary["parent"]), self._pool.context)
+		if(summary["obs_complete"]):
+			self._obs.update(dict([ (str(k), v) for (k,v) in summary["obs"].items() ]))
+			self._obs_loaded = True
+			self._obs_mtime = summary["obs_mtime"]
+			if(self._obs_mtime != None): # observables-file holds exactly these values
+				self._obs_digest = desc.digest(desc.encode_desc(dict(self._obs)))
+	
+	#---------------------------------------------------------------------------
+	@property
+	def is_loaded(self):
+		""" Returns true when the descriptor was read - otherwise attributes are loaded on demand """
+		return(self._loaded)
+	
 	@property
 	def obs(self):
+		if(not self._obs_loaded):
+			self._load(self._load_obs)
 		return(self._obs)
 	
 	@property
@@ -96,68 +237,155 @@ class Node(object):
 	#---------------------------------------------------------------------------
 	@property
 	def dir(self):
-		return("nodes/"+self.name)
+		return(self._pool.context.path("nodes", self.name))
 	
 	@property
 	def filename(self):
+		return(self.dir+"/"+self.name+"_desc.bin")
+	
+	@property
+	def legacy_filename(self):
+		""" text-based descriptor used up to pool format version 2 """
 		return(self.dir+"/"+self.name+"_desc.txt")
 	
 	#---------------------------------------------------------------------------
-	def reload(self):
-		#pylint: disable=W0612
+	def _load_namespace(self):
+		""" Names needed to restore the persistent node data """
+		import datetime
+		from ZIBMolPy.restraint import DihedralRestraint, DistanceRestraint
+		from ZIBMolPy.internals import Converter, DihedralCoordinate, LinearCoordinate
+		
+		context = self.pool.context
+		def converter(int_fn=None, coord_list=None):
+			# sharing the pool's instance avoids parsing the int-file for every node
+			if(int_fn != None and int_fn == getattr(self.pool, "int_fn", None)):
+				return(self.pool.converter)
+			return(Converter(int_fn, coord_list, root_dir=context.root_dir))
 		
+		def node(name=None):
+			return(Node(name, context))
+			
+		return({"array": np.array, "float32": np.float32, "float64": np.float64,
+			"datetime": datetime, "Node": node, "InternalArray": InternalArray, 
+			"Converter": converter, "DihedralCoordinate": DihedralCoordinate, 
+			"LinearCoordinate": LinearCoordinate, "DihedralRestraint": DihedralRestraint, 
+			"DistanceRestraint": DistanceRestraint})
+	
+	#---------------------------------------------------------------------------
+	def reload(self):
+		""" Loads the descriptor and the observables - files which did not change since their last loading are skipped. """
+		self._load(self._load_desc)
+		self._load(self._load_obs)
+	
+	def _load(self, loader):
 		#avoiding race-condition and respecting time-resoultion of 1s 
 		t = time.time() - 1
 		try:
-			from numpy import array, float32, float64
-			from ZIBMolPy.restraint import DihedralRestraint, DistanceRestraint
-			from ZIBMolPy.internals import Converter
-			f = open(self.filename)
-			text = f.read()
-			raw_persistent = eval(text)
-			self.__dict__.update(raw_persistent)					
-			if(path.exists(self.observables_fn)):
-				raw_obs = eval(open(self.observables_fn).read())
-				self.obs.update(raw_obs)
-			
-			self._mtime = t
+			with self._pool.context.lock: # nodes might be loaded from several threads
+				loader(self._load_namespace())
 		except:			
 			traceback.print_exc()
 			raise(Exception("Could not parse: "+self.filename))
-			
+		self._mtime = t
+		self.pool._invalidate_caches() #pylint: disable=W0212
+	
+	def _load_desc(self, namespace):
+		fn = self.filename
+		if(not path.exists(fn)):
+			fn = self.legacy_filename
+		mtime = path.getmtime(fn)
+		if(self._loaded and mtime == self._desc_mtime):
+			return
+		if(fn == self.filename):
+			(raw_persistent, self._desc_digest) = desc.load_desc(fn, namespace)
+		else:
+			raw_persistent = eval(open(fn).read(), namespace)
+			self._desc_digest = None
+		self.__dict__.update(raw_persistent)
+		self._desc_mtime = mtime
+		self._summary = None
+		self._loaded = True
+	
+	def _load_obs(self, namespace):
+		for fn in (self.observables_fn, self.legacy_observables_fn):
+			if(not path.exists(fn)):
+				continue
+			mtime = path.getmtime(fn)
+			if(self._obs_loaded and mtime == self._obs_mtime):
+				return
+			if(fn == self.observables_fn):
+				(raw_obs, self._obs_digest) = desc.load_desc(fn, namespace)
+				self._obs.update(raw_obs)
+			else:
+				self._obs.update(eval(open(fn).read(), namespace))
+				self._obs_digest = None
+			self._obs_mtime = mtime
+			break
+		self._obs_loaded = True
+	
 	#---------------------------------------------------------------------------			
-	def save(self):
-		""" Save node to it's files (node0042_desc.txt and observables.txt) """
+	def save(self, update_index=True, fsync_dir=True):
+		""" Save node to it's files (node0042_desc.bin and node0042_observables.bin)
+		
+		Files, whose content did not change since they were loaded or saved, are not rewritten.
+		Parts of lazy nodes, which were never loaded, can not have changed either.
+		@param update_index: whether to update the pool-index, see L{NodeList.save_all<ZIBMolPy.pool.NodeList.save_all>}
+		@param fsync_dir: whether to fsync the node's directory after writing
+		@return: True if any file was written
+		"""
 		#observables are save to a different file - so zgf_cleanup can remove them when updated
 		if(not path.exists(self.dir)):
 			os.makedirs(self.dir)
 		else:
 			assert(self.owns_lock)
-			
-		#save persistent node data
-		persistent = dict([ (k,v) for k,v in self.__dict__.items() if k[0]!='_' ])
-		split_temp = (self.filename).rsplit(".")
-		name_temp = split_temp[0] + "temp" + split_temp[1]
-		f = open(name_temp, "w")
-		#f = open(self.filename, "w")
-		f.write(utils.pformat(persistent)+"\n")
-		f.close()
-		os.rename(name_temp,self.filename)
+			# files in the old format get converted, hence they have to be loaded
+			if(not self._loaded and not path.exists(self.filename)):
+				self._load(self._load_desc)
+			if(not self._obs_loaded and path.exists(self.legacy_observables_fn)):
+				self._load(self._load_obs)
+		
+		written = False
+		#save persistent node data - write_atomic replaces the file atomically
+		if(self._loaded):
+			persistent = dict([ (k,v) for k,v in self.__dict__.items() if k[0]!='_' ])
+			content = desc.encode_desc(persistent)
+			if(desc.digest(content) != self._desc_digest or not path.exists(self.filename)):
+				utils.write_atomic(self.filename, content, fsync_dir)
+				self._desc_digest = desc.digest(content)
+				self._mtime = path.getmtime(self.filename)
+				self._desc_mtime = self._mtime
+				written = True
 		
 		# save observables, if there are any
-		if(len(self.obs) > 0):
-			f = open(self.observables_fn, "w")
-			f.write(utils.pformat(self.obs)+"\n")
-			f.close()
+		if(self._obs_loaded and len(self._obs) > 0):
+			content = desc.encode_desc(dict(self._obs))
+			if(desc.digest(content) != self._obs_digest or not path.exists(self.observables_fn)):
+				utils.write_atomic(self.observables_fn, content, fsync_dir)
+				self._obs_digest = desc.digest(content)
+				self._obs_mtime = path.getmtime(self.observables_fn)
+				written = True
+		
+		# files in the old format are superseded now
+		for fn in (self.legacy_filename, self.legacy_observables_fn):
+			if(path.exists(fn)):
+				os.remove(fn)
 		
-		self._mtime = path.getmtime(self.filename)
+		if(not written):
+			return(False)
+		
+		self.pool._invalidate_caches() #pylint: disable=W0212
+		if(not self._loaded):
+			self._load(self._load_desc) # the pool-index needs the full descriptor
+		if(update_index):
+			self.pool.index.update([self])
+		return(True)
 	
 	#---------------------------------------------------------------------------
 	def __str__(self):
 		return("<Node %s>"%self.name)
 	
 	def __eq__(self, other): #used e.g. in NodeList.append
-		return( isinstance(other, type(self)) and other.name == self.name )
+		return( isinstance(other, type(self)) and other.name == self.name and other._pool is self._pool )
 		
 	def	__hash__(self):
 		return(hash(self.name))
@@ -173,6 +401,10 @@ class Node(object):
 	#---------------------------------------------------------------------------
 	@property
 	def observables_fn(self):
+		return(self.dir+"/"+self.name+"_observables.bin")
+	
+	@property
+	def legacy_observables_fn(self):
 		return(self.dir+"/"+self.name+"_observables.txt")
 	
 	@property
@@ -187,41 +419,100 @@ class Node(object):
 	@property
 	def owns_lock(self):
 		""" Returns true when I have got the lock """
-		return(path.exists(self.lock_fn) and open(self.lock_fn).read() == my_lock_signature())
+		try:
+			(pid, host, _) = read_lock(self.lock_fn)
+		except (IOError, ValueError):
+			return(False)
+		return("%s %s"%(pid, host) == my_lock_signature())
 	
 	@property
 	def is_lock_valid(self):
-		""" Tests if the process which holds the lock still exists """	
-		lock_signature = open(self.lock_fn).read()
-		(pid, host) = lock_signature.split()
-			
-		if(host !=  socket.getfqdn()):
-			cmd = ["ssh", "-o", "UserKnownHostsFile=/dev/null", "-o", "StrictHostKeyChecking=no", host, "test", "-x", "/proc/"+pid]
-			return( subprocess.call(cmd) == 0 )
+		""" Tests if the lease of the lock has not yet expired.
 		
-		return(path.exists("/proc/"+pid)) # linux-way to check if a pid exists :-)
+		Old-style locks without expiry are checked via the pid of their owner,
+		for remote hosts this requires a ssh-call - see also L{NodeList.stale_locks}.
+		"""
+		(pid, host, expiry) = read_lock(self.lock_fn)
+		if(expiry != None):
+			return(time.time() < expiry)
+		return(pid in probe_pids(host, [pid]))
+
+
+	def _write_lock(self, fn):
+		f = open(fn, "w")
+		f.write("%s %.0f"%(my_lock_signature(), time.time()+LOCK_LEASE))
+		f.close()
 
 
-	def lock(self, guardtime=1):
+	def lock(self, guardtime=None):
+		""" Tries to acquire the lock atomically - also on NFS.
+		
+		The signature is written to a unique temporary file, which is then 
+		hard-linked to the lock-file. Since link() might report a failure 
+		on NFS although it succeeded, the link count is checked instead. 
+		On success the lease of the lock is renewed by the L{LockHeartbeat}.
+		Raises an exception if the filesystem does not support hard links.
+		@param guardtime: ignored, kept for backward compatibility
+		"""
+		#pylint: disable=W0613
 		if(path.exists(self.lock_fn)):
 			return(False)
-		f = open(self.lock_fn, "w")
-		f.write(my_lock_signature())
-		f.close()
-		if(guardtime > 0):
-			print("Waiting for Node-lock...")
-			time.sleep(guardtime)
-		return(self.owns_lock)
+		tmp_fn = "%s/.lock.%s.%d"%(self.dir, socket.gethostname(), os.getpid())
+		self._write_lock(tmp_fn)
+		try:
+			os.link(tmp_fn, self.lock_fn)
+		except OSError, e:
+			# on NFS the link might have succeeded nevertheless, checked below
+			if(e.errno != errno.EEXIST and os.stat(tmp_fn).st_nlink != 2):
+				os.remove(tmp_fn)
+				raise(Exception("Could not lock %s - the filesystem has to support hard links: %s"%(self.name, e)))
+		success = (os.stat(tmp_fn).st_nlink == 2)
+		os.remove(tmp_fn)
+		if(success):
+			LockHeartbeat().add(self)
+		return(success)
+
+
+	def renew_lock(self):
+		""" Extends the lease of the lock - called by the L{LockHeartbeat}.
+		
+		Others may take the lock only after its lease expired. Hence the lease is 
+		renewed only while a safe margin is left, otherwise the rename could replace 
+		the lock of a new owner. A lost lease is given up and reported.
+		"""
+		try:
+			(pid, host, expiry) = read_lock(self.lock_fn)
+		except (IOError, ValueError):
+			(pid, host, expiry) = (None, None, None)
+		if("%s %s"%(pid, host) != my_lock_signature()):
+			self._lease_lost("it was taken over or removed")
+			return
+		if(expiry != None and expiry - time.time() < LOCK_LEASE/6.0):
+			self._lease_lost("its lease expired")
+			return
+		
+		tmp_fn = "%s/.lock.%s.%d"%(self.dir, socket.gethostname(), os.getpid())
+		self._write_lock(tmp_fn)
+		os.rename(tmp_fn, self.lock_fn)
+		if(not self.owns_lock):
+			self._lease_lost("it was taken over while renewing")
+
+
+	def _lease_lost(self, reason):
+		if(LockHeartbeat().remove(self)): # not yet unlocked meanwhile
+			print("Warning: lost lock of %s - %s."%(self.name, reason))
+
 	
 	def unlock(self):
 		assert(self.owns_lock)
+		LockHeartbeat().remove(self)
 		os.remove(self.lock_fn)
 	
 	
 	#---------------------------------------------------------------------------
 	@property
 	def children(self):
-		return(self.pool.where("parent!=None and parent.name=='%s'"%self.name))
+		return(self.pool.children_of(self))
 	
 	@property
 	def tpr_fn(self):
@@ -231,6 +522,10 @@ class Node(object):
 	def trr_fn(self):
 		return(self.dir+"/"+self.name+".trr")
 	
+	@property
+	def internals_cache_fn(self):
+		return(self.dir+"/"+self.name+"_internals.npz")
+	
 	@property
 	def mdp_fn(self):
 		return(self.dir+"/"+self.name+".mdp")
@@ -273,10 +568,14 @@ class Node(object):
 
 	@property
 	def has_restraints(self):
+		if(not self._loaded and self._summary != None):
+			return(self._summary["n_restraints"] > 0)
 		return(hasattr(self, "restraints") and len(self.restraints)>0)
 
 	@property
 	def has_internals(self):
+		if(not self._loaded and self._summary != None):
+			return(bool(self._summary["has_internals"]))
 		return(hasattr(self, "internals"))
 	
 	@property
@@ -289,20 +588,28 @@ class Node(object):
 		
 	
 	def read_trajectory(self):
+		return(self._trajectory_entry().trajectory)
+	
+	def _trajectory_entry(self):
 		if(not path.exists(self.trr_fn)):
 			raise(Exception("%s not found."%self.trr_fn))
 		
-		if(self.__dict__.has_key("_trajectory_cache") and self.__dict__["_trajectory_cache_time"] >= path.getmtime(self.trr_fn)):
+		cache = TrajectoryCache()
+		trr_mtime = path.getmtime(self.trr_fn)
+		entry = cache.get(self, trr_mtime)
+		if(entry != None):
 			#print "Using trajectory cache."
-			return(self._trajectory_cache)
+			return(entry)
 		
-		# using print for newline, so that converter warnings are more readable
-		#sys.stdout.write("Loading trr-file: %s... "%self.trr_fn)
-		#sys.stdout.flush()
-		print("Loading trr-file: %s... "%self.trr_fn)
-		frames_int = self.pool.converter.read_trajectory(self.trr_fn)
-		print("done.")
-								
+		frames_int = self.read_internals()
+		(phi_values, penalty_potential, frameweights) = self._frameweights(frames_int)
+		trajectory = InternalArray(frames_int.converter, frames_int.array, frameweights)
+		entry = TrajectoryCacheEntry(self, trajectory, phi_values, penalty_potential, trr_mtime)
+		cache.put(entry)
+		return(entry)
+	
+	def _frameweights(self, frames_int):
+		""" @return: (phi_values, penalty_potential, frameweights) of the given frames """
 		if(self.has_internals and self.has_restraints):
 			phi_values = get_phi(frames_int, self)
 			penalty_potential = np.zeros(frames_int.n_frames)
@@ -316,23 +623,134 @@ class Node(object):
 			phi_values = np.zeros(frames_int.n_frames)
 			penalty_potential = np.zeros(frames_int.n_frames)
 			frameweights = np.ones(frames_int.n_frames)
+		return(phi_values, penalty_potential, frameweights)
+	
+	def iter_trajectory(self, chunk_size=10000):
+		""" Yields the trajectory with frameweights in chunks of at most chunk_size frames.
 		
-		trajectory = InternalArray(frames_int.converter, frames_int.array, frameweights)
-		self.__dict__["_phi_values_cache"] = phi_values
-		self.__dict__["_penalty_potential_cache"] = penalty_potential
-		self.__dict__["_trajectory_cache"] = trajectory
-		self.__dict__["_trajectory_cache_time"] = path.getmtime(self.trr_fn)
-		return(self._trajectory_cache)
+		Unless the trajectory is cached - in memory or in the on-disk internals cache - 
+		it is streamed from the trr-file without ever being in memory as a whole.
+		@return: generator of L{InternalArray}s
+		"""
+		if(not path.exists(self.trr_fn)):
+			raise(Exception("%s not found."%self.trr_fn))
+		
+		entry = TrajectoryCache().get(self, path.getmtime(self.trr_fn))
+		if(entry != None):
+			chunks = [entry.trajectory]
+		else:
+			frames_int = self._read_internals_cache()
+			if(frames_int != None):
+				chunks = [frames_int]
+			else:
+				chunks = self.pool.converter.iter_trajectory(self.trr_fn, chunk_size)
+		
+		for chunk in chunks:
+			for start in range(0, chunk.n_frames, chunk_size):
+				array = chunk.array[start:start+chunk_size]
+				if(chunk.has_frameweights):
+					frameweights = chunk.frameweights[start:start+chunk_size]
+				else:
+					frameweights = self._frameweights(InternalArray(chunk.converter, array))[2]
+				yield( InternalArray(chunk.converter, array, frameweights) )
+	
+	#---------------------------------------------------------------------------
+	def read_internals(self):
+		""" Returns the trajectory converted into internal coordinates (without frameweights).
+		
+		The on-disk internals cache is used, if it is up-to-date. If frames were appended to the
+		trr-file since the cache was written (e.g. by an extension in zgf_mdrun), only the new frames
+		are read and the cache is extended. """
+		converter = self.pool.converter
+		cached = self._load_internals_cache()
+		if(cached != None and cached[1] == path.getsize(self.trr_fn)):
+			return(InternalArray(converter, cached[0]))
+		
+		trr_size = path.getsize(self.trr_fn)
+		# using print for newline, so that converter warnings are more readable
+		#sys.stdout.write("Loading trr-file: %s... "%self.trr_fn)
+		#sys.stdout.flush()
+		if(cached != None):
+			(old_array, old_size) = cached
+			print("Loading new frames of trr-file: %s... "%self.trr_fn)
+			new_frames = converter.iter_trajectory(self.trr_fn, chunk_size=None, start=old_size, end=trr_size).next()
+			frames_int = InternalArray(converter, np.row_stack([old_array, new_frames.array]))
+		else:
+			print("Loading trr-file: %s... "%self.trr_fn)
+			frames_int = converter.iter_trajectory(self.trr_fn, chunk_size=None, end=trr_size).next()
+		print("done.")
+		self._write_internals_cache(frames_int, trr_size)
+		return(frames_int)
+	
+	def _read_internals_cache(self):
+		""" @return: the internals from the on-disk cache or None, if it is missing or outdated """
+		cached = self._load_internals_cache()
+		if(cached == None or cached[1] != path.getsize(self.trr_fn)):
+			return(None)
+		return(InternalArray(self.pool.converter, cached[0]))
+	
+	def _load_internals_cache(self):
+		""" Loads the on-disk internals cache, if it was created with the current int-file 
+		from a prefix of the current trr-file. 
+		@return: tuple (array, size of the trr-file it was created from) or None """
+		converter = self.pool.converter
+		cache_fn = self.internals_cache_fn
+		if(not path.exists(cache_fn) or converter.filename == None):
+			return(None)
+		cache_mtime = path.getmtime(cache_fn)
+		if(cache_mtime < path.getmtime(self.pool.context.path(converter.filename))):
+			return(None)
+		data = np.load(cache_fn)
+		try:
+			if(str(data["int_fn"]) != converter.filename):
+				return(None)
+			if("trr_size" not in data.files): # written by an older version
+				if(cache_mtime < path.getmtime(self.trr_fn)):
+					return(None)
+				return(data["array"], path.getsize(self.trr_fn))
+			trr_size = int(data["trr_size"])
+			if(trr_size > path.getsize(self.trr_fn) or str(data["trr_tail"]) != self._trr_tail(trr_size)):
+				return(None) # trr-file was rewritten
+			return(data["array"], trr_size)
+		finally:
+			data.close()
+	
+	def _trr_tail(self, trr_size):
+		""" Fingerprint of the last bytes before trr_size - detects, whether the trr-file was rewritten """
+		f = open(self.trr_fn, "rb")
+		f.seek(max(0, trr_size-1024))
+		tail = f.read(min(1024, trr_size))
+		f.close()
+		return(desc.digest(tail))
+	
+	def spill_internals(self, frames_int):
+		""" Writes the internals of the trajectory to the on-disk internals cache. """
+		if(not path.exists(self.trr_fn)):
+			return # cache could not be validated later on
+		cached = self._load_internals_cache()
+		if(cached != None and cached[1] == path.getsize(self.trr_fn)):
+			return # already up-to-date
+		self._write_internals_cache(frames_int, path.getsize(self.trr_fn))
+	
+	def _write_internals_cache(self, frames_int, trr_size):
+		converter = frames_int.converter
+		if(converter.filename == None):
+			return # cache could not be validated later on
+		cache_fn = self.internals_cache_fn
+		tmp_fn = self.dir+"/.internals_cache_tmp%d.npz"%os.getpid()
+		np.savez(tmp_fn, array=frames_int.array, int_fn=converter.filename, 
+			trr_size=trr_size, trr_tail=self._trr_tail(trr_size))
+		os.rename(tmp_fn, cache_fn)
+		utils.register_file_dependency(cache_fn, self.trr_fn)
+		utils.register_file_dependency(cache_fn, self.pool.context.path(converter.filename))
 	
 	@property
 	def penalty_potential(self):
-		self.read_trajectory()
-		return(self._penalty_potential_cache)
+		return(self._trajectory_entry().penalty_potential)
 	
 	@property
 	def phi_values(self):
-		self.read_trajectory()
-		return(self._phi_values_cache)
+		return(self._trajectory_entry().phi_values)
 	
 	@property
 	def frameweights(self):
@@ -358,5 +776,9 @@ class Node(object):
 		"""Indicates that this node is finished with sampling""" 
 		return self.state in ("converged", "not-converged", "refined", "ready")
 	
+#===============================================================================
+# evicted trajectories are kept in the on-disk internals cache
+TrajectoryCache().eviction_hooks.append(lambda node, entry: node.spill_internals(entry.trajectory))
+
 #===============================================================================
 #EOF
@@ -103,6 +103,40 @@ def get_phi_denom(x, nodes):
 	return( np.sum( get_phi_num(x, node) for node in nodes) )
 
 
+#===============================================================================
+def get_phi_log_denom(x, nodes):
+	r""" Calculates the logarithm of the denominator $\ln \sum_i \chi_i(\vec x)$ of the phi-function.
+	
+	Unlike L{get_phi_denom} this is stable, since the maximum exponent $m$ is factored out as described above.
+	@type x: L{InternalArray}
+	@param nodes: these are sumed over
+	@type nodes: list of L{Node} objects
+	@rtype: 1D numpy.ndarray of length x.n_frames	
+	"""
+	exponents = [ -node.pool.alpha*( (x - node.internals).norm2() ) for node in nodes ]
+	m = np.max(exponents, axis=0)
+	return( m + np.log(np.sum(np.exp(exponents - m), axis=0)) )
+
+
+#===============================================================================
+def get_phi_matrix(x, nodes, denom_nodes=None, log_denom=None):
+	r""" Calculates the phi-functions of all given nodes at the positions given by x at once.
+	
+	The phi-functions are evaluated as stable softmax $\exp(-\alpha \operatorname{dist}^2(\vec x, \vec q_i) - \ln \sum_j \chi_j(\vec x))$.
+	Hence, the denominator is computed only once instead of once per node as in L{get_phi}.
+	@type x: L{InternalArray}
+	@type nodes: list of L{Node} objects
+	@param denom_nodes: nodes of the denominator, default are the nodes which belong to the partition
+	@param log_denom: result of L{get_phi_log_denom}(x, denom_nodes), if already at hand
+	@rtype: 2D numpy.ndarray of shape (x.n_frames, len(nodes))
+	"""
+	if(log_denom is None):
+		if(denom_nodes == None):
+			denom_nodes = nodes[0].pool.where("isa_partition")
+		log_denom = get_phi_log_denom(x, denom_nodes)
+	return( np.column_stack([ np.exp(-node.pool.alpha*( (x - node.internals).norm2() ) - log_denom) for node in nodes ]) )
+
+
 #===============================================================================
 def get_phi_potential(x, node_i):
 	r""" Calculates $-\beta^{-1} \log \phi_i(\vec x)$, 
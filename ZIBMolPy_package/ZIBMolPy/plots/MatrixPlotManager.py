@@ -3,6 +3,7 @@
 import gtk
 import numpy as np
 from os import path
+from glob import glob
 
 #===============================================================================
 class MatrixPlotManager(object):
@@ -23,6 +24,15 @@ class MatrixPlotManager(object):
 			setattr(self, "rb_show_"+x, rb)
 			rb.connect("toggled", self.update)
 			panel.pack_start(rb, expand=False)
+		# chi and Qc matrices of the cluster-count sweep of zgf_analyze, 0 means the chosen clustering
+		sweep_panel = gtk.HBox()
+		sweep_panel.pack_start(gtk.Label("sweep clusters"), expand=False)
+		self.spin_sweep = gtk.SpinButton()
+		self.spin_sweep.set_range(0, 0)
+		self.spin_sweep.set_increments(1, 1)
+		self.spin_sweep.connect("value-changed", self.update)
+		sweep_panel.pack_start(self.spin_sweep, expand=False)
+		panel.pack_start(sweep_panel, expand=False)
 		return(panel)
 
 	def begin_session(self):
@@ -34,14 +44,24 @@ class MatrixPlotManager(object):
 
 	def update(self, dummy=None):
 		self.board.canvas.figure.clear()
+		pool = self.board.pool
+		sweep_ks = [ int(path.basename(fn)[len("chi_mat_k"):-len(".npz")]) for fn in glob(pool.analysis_dir+"chi_mat_k[0-9][0-9].npz") ]
+		self.spin_sweep.set_range(0, max([0]+sweep_ks))
+		k = int(self.spin_sweep.get_value())
 		if(self.rb_show_s_matrix.get_active()):
 			self.plot_matrix(self.board.pool.s_mat_fn, "S matrix")
 		elif(self.rb_show_s_matrix_corrected.get_active()):
 			self.plot_matrix(self.board.pool.s_corr_mat_fn, "S matrix (corrected)")
 		elif(self.rb_show_chi_matrix.get_active()):
-			self.plot_matrix(self.board.pool.chi_mat_fn, "Chi matrix")
+			if(k > 0):
+				self.plot_matrix(pool.chi_mat_k_fn(k), "Chi matrix (sweep, %d clusters)"%k)
+			else:
+				self.plot_matrix(self.board.pool.chi_mat_fn, "Chi matrix")
 		elif(self.rb_show_qc_matrix.get_active()):
-			self.plot_matrix(self.board.pool.qc_mat_fn, "Qc matrix")
+			if(k > 0):
+				self.plot_matrix(pool.qc_mat_k_fn(k), "Qc matrix (sweep, %d clusters)"%k)
+			else:
+				self.plot_matrix(self.board.pool.qc_mat_fn, "Qc matrix")
 		elif(self.rb_show_pc_matrix.get_active()):
 			self.plot_matrix(self.board.pool.pc_mat_fn, "Pc matrix")
 		elif(self.rb_show_pc_matrix.get_active()):
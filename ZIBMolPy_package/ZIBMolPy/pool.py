@@ -5,14 +5,81 @@ import numpy as np
 from os import path
 from glob import glob
 import traceback
-from ZIBMolPy.node import Node
-from ZIBMolPy import utils
+import os
+import re
 import time
+from ZIBMolPy.node import Node, read_lock, probe_pids
+from ZIBMolPy.pool_index import PoolIndex
+from ZIBMolPy.pool_context import PoolContext
+from ZIBMolPy import utils
+from ZIBMolPy.io import desc
 from ZIBMolPy.constants import BOLTZMANN, AVOGADRO
 
 # needed to eval pool-desc.txt
 import datetime #pylint: disable=W0611
 
+#===============================================================================
+class _Resolver(dict):
+	""" Maps the names used within a NodeList.where-query onto node attributes """
+	def __init__(self, node):
+		dict.__init__(self)
+		self.node = node
+	
+	def __getitem__(self, key):
+		if(key == "hasattr"): 
+			return( lambda x: hasattr(self.node, x) )
+		return(getattr(self.node, key))
+
+
+# compiled code objects of the query-strings passed to NodeList.where
+_query_cache = dict()
+
+def _compile_query(query):
+	if(not _query_cache.has_key(query)):
+		_query_cache[query] = compile(query, "<where>", "eval")
+	return(_query_cache[query])
+
+
+#===============================================================================
+# comparisons available for the structured predicates of NodeList.where
+PREDICATE_OPS = {
+	"eq": lambda a, b: a == b,
+	"ne": lambda a, b: a != b,
+	"in": lambda a, b: a in b,
+	"not_in": lambda a, b: a not in b,
+	"lt": lambda a, b: a < b,
+	"le": lambda a, b: a <= b,
+	"gt": lambda a, b: a > b,
+	"ge": lambda a, b: a >= b,
+	}
+
+def _compile_predicates(predicates):
+	compiled = []
+	for (key, value) in sorted(predicates.items()):
+		parts = key.split("__")
+		op = "eq"
+		if(len(parts) > 1 and PREDICATE_OPS.has_key(parts[-1])):
+			op = parts.pop()
+		compiled.append( (tuple(parts), op, value) )
+	return(compiled)
+
+def _check_predicate(node, attr_path, op, value):
+	obj = node
+	for attr in attr_path:
+		if(obj == None or not hasattr(obj, attr)):
+			return(False) # e.g. parent__name for the root-node
+		obj = getattr(obj, attr)
+	return( PREDICATE_OPS[op](obj, value) )
+
+
+# Results of queries, which refer to one of these names, depend on the 
+# filesystem or on mutable stores and must therefore not be memoized by the Pool.
+VOLATILE_NAMES = frozenset(["is_locked", "owns_lock", "is_lock_valid", 
+	"has_trajectory", "has_convergence_log", "has_reweighting_log", 
+	"has_mdrun_log", "trajectory", "frameweights", "phi_values", 
+	"penalty_potential", "mtime", "obs", "tmp", "hasattr"])
+
+
 #===============================================================================
 class NodeList(list):
 	def __init__(self, nodes=None):
@@ -23,27 +90,34 @@ class NodeList(list):
 	#---------------------------------------------------------------------------
 	@property
 	def internals(self):
-		arrays = [n.internals for n in self if hasattr(n, "internals")]
+		arrays = [n.internals for n in self if n.has_internals]
 		if(len(arrays) == 0):
 			return(None)
 		return( InternalArray.stack_frames(arrays) )
 	
 	
 	#---------------------------------------------------------------------------
-	def where(self, query):
-		""" very cool, smart query tool - runs a python-statement on every node """
-		class Resolver(dict):
-			def __init__(self, node):
-				dict.__init__(self)
-				self.node = node
-			
-			def __getitem__(self, key):
-				if(key == "hasattr"): 
-					return( lambda x: hasattr(self.node, x) )
-				return(getattr(self.node, key))
+	def where(self, query=None, **predicates):
+		""" very cool, smart query tool - runs a python-statement on every node
 		
-		matches = [ n for n in self if eval(query, Resolver(n)) ] 
-		return( NodeList(matches) )
+		The query-string is compiled only once and then evaluated for every node.
+		Additionally (or instead) structured predicates can be given as keywords,
+		e.g. C{where(state__in=('converged', 'refined'), isa_partition=True)}.
+		The part after the last double-underscore selects the comparison 
+		(see L{PREDICATE_OPS}), all other parts form an attribute path,
+		e.g. C{where(parent__name='node0000')}.
+		"""
+		return( NodeList(self._filter(query, predicates)) )
+	
+	#---------------------------------------------------------------------------
+	def _filter(self, query, predicates):
+		matches = list(self)
+		if(query != None):
+			code = _compile_query(query)
+			matches = [ n for n in matches if eval(code, _Resolver(n)) ]
+		for (attr_path, op, value) in _compile_predicates(predicates):
+			matches = [ n for n in matches if _check_predicate(n, attr_path, op, value) ]
+		return(matches)
 	
 	#---------------------------------------------------------------------------
 	def coord_range(self, coord, num=360, lin_slack=True):
@@ -59,8 +133,11 @@ class NodeList(list):
 			return( np.linspace(lower, upper, num=num) )
 
 		# considering presampling-trajectory and position of all nodes
-		values = self[0].pool.root.trajectory.getcoord(coord)
-		(lower, upper) = (min(values), max(values))
+		# the trajectory is streamed, it might be too large to be loaded as a whole
+		(lower, upper) = (np.inf, -np.inf)
+		for chunk in self[0].pool.root.iter_trajectory():
+			values = chunk.getcoord(coord)
+			(lower, upper) = (min(lower, np.min(values)), max(upper, np.max(values)))
 		
 		ints = self.internals # is None if no nodes besides root exist, yet
 		if(ints != None):
@@ -78,21 +155,52 @@ class NodeList(list):
 
 	#---------------------------------------------------------------------------
 	def multilock(self):
-		nodes_lockable = self.where("not is_locked")
-		for n in nodes_lockable:
-			n.lock(guardtime=0)
-			
-		if(len(nodes_lockable) > 0):
-			print("Waiting for Node-Multilock...")
-			time.sleep(1)
-			
-		return(self.where("owns_lock"))
+		""" Locks as many nodes as possible - returns the locked ones """
+		return( NodeList([n for n in self if n.lock() or n.owns_lock]) )
 
 	#---------------------------------------------------------------------------
 	def unlock(self):
 		for n in self:
 			n.unlock()
 
+	#---------------------------------------------------------------------------
+	def stale_locks(self):
+		""" Returns the locked nodes, whose lock is no longer valid.
+		
+		Leases are checked locally, old-style locks are checked with a single ssh-call per host.
+		"""
+		stale = NodeList()
+		legacy = dict() # host -> [(node, pid)]
+		for n in self:
+			try:
+				(pid, host, expiry) = read_lock(n.lock_fn)
+			except (IOError, OSError):
+				continue # not locked (anymore)
+			if(expiry == None):
+				legacy.setdefault(host, []).append((n, pid))
+			elif(time.time() >= expiry):
+				stale.append(n)
+		for (host, locks) in legacy.items():
+			alive = probe_pids(host, [pid for (n, pid) in locks])
+			stale.extend([n for (n, pid) in locks if pid not in alive])
+		return(stale)
+
+	#---------------------------------------------------------------------------
+	def save_all(self):
+		""" Saves all nodes, skipping the unchanged ones.
+		
+		The pool-index is updated within a single transaction and each touched
+		directory is fsynced only once, after all files were written.
+		@return: the nodes which were actually written
+		"""
+		written = NodeList([n for n in self if n.save(update_index=False, fsync_dir=False)])
+		if(len(written) == 0):
+			return(written)
+		for d in set([n.dir for n in written] + [written[0].pool.context.path("nodes")]):
+			utils.fsync_directory(d)
+		written[0].pool.index.update(written)
+		return(written)
+
 	#---------------------------------------------------------------------------
 	def append(self, n):
 		if(n not in self):
@@ -101,33 +209,44 @@ class NodeList(list):
 			
 #===============================================================================
 class Pool(NodeList):
-	FORMAT_VERSION = 2
+	FORMAT_VERSION = 3
 	
-	# Singleton-Pattern
-	_instance = None
+	# Singleton-Pattern - one instance per L{PoolContext}
+	def __new__(cls, context=None):
+		if(context == None):
+			context = PoolContext.default()
+		with context.lock:
+			if(context._pool != None): #pylint: disable=W0212
+				return(context._pool) #pylint: disable=W0212
+			self = NodeList.__new__(cls)
+			context._pool = self #pylint: disable=W0212
+			self._context = context
+			self._init()
+			return(self)
 	
-	def __new__(cls):
-		if(cls._instance != None):
-			return(cls._instance)
-			
-		self = NodeList.__new__(cls)
-		cls._instance = self
-			
+	def _init(self):
 		# actual init-code
 		NodeList.__init__(self)
 		self._mtime = -1 # very old
 		self._mtime_nodes = -1 # very old
 		self.history = []
+		self._digest = None # digest of pool-desc.txt's content at the time it was loaded or saved
 		self.format_version = self.FORMAT_VERSION
+		self._index = PoolIndex(self.index_fn)
+		self._index_rows = None
+		self._index_stale = []
+		self._converter_cache = None
+		self._by_name = dict()
+		self._max_reserved = -1
+		self._invalidate_caches()
 		
 		if(path.exists(self.filename)):
 			self.reload()
 			self.reload_nodes()
-		return(self)
 		
 	
 	#---------------------------------------------------------------------------
-	def __init__(self):
+	def __init__(self, context=None):
 		#because of singleton, we must not(!) call the super constructor
 		#pylint: disable=W0231
 		pass 
@@ -135,46 +254,160 @@ class Pool(NodeList):
 	#---------------------------------------------------------------------------
 	def reload(self):
 		try:
-			raw_persistent = eval(open(self.filename).read())
+			content = open(self.filename).read()
+			raw_persistent = eval(content)
 			self.__dict__.update(raw_persistent)
+			self._digest = desc.digest(content)
 			self._mtime = path.getmtime(self.filename)
 		except:
 			traceback.print_exc()
 			raise(Exception("Could not parse: "+self.filename))
-			
+		
+		self._invalidate_caches()
 		if(self.format_version > Pool.FORMAT_VERSION):
 			raise(Exception("Pool was created with newer version of ZIBMolPy - run zgf_upgrade."))
 			
 	#---------------------------------------------------------------------------
 	def reload_nodes(self):
-		if(not path.exists("./nodes/")):
+		with self.context.lock:
+			self._reload_nodes()
+	
+	def _reload_nodes(self):
+		nodes_dir = self.context.path("nodes")
+		if(not path.exists(nodes_dir)):
 			return
 			
-		self._mtime_nodes = path.getmtime("./nodes")
+		self._mtime_nodes = path.getmtime(nodes_dir)
+		self._index_rows = self.index.read_all()
 		
 		new_nodes = []
-		for node_dir in sorted(glob("./nodes/*")):
+		for node_dir in sorted(glob(nodes_dir+"/*")):
 			node_name = path.basename(node_dir)
-			if(not path.exists(node_dir+"/"+node_name+"_desc.txt")):
+			desc_fn = node_dir+"/"+node_name+"_desc"
+			if(not path.exists(desc_fn+".bin") and not path.exists(desc_fn+".txt")):
 				continue #ignoring not readily created nodes
-			found_node = None 
-			for n in self:
-				if(n.name == node_name):
-					found_node = n
-			
+			found_node = self.find(node_name)
 			if(found_node == None):
-				found_node = Node(node_name)
+				found_node = Node(node_name, self.context) # creates a lazy node
+			elif(not found_node.is_loaded):
+				found_node._make_lazy(self.index_summary(found_node)) #pylint: disable=W0212
 			new_nodes.append(found_node)
 		
 		self[:] = new_nodes
+		self._by_name = dict([ (n.name, n) for n in new_nodes ])
+		self._invalidate_caches()
+		
+		# refresh outdated summaries - this requires to load those nodes once
+		stale_nodes = list(set([n for n in self._index_stale if path.exists(n.filename)]))
+		self._index_stale = []
+		if(self.index.available):
+			for n in stale_nodes:
+				n.reload()
+			self.index.update(stale_nodes)
+
+	#---------------------------------------------------------------------------
+	def append(self, n):
+		if(not self._by_name.has_key(n.name)):
+			list.append(self, n)
+			self._by_name[n.name] = n
+		self._invalidate_caches()
+	
+	#---------------------------------------------------------------------------
+	def find(self, name):
+		""" Returns the node with the given name or None """
+		return(self._by_name.get(name))
+	
+	#---------------------------------------------------------------------------
+	def reserve_names(self, count):
+		""" Returns count new node names, which follow the highest node number in use. """
+		used = self.context.nodes.keys()
+		if(path.exists(self.context.path("nodes"))):
+			used += os.listdir(self.context.path("nodes"))
+		numbers = [ int(m.group(1)) for m in [re.match("node(\d+)$", u) for u in used] if m ]
+		first = max(numbers + [self._max_reserved]) + 1
+		self._max_reserved = first + count - 1
+		return([ "node%.4d"%i for i in range(first, first+count) ])
+	
+	#---------------------------------------------------------------------------
+	def create_nodes(self, count, **attrs):
+		""" Creates count new nodes, sets the given attributes on each of them and appends them to the pool.
+		
+		The nodes are not saved, yet - use L{NodeList.save_all}.
+		@return: the new nodes as L{NodeList}
+		"""
+		new_nodes = NodeList()
+		for name in self.reserve_names(count):
+			n = Node(name, self.context)
+			for (k, v) in attrs.items():
+				setattr(n, k, v)
+			list.append(new_nodes, n)
+			list.append(self, n)
+			self._by_name[name] = n
+		self._invalidate_caches()
+		return(new_nodes)
+
+	#---------------------------------------------------------------------------
+	def index_summary(self, node):
+		""" Returns the summary of the given node from the pool-index or None, if it is not up-to-date. """
+		if(self._index_rows == None):
+			self._index_rows = self.index.read_all()
+		summary = self._index_rows.get(node.name)
+		if(not PoolIndex.is_valid(summary, node)):
+			self._index_stale.append(node)
+			return(None)
+		return(summary)
+	
+	#---------------------------------------------------------------------------
+	def _invalidate_caches(self):
+		""" Drops all memoized query results - called whenever a node changes """
+		self._where_cache = dict()
+		self._children_cache = None
+		self._derived_cache = dict()
+	
+	def _memoized(self, key, func):
+		""" Returns func(), which is computed only once until the caches get invalidated """
+		if(not self._derived_cache.has_key(key)):
+			self._derived_cache[key] = func()
+		return(self._derived_cache[key])
+
+	#---------------------------------------------------------------------------
+	def where(self, query=None, **predicates):
+		""" Like L{NodeList.where}, but results are memoized until the pool or one of its nodes changes. """
+		key = (query, tuple(sorted(predicates.items())))
+		try:
+			cached = self._where_cache.get(key)
+		except TypeError: # unhashable predicate-value, e.g. a list
+			return( NodeList.where(self, query, **predicates) )
+		
+		if(cached == None):
+			cached = self._filter(query, predicates)
+			names = set([ a for k in predicates.keys() for a in k.split("__") ])
+			if(query != None):
+				names.update(_compile_query(query).co_names)
+			if(names.isdisjoint(VOLATILE_NAMES)):
+				self._where_cache[key] = cached
+		return( NodeList(cached) )
+	
+	#---------------------------------------------------------------------------
+	def children_of(self, node):
+		""" Returns the nodes whose parent is the given node. """
+		if(self._children_cache == None):
+			self._children_cache = dict()
+			for n in self:
+				if(n.parent != None):
+					self._children_cache.setdefault(n.parent.name, []).append(n)
+		return( NodeList(self._children_cache.get(node.name, [])) )
 
 	
 	#---------------------------------------------------------------------------
 	def save(self):
+		""" Writes pool-desc.txt atomically - unless its content did not change. """
 		persistent = dict([ (k,v) for k,v in self.__dict__.items() if k[0]!='_' ])
-		f = open(self.filename, "w")
-		f.write(utils.pformat(persistent)+"\n")
-		f.close()
+		content = utils.pformat(persistent)+"\n"
+		if(desc.digest(content) == self._digest and path.exists(self.filename)):
+			return
+		utils.write_atomic(self.filename, content)
+		self._digest = desc.digest(content)
 		self._mtime = path.getmtime(self.filename)
 	
 	
@@ -186,10 +419,23 @@ class Pool(NodeList):
 		return(self.__repr__())
 
 	#---------------------------------------------------------------------------
+	@property
+	def context(self):
+		""" The L{PoolContext} this pool belongs to """
+		return(self._context)
+	
 	@property
 	def filename(self):
-		return("pool-desc.txt")
+		return(self.context.path("pool-desc.txt"))
+	
+
+	@property
+	def index_fn(self):
+		return(self.context.path("pool-index.sqlite"))
 	
+	@property
+	def index(self):
+		return(self._index)
 
 	@property
 	def mtime(self):
@@ -201,28 +447,57 @@ class Pool(NodeList):
 	
 	#---------------------------------------------------------------------------
 	@property
-	def converter(self): #TODO maybe cache instance
-		if(hasattr(self, "int_fn")):
-			return(Converter(self.int_fn))
-		return(None)
+	def converter(self):
+		""" The Converter is parsed again only if the int-file was modified """
+		if(not hasattr(self, "int_fn")):
+			return(None)
+		key = (self.int_fn, path.getmtime(self.context.path(self.int_fn)))
+		if(self._converter_cache == None or self._converter_cache[0] != key):
+			self._converter_cache = (key, Converter(self.int_fn, root_dir=self.context.root_dir))
+		return(self._converter_cache[1])
 
 	#---------------------------------------------------------------------------
 	@property
 	def root(self):
-		for n in self:
-			if(n.name == self.root_name):
-				return(n)
-		return(None)
+		return(self.find(self.root_name))
+	
+	#---------------------------------------------------------------------------
+	@property
+	def partition(self):
+		""" The nodes which belong to the partitioning, see L{Node.isa_partition<ZIBMolPy.node.Node.isa_partition>} """
+		return(self.where("isa_partition"))
+	
+	@property
+	def internals(self):
+		return(self._memoized("internals", lambda: NodeList.internals.fget(self)))
+	
+	#---------------------------------------------------------------------------
+	def coord_range(self, coord, num=360, lin_slack=True):
+		# the range depends on the presampling-trajectory, which might get replaced
+		trr_mtime = None
+		if(path.exists(self.root.trr_fn)):
+			trr_mtime = path.getmtime(self.root.trr_fn)
+		key = ("coord_range", coord.index, num, lin_slack, trr_mtime)
+		values = self._memoized(key, lambda: NodeList.coord_range(self, coord, num, lin_slack))
+		return(values.copy())
 
 	#---------------------------------------------------------------------------
 	@property 
 	def analysis_dir(self):
-		return("./analysis/")
+		return(self.context.path("analysis")+"/")
 		
 	@property 
 	def s_mat_fn(self):	
 		return(self.analysis_dir+"s_mat.npz")
 		
+	@property 
+	def s_lags_mat_fn(self):	
+		return(self.analysis_dir+"s_mat_lags.npz")
+		
+	@property 
+	def s_approx_mat_fn(self):	
+		return(self.analysis_dir+"s_mat_approx.npz")
+		
 	@property
 	def s_corr_mat_fn(self): 
 		return(self.analysis_dir+"s_corr_mat.npz")
@@ -235,6 +510,39 @@ class Pool(NodeList):
 	def qc_mat_fn(self): 
 		return(self.analysis_dir+"qc_mat.npz")
 
+	# results of the approximate S matrix are kept apart - see option approx of L{zgf_analyze}
+	@property
+	def s_corr_approx_mat_fn(self): 
+		return(self.analysis_dir+"s_corr_mat_approx.npz")
+			
+	@property
+	def chi_approx_mat_fn(self): 
+		return(self.analysis_dir+"chi_mat_approx.npz")
+		
+	@property
+	def qc_approx_mat_fn(self): 
+		return(self.analysis_dir+"qc_mat_approx.npz")
+
+	def chi_mat_k_fn(self, n_clusters, approx=False): 
+		""" chi matrix for the given number of clusters, as stored by the sweep of L{zgf_analyze} """
+		return(self.analysis_dir+"chi_mat_k%02d%s.npz"%(n_clusters, "_approx" if(approx) else ""))
+
+	def qc_mat_k_fn(self, n_clusters, approx=False): 
+		""" Q_c matrix for the given number of clusters, as stored by the sweep of L{zgf_analyze} """
+		return(self.analysis_dir+"qc_mat_k%02d%s.npz"%(n_clusters, "_approx" if(approx) else ""))
+
+	@property
+	def qc_bootstrap_fn(self): 
+		return(self.analysis_dir+"qc_mat_bootstrap.npz")
+
+	@property
+	def phi_frames_fn(self): 
+		return(self.analysis_dir+"phi_frames.npz")
+
+	@property
+	def hist_cube_fn(self): 
+		return(self.analysis_dir+"hist_cube.npz")
+
 	@property
 	def pc_mat_fn(self): 
 		return(self.analysis_dir+"pc_mat.npz")
@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+
+"""
+Contexts, which bind a L{Pool<ZIBMolPy.pool.Pool>} and its nodes to a root directory.
+
+Each context owns its pool, its node registry and a lock, which serializes
+the loading of nodes. Hence several pools can be analyzed within one process
+and nodes can be loaded from background threads::
+
+	ctx = PoolContext("/data/pentane")
+	pool = ctx.pool            # same as Pool(ctx)
+	node = Node("node0042", ctx)
+
+The default context is used by C{Pool()} and C{Node(name)} - its paths are
+relative to the current working directory, just as they always were.
+"""
+
+import threading
+from os import path
+
+
+#===============================================================================
+class PoolContext(object):
+	_default = None
+
+	def __init__(self, root_dir=None):
+		"""
+		@param root_dir: directory of the pool, None means relative to the current working directory
+		"""
+		self.root_dir = ""
+		if(root_dir != None):
+			self.root_dir = path.abspath(root_dir)
+		self.nodes = dict() # node-name -> Node
+		self.lock = threading.RLock()
+		self._pool = None
+
+	#---------------------------------------------------------------------------
+	@classmethod
+	def default(cls):
+		""" Returns the context used by C{Pool()} and C{Node(name)} """
+		if(cls._default == None):
+			cls._default = cls()
+		return(cls._default)
+
+	#---------------------------------------------------------------------------
+	def __repr__(self):
+		return("PoolContext(%r)"%(self.root_dir or None))
+
+	#---------------------------------------------------------------------------
+	def path(self, *parts):
+		""" Returns the path of the given file within the pool - absolute unless this is the default context """
+		return(path.join(self.root_dir, *parts))
+
+	#---------------------------------------------------------------------------
+	@property
+	def pool(self):
+		from ZIBMolPy.pool import Pool #avoids circular imports
+		return(Pool(self))
+
+#===============================================================================
+#EOF
@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+
+"""
+Pool-wide index of node summaries (pool-index.sqlite).
+
+The index holds for every node the few attributes, which are needed by most
+tools and queries (state, parent, partition flag, extension counters and the
+scalar observables), along with the mtimes of the descriptor files they were
+taken from. This allows L{Pool<ZIBMolPy.pool.Pool>} to create lazy nodes, which
+read their full descriptor only on attribute access.
+
+The index is a pure cache: rows, whose mtimes do not match the files on disk,
+are ignored and rewritten. If sqlite3 is not available, no index is used.
+"""
+
+import json
+import threading
+from os import path
+
+try:
+	import sqlite3
+except ImportError:
+	sqlite3 = None
+
+SCHEMA_VERSION = 1
+
+# node attributes, which are stored in their own column
+SUMMARY_ATTRS = ("state", "extensions_counter", "extensions_max", "extensions_length", "sampling_length")
+
+SCALAR_TYPES = (bool, int, long, float, basestring)
+
+
+#===============================================================================
+class PoolIndex(object):
+	def __init__(self, filename):
+		self.filename = filename
+		self._conn = None
+		self._lock = threading.Lock() # the connection is shared by all threads
+
+	#---------------------------------------------------------------------------
+	@property
+	def available(self):
+		return(sqlite3 != None)
+
+	#---------------------------------------------------------------------------
+	def _connect(self):
+		if(self._conn == None):
+			self._conn = sqlite3.connect(self.filename, timeout=60, check_same_thread=False)
+			(version,) = self._conn.execute("PRAGMA user_version").fetchone()
+			if(version != SCHEMA_VERSION):
+				self._conn.execute("DROP TABLE IF EXISTS nodes")
+				columns = "".join([a+", " for a in SUMMARY_ATTRS])
+				self._conn.execute("CREATE TABLE nodes (name TEXT PRIMARY KEY, desc_mtime REAL, obs_mtime REAL, "
+					+ "parent TEXT, n_restraints INTEGER, has_internals INTEGER, "+columns+"obs TEXT, obs_complete INTEGER)")
+				self._conn.execute("PRAGMA user_version=%d"%SCHEMA_VERSION)
+				self._conn.commit()
+		return(self._conn)
+
+	#---------------------------------------------------------------------------
+	def read_all(self):
+		""" @return: dict which maps node names onto their summary (a dict) """
+		if(not self.available or not path.exists(self.filename)):
+			return(dict())
+		try:
+			with self._lock:
+				cursor = self._connect().execute("SELECT * FROM nodes")
+				columns = [d[0] for d in cursor.description]
+				rows = [ dict(zip(columns, r)) for r in cursor ]
+		except sqlite3.Error, e:
+			print("Warning: could not read %s: %s"%(self.filename, e))
+			return(dict())
+
+		for r in rows:
+			r["obs"] = json.loads(r["obs"])
+		return(dict([ (str(r["name"]), r) for r in rows ]))
+
+	#---------------------------------------------------------------------------
+	def update(self, nodes):
+		""" Rewrites the summaries of the given (fully loaded) nodes within a single transaction. """
+		if(not self.available or len(nodes) == 0):
+			return
+		rows = [ self._summarize(n) for n in nodes ]
+		columns = sorted(rows[0].keys())
+		sql = "INSERT OR REPLACE INTO nodes (%s) VALUES (%s)"%(", ".join(columns), ", ".join(["?"]*len(columns)))
+		with self._lock:
+			try:
+				conn = self._connect()
+				conn.executemany(sql, [ [r[c] for c in columns] for r in rows ])
+				conn.commit()
+			except sqlite3.Error, e:
+				print("Warning: could not update %s: %s"%(self.filename, e))
+				if(self._conn != None):
+					self._conn.rollback()
+
+	#---------------------------------------------------------------------------
+	@staticmethod
+	def _summarize(node):
+		attrs = node.__dict__
+		row = dict([ (a, attrs.get(a)) for a in SUMMARY_ATTRS ])
+		row["name"] = node.name
+		row["desc_mtime"] = path.getmtime(node.filename)
+		row["obs_mtime"] = None
+		if(path.exists(node.observables_fn)):
+			row["obs_mtime"] = path.getmtime(node.observables_fn)
+		row["parent"] = None
+		if(attrs.get("parent") != None):
+			row["parent"] = attrs["parent"].name
+		row["n_restraints"] = len(attrs.get("restraints", []))
+		row["has_internals"] = attrs.has_key("internals")
+		scalar_obs = dict([ (k,v) for (k,v) in node.obs.items() if isinstance(v, SCALAR_TYPES) ])
+		row["obs"] = json.dumps(scalar_obs, sort_keys=True)
+		row["obs_complete"] = (len(scalar_obs) == len(node.obs))
+		return(row)
+
+	#---------------------------------------------------------------------------
+	@staticmethod
+	def is_valid(summary, node):
+		""" Checks if the summary was taken from the current descriptor files of the node. """
+		if(summary == None or not path.exists(node.filename)):
+			return(False)
+		if(summary["desc_mtime"] != path.getmtime(node.filename)):
+			return(False)
+		if(path.exists(node.observables_fn)):
+			return(summary["obs_mtime"] == path.getmtime(node.observables_fn))
+		return(summary["obs_mtime"] == None)
+
+#===============================================================================
+#EOF
@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+
+"""
+Process-wide cache for the trajectories read by L{Node.read_trajectory<ZIBMolPy.node.Node.read_trajectory>}.
+
+The cache holds the trajectories of the most recently used nodes, until their
+total size exceeds the byte budget. The budget can be set via the environment
+variable ZGF_TRAJECTORY_CACHE_MB (default: 1024). Pinned nodes, e.g. the one
+selected in zgf_browser, are never evicted. Entries are keyed by the nodes
+themselves, so nodes of different L{PoolContext<ZIBMolPy.pool_context.PoolContext>}s
+do not collide. All methods are thread-safe.
+
+Before an entry is dropped, the eviction hooks are called with the node and
+the entry - by default L{Node.spill_internals<ZIBMolPy.node.Node.spill_internals>}
+is registered, which writes the internals to the node's on-disk cache.
+"""
+
+import os
+import threading
+import traceback
+from collections import OrderedDict
+
+DEFAULT_BUDGET_MB = 1024
+
+
+#===============================================================================
+class TrajectoryCacheEntry(object):
+	def __init__(self, node, trajectory, phi_values, penalty_potential, trr_mtime):
+		self.node = node
+		self.trajectory = trajectory
+		self.phi_values = phi_values
+		self.penalty_potential = penalty_potential
+		self.trr_mtime = trr_mtime
+
+	@property
+	def nbytes(self):
+		arrays = [self.trajectory.array, self.trajectory.frameweights, self.phi_values, self.penalty_potential]
+		return( sum([a.nbytes for a in arrays if a is not None]) )
+
+
+#===============================================================================
+class TrajectoryCache(object):
+	# Singleton-Pattern
+	_instance = None
+
+	def __new__(cls):
+		if(cls._instance != None):
+			return(cls._instance)
+
+		self = object.__new__(cls)
+		cls._instance = self
+
+		# actual init-code
+		self.budget = int(os.environ.get("ZGF_TRAJECTORY_CACHE_MB", DEFAULT_BUDGET_MB)) * 2**20
+		self.eviction_hooks = []
+		self.hits = 0
+		self.misses = 0
+		self.evictions = 0
+		self._entries = OrderedDict() # node -> entry, least recently used first
+		self._pinned = set()
+		self._lock = threading.RLock()
+		return(self)
+
+	#---------------------------------------------------------------------------
+	def __repr__(self):
+		return("<TrajectoryCache entries=%d nbytes=%d budget=%d hits=%d misses=%d evictions=%d>"%(
+			len(self._entries), self.nbytes, self.budget, self.hits, self.misses, self.evictions))
+
+	@property
+	def nbytes(self):
+		return( sum([e.nbytes for e in self._entries.values()]) )
+
+	#---------------------------------------------------------------------------
+	def get(self, node, trr_mtime):
+		""" @return: the cached entry of the node or None, if it is missing or outdated """
+		with self._lock:
+			entry = self._entries.pop(node, None)
+			if(entry == None or entry.trr_mtime < trr_mtime):
+				self.misses += 1
+				return(None)
+			self._entries[node] = entry # mark as most recently used
+			self.hits += 1
+			return(entry)
+
+	#---------------------------------------------------------------------------
+	def put(self, entry):
+		with self._lock:
+			self._entries.pop(entry.node, None)
+			self._entries[entry.node] = entry
+			self.shrink()
+
+	#---------------------------------------------------------------------------
+	def shrink(self):
+		""" Evicts least recently used entries until the budget is met. """
+		with self._lock:
+			excess = self.nbytes - self.budget
+			for node in self._entries.keys():
+				if(excess <= 0):
+					break
+				if(node in self._pinned or node == self._entries.keys()[-1]):
+					continue # the most recent entry is kept in any case
+				excess -= self._entries[node].nbytes
+				self.evict(node)
+
+	#---------------------------------------------------------------------------
+	def evict(self, node):
+		with self._lock:
+			entry = self._entries.pop(node, None)
+			if(entry == None):
+				return
+			self.evictions += 1
+			for hook in self.eviction_hooks:
+				try:
+					hook(entry.node, entry)
+				except:
+					traceback.print_exc()
+					print("Warning: eviction hook failed for %s"%node.name)
+
+	#---------------------------------------------------------------------------
+	def clear(self):
+		with self._lock:
+			for node in self._entries.keys():
+				self.evict(node)
+
+	#---------------------------------------------------------------------------
+	def pin(self, node):
+		with self._lock:
+			self._pinned.add(node)
+
+	def unpin(self, node):
+		with self._lock:
+			self._pinned.discard(node)
+			self.shrink()
+
+#===============================================================================
+#EOF
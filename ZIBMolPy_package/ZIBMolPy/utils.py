@@ -65,6 +65,87 @@ def register_file_dependency(addict, drug):
 	f.write("".join(entries))
 	f.close()
 
+#===============================================================================
+def write_atomic(filename, content, fsync_dir=True):
+	""" Replaces the given file atomically via a temporary file and rename().
+	@param fsync_dir: whether to fsync the directory afterwards - see L{fsync_directory}
+	"""
+	tmp_fn = filename + ".tmp%d"%os.getpid()
+	f = open(tmp_fn, "wb")
+	f.write(content)
+	f.flush()
+	os.fsync(f.fileno())
+	f.close()
+	os.rename(tmp_fn, filename)
+	if(fsync_dir):
+		fsync_directory(path.dirname(filename) or os.curdir)
+
+#===============================================================================
+def fsync_directory(dirname):
+	""" Makes renames within the given directory durable - a no-op where directories can not be fsynced """
+	try:
+		fd = os.open(dirname, os.O_RDONLY)
+	except OSError:
+		return
+	try:
+		os.fsync(fd)
+	except OSError:
+		pass
+	finally:
+		os.close(fd)
+
+#===============================================================================
+# function and shared data of the running parallel_imap - inherited by the forked workers
+_parallel_task = None
+
+def _parallel_call(job):
+	(func, shared) = _parallel_task
+	return(func(shared, job))
+
+
+def parallel_imap(func, jobs, n_procs=None, shared=None, ordered=True):
+	"""
+	Calls func(shared, job) for all jobs in a pool of forked worker processes and yields the results.
+	
+	The shared data is never pickled, the workers inherit it via fork. Only jobs and results 
+	are sent through pipes. With n_procs == 1 or a single job, everything runs within the calling process.
+	The workers are terminated, if a job raises an exception or the iteration is stopped early.
+	@param n_procs: number of processes, default: number of cpus
+	@param ordered: False yields each result as soon as it is available
+	"""
+	global _parallel_task
+	jobs = list(jobs)
+	if(n_procs == 1 or len(jobs) <= 1):
+		for job in jobs:
+			yield(func(shared, job))
+		return
+	
+	import multiprocessing
+	_parallel_task = (func, shared)
+	workers = multiprocessing.Pool(n_procs)
+	finished = False
+	try:
+		if(ordered):
+			results = workers.imap(_parallel_call, jobs)
+		else:
+			results = workers.imap_unordered(_parallel_call, jobs)
+		for r in results:
+			yield(r)
+		finished = True
+	finally:
+		if(finished):
+			workers.close()
+		else:
+			workers.terminate()
+		workers.join()
+		_parallel_task = None
+
+
+def parallel_map(func, jobs, n_procs=None, shared=None):
+	""" Like L{parallel_imap}, but returns the list of results """
+	return(list(parallel_imap(func, jobs, n_procs, shared)))
+
+
 #===============================================================================
 def pformat(data):
 	""" A pretty formater, that outputs numpy-arrays completely """
@@ -0,0 +1,45 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Runs the sparse path of zgf_analyze on a block-diagonal S matrix - no pool or gromacs required.
+Two well separated blocks of four nodes give a twofold eigenvalue 1, while only
+three of the eight eigenpairs are computed, hence the eigenvectors are not square.
+"""
+
+from ZIBMolPy.algorithms import symmetrize, eig_reversible, orthogonalize, cluster_by_isa
+import numpy as np
+import scipy.sparse
+
+def main():
+	block = np.array([[0.70, 0.20, 0.06, 0.04],
+	                  [0.20, 0.60, 0.15, 0.05],
+	                  [0.06, 0.15, 0.69, 0.10],
+	                  [0.04, 0.05, 0.10, 0.81]])
+	s_matrix = np.kron(np.eye(2), block)
+	s_matrix += 1E-05 # tiny overlaps between the blocks, below the threshold
+	s_matrix /= np.sum(s_matrix, axis=1)[:,None]
+	node_weights = np.ones(8) / 8.0
+
+	# same thresholding as zgf_analyze
+	dropped = np.where(s_matrix >= 1E-03, 0, s_matrix)
+	s_matrix = scipy.sparse.csr_matrix( s_matrix - dropped + np.diag(np.sum(dropped, axis=1)) )
+	print "kept %d of %d entries" % (s_matrix.nnz, np.prod(s_matrix.shape))
+
+	(corr_s_matrix, corr_node_weights) = symmetrize(s_matrix, node_weights, correct_weights=True, error=1E-05)
+	(eigvalues, eigvectors) = eig_reversible(corr_s_matrix, corr_node_weights, 3)
+	print "eigenvalues:", " ".join(["%.6f"%v for v in eigvalues])
+	print "eigenvectors:", eigvectors.shape
+
+	orth_eigvectors = orthogonalize(eigvalues, eigvectors.copy(), corr_node_weights)
+	gram = np.dot(orth_eigvectors.T * corr_node_weights, orth_eigvectors)
+	print "orthonormality error: %.6f" % np.max(np.abs(gram - np.eye(3)))
+
+	# the basis of the twofold eigenvalue is arbitrary, so only compare the partition
+	labels = np.argmax(cluster_by_isa(orth_eigvectors, 2)[2], axis=1)
+	print "blocks become clusters:", (len(set(labels[:4])) == len(set(labels[4:])) == 1 and labels[0] != labels[4])
+
+if(__name__=="__main__"):
+	main()
+
+#EOF
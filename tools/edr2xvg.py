@@ -0,0 +1,37 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+
+from ZIBMolPy.io.edr import EdrFile
+import sys
+
+def main():
+	if(len(sys.argv) < 2):
+		print("Takes a gromacs energy file and prints the given terms like g_energy writes them into an xvg-file.")
+		print("Usage: edr2xvg.py <edr-input-file> [term ...]")
+		print("Without terms all terms are printed. Blanks in term names can be written as dashes, e.g. Coulomb-(SR).")
+		sys.exit(1)
+	
+	edr_fn = sys.argv[1]
+	terms = sys.argv[2:]
+	
+	f = EdrFile(edr_fn)
+	if(len(terms) == 0):
+		terms = f.term_names
+	(times, energies) = f.read_terms(terms)
+	
+	print('@    title "Energies from %s"'%edr_fn)
+	print('@    xaxis  label "Time (ps)"')
+	for (i, k) in enumerate(f.find_terms(terms)):
+		print('@ s%d legend "%s"'%(i, f.term_names[k]))
+	for (t, values) in zip(times, energies):
+		print("%12.6f"%t + "".join(["  %18.6f"%v for v in values]))
+
+	
+	
+	
+	
+if(__name__=="__main__"):
+	main()
+	
+#EOF
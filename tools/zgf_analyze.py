@@ -35,21 +35,38 @@ PCCA+
 =====
 	You will have to specify a number of clusters for PCCA+. An initial guess for this number will be made based on the largest gap between the calculated eigenvalues. Ideally there is only real eigenvalue one, followed by a number of eigenvalues very close to one (together forming the Perron cluster, which gives the number of metastable conformations), followed by a significant gap to mark the end of the Perron cluster. Eigenvectors belonging to eigenvalues that are not in the Perron cluster are irrelevant for PCCA+. The quality of the clustering result can be evaluated by taking a look at the (stochastic) $\chi$ matrix, which for each node gives the membership to the metastable conformations identified during PCCA+. All matrices can also be exported for use in Matlab. The matrices are stored in the analysis/ directory.
 
+	To compare several numbers of clusters, use the option sweep (e.g. 2-6). PCCA+ is then performed for each of them in parallel on the same orthogonalized eigenvectors, and crispness, minimum $\chi$ entry, $Q_c$ row-sum error and cluster weights are shown in one table - before you are asked for the number of clusters. The $\chi$ and $Q_c$ matrices of each count are stored as analysis/chi_mat_kNN.npz and analysis/qc_mat_kNN.npz, which can be viewed in L{zgf_browser}.
+
 Symmetrization error threshold
 ==============================
 	This parameter helps to adjust the weighting of overlap regions between $\phi$ functions.
 
+S matrix calculation
+====================
+	The rows of $S$ are calculated in parallel (option processes). The result is stored in the analysis/ directory together with its inputs. When nodes are added, removed or re-sampled, only the affected rows and columns are recalculated - unless alpha changed or the phi-functions of the added or removed nodes do not vanish on a row's trajectory. Use overwrite-mat to force a full recalculation. Completed rows are checkpointed as well, hence an interrupted calculation resumes when zgf_analyze is rerun.
+
+	With the option lags, the lagged matrices $S(\tau)$ for the given lag times (in frames) are accumulated in the same pass and stored as a stack in analysis/s_mat_lags.npz - useful for checking Markovianity and implied timescales.
+
+	For a quick look at large pools, the option approx estimates $S$ from the given number of frames per node, drawn according to the frame weights. Bootstrap standard errors of the entries and of the leading eigenvalues are computed from the same $\phi$-values, and the matrix is stored in analysis/s_mat_approx.npz. All results of such a run go to separate files with the suffix _approx, the node weights are not changed - the other tools keep using the full matrix. If a full (or approximate) $S$ matrix of the same nodes exists, a warning is given when it suggests a different number of clusters.
+
+Sparse S matrix
+===============
+	For large pools most $\phi$ overlaps are effectively zero. With the option sparse-threshold, entries of $S$ below the threshold are dropped - their mass is added to the diagonal, so that $S$ stays row-stochastic. The symmetrization is done on a sparse matrix and only the leading eigenvalues (option num-eigvals) are computed by Lanczos. The eigenvalue gaps are then shown for this partial spectrum only.
+
 """
 
 import os
 from os import path
 import sys
-from ZIBMolPy.utils import register_file_dependency
-from ZIBMolPy.phi import get_phi_num, get_phi_denom, get_phi
+from ZIBMolPy.utils import register_file_dependency, fn2dep, parallel_imap, parallel_map
+from ZIBMolPy.phi import get_phi_matrix, get_phi_log_denom
+from ZIBMolPy.internals import InternalArray
+from ZIBMolPy.checkpoint import Checkpoint, remove_checkpoint, file_stamp
 from ZIBMolPy.pool import Pool
-from ZIBMolPy.algorithms import cluster_by_isa, orthogonalize, symmetrize, opt_soft
+from ZIBMolPy.algorithms import cluster_by_isa, orthogonalize, symmetrize, opt_soft, eig_reversible
 from ZIBMolPy.ui import userinput, Option, OptionsList
 from scipy.io import savemat
+import scipy.sparse
 import numpy as np
 import time
 
@@ -60,10 +77,18 @@ options_desc = OptionsList([
 	Option("m", "export-matlab", "bool", "export matrices as mat-files", default=False),
 	Option("c", "auto-cluster", "bool", "choose number of clusters automatically", default=False),
 	Option("o", "overwrite-mat", "bool", "overwrite existing matrices", default=False),
-	Option("f", "fast-mat", "bool", "fast but less stable matrix calculation", default=False),
+	Option("f", "fast-mat", "bool", "phi-denominators over the analyzed nodes only, instead of the whole partition", default=False),
 	Option("i", "ignore-failed", "bool", "reweight and ignore mdrun-failed nodes", default=False),
 	Option("n", "optimize-chi", "bool", "optimize chi matrix", default=False),
+	Option("O", "optimize-method", "choice", "optimizer for chi matrix, nelder-mead is the old and slow one", choices=("lbfgs", "nelder-mead")),
+	Option("r", "optimize-starts", "int", "number of optimizer runs for chi matrix (executed in parallel)", default=4, min_value=1),
 	Option("s", "summary", "bool", "print cluster summary", default=False),
+	Option("t", "sparse-threshold", "float", "drop S matrix entries below this threshold and compute only the leading eigenvalues (0 = dense)", default=0.0, min_value=0.0),
+	Option("k", "num-eigvals", "int", "number of leading eigenvalues computed for a sparse S matrix", default=20, min_value=2),
+	Option("l", "lags", "str", "comma separated lag times (in frames) of additional lagged S matrices, calculated in the same pass", default=""),
+	Option("a", "approx", "int", "approximate S matrix from this many frames per node, with bootstrap errors (0 = all frames)", default=0, min_value=0),
+	Option("w", "sweep", "str", "range of cluster counts for PCCA+, e.g. 2-6 or 2,4,5 - results are compared and stored per count", default=""),
+	Option("P", "processes", "int", "number of processes for the S matrix calculation and the sweep (0 = number of cpus)", default=0, min_value=0),
 	])
 
 sys.modules[__name__].__doc__ += options_desc.epytext() # for epydoc
@@ -75,6 +100,8 @@ def is_applicable():
 #===============================================================================
 def main():
 	options = options_desc.parse_args(sys.argv)[0]
+	if(options.approx and options.lags):
+		sys.exit("Options approx and lags can not be combined.")
 
 	zgf_cleanup.main()
 	
@@ -90,38 +117,72 @@ def main():
 		sys.exit("Matrix calculation not possible: Not all of the nodes have been reweighted.")
 	
 	print "\n### Getting S matrix ..."
-	s_matrix = cache_matrix(pool.s_mat_fn, active_nodes, overwrite=options.overwrite_mat, fast=options.fast_mat)
-	register_file_dependency(pool.s_mat_fn, pool.filename)
-
+	n_procs = options.processes or None
 	node_weights = np.array([node.obs.weight_direct for node in active_nodes])
+	s_mat_fn = pool.s_mat_fn
+	(s_corr_mat_fn, chi_mat_fn, qc_mat_fn) = (pool.s_corr_mat_fn, pool.chi_mat_fn, pool.qc_mat_fn)
+	mat_suffix = "" # of the matlab exports
+	if(options.approx):
+		# the quick look must not replace the results of the full matrix
+		s_mat_fn = pool.s_approx_mat_fn
+		(s_corr_mat_fn, chi_mat_fn, qc_mat_fn) = (pool.s_corr_approx_mat_fn, pool.chi_approx_mat_fn, pool.qc_approx_mat_fn)
+		mat_suffix = "_approx"
+		t1 = time.time()
+		(s_matrix, s_errors, s_replicas) = calc_matrix_approx(active_nodes, options.approx, options.fast_mat)
+		print("Approximate matrix calculation took %f seconds.")%(time.time()-t1)
+		print "Bootstrap standard errors of S matrix entries - mean: %f, max: %f" % (np.mean(s_errors), np.max(s_errors))
+		save_matrix(s_mat_fn, s_matrix, active_nodes, {'std_errors':s_errors, 'frames_per_node':options.approx})
+	elif(options.lags):
+		# lag 0 is the S matrix itself
+		lags = [0] + [int(l) for l in options.lags.split(",")]
+		s_matrices = cache_matrix(pool.s_lags_mat_fn, active_nodes, shift=lags, overwrite=options.overwrite_mat, fast=options.fast_mat, n_procs=n_procs)
+		s_matrix = s_matrices[0]
+		save_matrix(pool.s_mat_fn, s_matrix, active_nodes, matrix_inputs(active_nodes, [0], options.fast_mat))
+		print "Lagged S matrices for lag times %s stored in %s."%(lags, pool.s_lags_mat_fn)
+	else:
+		s_matrix = cache_matrix(pool.s_mat_fn, active_nodes, overwrite=options.overwrite_mat, fast=options.fast_mat, n_procs=n_procs)
+
+	sparse = (options.sparse_threshold > 0)
+	if(sparse):
+		# the dropped mass is added to the diagonal, hence S stays row-stochastic
+		dropped = np.where(s_matrix >= options.sparse_threshold, 0, s_matrix)
+		s_matrix = scipy.sparse.csr_matrix( s_matrix - dropped + np.diag(np.sum(dropped, axis=1)) )
+		print "\n### Sparse S matrix: kept %d of %d entries (threshold %g)." % (s_matrix.nnz, np.prod(s_matrix.shape), options.sparse_threshold)
 	
 	print "\n### Symmetrizing S matrix ..."
 	(corr_s_matrix, corr_node_weights) = symmetrize(s_matrix, node_weights, correct_weights=True, error=float(options.error))
 
-	# store intermediate results
-	register_file_dependency(pool.s_corr_mat_fn, pool.s_mat_fn)
+	# store intermediate results - unlike the S matrix they can not be updated row by row
+	register_pool_dependencies(s_corr_mat_fn, active_nodes, [s_mat_fn])
 
-	np.savez(pool.s_corr_mat_fn, matrix=corr_s_matrix, node_names=[n.name for n in active_nodes])
+	if(sparse):
+		np.savez(s_corr_mat_fn, matrix=corr_s_matrix.toarray(), node_names=[n.name for n in active_nodes])
+	else:
+		np.savez(s_corr_mat_fn, matrix=corr_s_matrix, node_names=[n.name for n in active_nodes])
 	
 	if options.export_matlab:
-		savemat(pool.analysis_dir+"node_weights.mat", {"node_weights":node_weights, "node_weights_corrected":corr_node_weights})
-		savemat(pool.analysis_dir+"s_mats.mat", {"s_matrix":s_matrix, "s_matrix_corrected":corr_s_matrix})
+		savemat(pool.analysis_dir+"node_weights%s.mat"%mat_suffix, {"node_weights":node_weights, "node_weights_corrected":corr_node_weights})
+		savemat(pool.analysis_dir+"s_mats%s.mat"%mat_suffix, {"s_matrix":s_matrix, "s_matrix_corrected":corr_s_matrix})
 
-	for (n, cw) in zip(active_nodes, corr_node_weights):
-		n.obs.weight_corrected = cw
-		
 	print "\n### Node weights after symmetrization of S matrix:"
-	for n in active_nodes:
-		print "%s: initial weight: %f, corrected weight: %f, weight change: %f" % (n.name, n.obs.weight_direct, n.obs.weight_corrected, abs(n.obs.weight_direct - n.obs.weight_corrected))
-		n.save()
+	for (n, cw) in zip(active_nodes, corr_node_weights):
+		print "%s: initial weight: %f, corrected weight: %f, weight change: %f" % (n.name, n.obs.weight_direct, cw, abs(n.obs.weight_direct - cw))
 
+	if(not options.approx): # approximate weights are not stored
+		for (n, cw) in zip(active_nodes, corr_node_weights):
+			n.obs.weight_corrected = cw
+		active_nodes.save_all()
 	active_nodes.unlock()
 
 	# calculate and sort eigenvalues in descending order
-	(eigvalues, eigvectors) = np.linalg.eig(corr_s_matrix)
-	argsorted_eigvalues = np.argsort(-eigvalues)
-	eigvalues = eigvalues[argsorted_eigvalues]
-	eigvectors = eigvectors[:, argsorted_eigvalues]
+	if(sparse):
+		# only the leading part of the spectrum
+		(eigvalues, eigvectors) = eig_reversible(corr_s_matrix, corr_node_weights, options.num_eigvals)
+	else:
+		(eigvalues, eigvectors) = np.linalg.eig(corr_s_matrix)
+		argsorted_eigvalues = np.argsort(-eigvalues)
+		eigvalues = eigvalues[argsorted_eigvalues]
+		eigvectors = eigvectors[:, argsorted_eigvalues]
 	
 	gaps = np.abs(eigvalues[1:]-eigvalues[:-1])
 	gaps = np.append(gaps, 0.0)
@@ -133,50 +194,57 @@ def main():
 	n_clusters = np.argmax(wgaps)+1
 	print "\n### Maximum gap %f after top %d eigenvalues." % (np.max(gaps), n_clusters)
 	print "### Maximum EV-weighted gap %f after top %d eigenvalues." % (np.max(wgaps), np.argmax(wgaps)+1)
+	
+	if(options.approx):
+		ev_errors = bootstrap_eigvalues(s_replicas, node_weights, float(options.error), min(10, len(eigvalues)))
+		print "\n### Bootstrap standard errors of the leading eigenvalues (approximation from %d frames per node):" % options.approx
+		for (idx, ev, err) in zip(range(1, len(ev_errors)+1), eigvalues, ev_errors):
+			print "EV%04d: %f +- %f" % (idx, ev, err)
+	
+	# compare with the other kind of S matrix - full vs. approximate
+	other_fn = pool.s_mat_fn if(options.approx) else pool.s_approx_mat_fn
+	if(path.exists(other_fn) and list(np.load(other_fn)["node_names"]) == [n.name for n in active_nodes]):
+		other_n_clusters = suggest_n_clusters(np.load(other_fn)["matrix"], node_weights, float(options.error))
+		other_kind = "full" if(options.approx) else "approximate"
+		if(other_n_clusters != n_clusters):
+			print "\n### WARNING: The %s S matrix in %s suggests %d clusters instead of %d." % (other_kind, other_fn, other_n_clusters, n_clusters)
+		else:
+			print "### The %s S matrix in %s suggests the same number of clusters." % (other_kind, other_fn)
+	
+	# orthogonalize and normalize eigenvectors - once for all cluster counts
+	orth_eigvectors = orthogonalize(eigvalues, eigvectors.copy(), corr_node_weights)
+	optimize = options.optimize_method if(options.optimize_chi) else None
+	
+	if(options.sweep):
+		sweep_ks = parse_sweep(options.sweep)
+		if(max(sweep_ks) > len(eigvalues)):
+			sys.exit("Sweep exceeds the number of eigenvalues (%d)."%len(eigvalues))
+		print "\n### Sweeping PCCA+ over %d cluster counts ..." % len(sweep_ks)
+		t1 = time.time()
+		sweep = sweep_clusters(eigvalues, orth_eigvectors, corr_node_weights, sweep_ks, optimize, n_procs)
+		print "Sweep took %.2f seconds." % (time.time()-t1)
+		print "\n%4s  %9s  %9s  %14s  %s" % ("k", "crispness", "min chi", "Qc row-sum err", "cluster weights")
+		for (k, chi_k, rot_k, qc_k) in sweep:
+			(crispness, min_chi, rowsum_err) = pcca_quality(chi_k, qc_k, corr_node_weights)
+			print "%4d  %9.4f  %9.4f  %14.2e  %s" % (k, crispness, min_chi, rowsum_err, " ".join(["%.4f"%w for w in rot_k[0]]))
+			(chi_k_fn, qc_k_fn) = (pool.chi_mat_k_fn(k, options.approx > 0), pool.qc_mat_k_fn(k, options.approx > 0))
+			np.savez(chi_k_fn, matrix=chi_k, n_clusters=k, node_names=[n.name for n in active_nodes])
+			np.savez(qc_k_fn, matrix=qc_k, n_clusters=k, node_names=[n.name for n in active_nodes], weights=rot_k[0])
+			for fn in (chi_k_fn, qc_k_fn):
+				register_pool_dependencies(fn, active_nodes, [s_mat_fn, s_corr_mat_fn])
+		print "Chi and Q_c matrices of the sweep stored in %s." % pool.analysis_dir
+	
 	sys.stdout.flush()
 	if not options.auto_cluster:
-		n_clusters = userinput("Please enter the number of clusters for PCCA+", "int", "x>0")
+		n_clusters = userinput("Please enter the number of clusters for PCCA+", "int", "x>0 and x<=%d"%len(eigvalues))
 	print "### Using %d clusters for PCCA+ ..."%n_clusters
 
 	if options.export_matlab:
-		savemat(pool.analysis_dir+"evs.mat", {"evs":eigvectors})
+		savemat(pool.analysis_dir+"evs%s.mat"%mat_suffix, {"evs":eigvectors})
 	
-	# orthogonalize and normalize eigenvectors 
-	eigvectors = orthogonalize(eigvalues, eigvectors, corr_node_weights)
-
-	# perform PCCA+
-	# First two return-values "c_f" and "indicator" are not needed
-	(chi_matrix, rot_matrix) = cluster_by_isa(eigvectors, n_clusters)[2:]
-
 	if(options.optimize_chi):
 		print "\n### Optimizing chi matrix ..."
-		
-		outliers = 5
-		mean_weight = np.mean(corr_node_weights)
-		threshold = mean_weight/100*outliers
-		print "Light-weight node threshold (%d%% of mean corrected node weight): %.4f."%(outliers, threshold)
-
-		# accumulate nodes for optimization
-		edges = np.where(np.max(chi_matrix, axis=1) > 0.9999)[0] # edges of simplex
-		heavies = np.where( corr_node_weights > threshold)[0] # heavy-weight nodes
-		filtered_eigvectors = eigvectors[ np.union1d(edges, heavies) ]
-
-		# perform the actual optimization
-		rot_matrix = opt_soft(filtered_eigvectors, rot_matrix, n_clusters)
-
-		chi_matrix = np.dot(eigvectors[:,:n_clusters], rot_matrix)
-		
-		# deal with light-weight nodes: shift and scale
-		for i in np.where(corr_node_weights <= threshold)[0]:
-			if(i in edges):
-				print "Column %d belongs to (potentially dangerous) light-weight node, but its node is a simplex edge."%(i+1)
-				continue
-			print "Column %d is shifted and scaled."%(i+1)
-			col_min = np.min( chi_matrix[i,:] )
-			chi_matrix[i,:] -= col_min
-			chi_matrix[i,:] /= 1-(n_clusters*col_min)
-			
-	qc_matrix = np.dot( np.dot( np.linalg.inv(rot_matrix), np.diag(eigvalues[range(n_clusters)]) ), rot_matrix ) - np.eye(n_clusters)
+	(chi_matrix, rot_matrix, qc_matrix) = pcca(eigvalues, orth_eigvectors, corr_node_weights, n_clusters, optimize, options.optimize_starts)
 	cluster_weights = rot_matrix[0]
 	
 	print "\n### Matrix numerics check"
@@ -192,19 +260,15 @@ def main():
 	print np.sum(chi_matrix, axis=1)
 
 	# store final results
-	np.savez(pool.chi_mat_fn, matrix=chi_matrix, n_clusters=n_clusters, node_names=[n.name for n in active_nodes])
-	np.savez(pool.qc_mat_fn,  matrix=qc_matrix,  n_clusters=n_clusters, node_names=[n.name for n in active_nodes], weights=cluster_weights)
+	np.savez(chi_mat_fn, matrix=chi_matrix, n_clusters=n_clusters, node_names=[n.name for n in active_nodes])
+	np.savez(qc_mat_fn,  matrix=qc_matrix,  n_clusters=n_clusters, node_names=[n.name for n in active_nodes], weights=cluster_weights)
 
 	if options.export_matlab:		
-		savemat(pool.analysis_dir+"chi_mat.mat", {"chi_matrix":chi_matrix})
-		savemat(pool.analysis_dir+"qc_mat.mat", {"qc_matrix":qc_matrix, "weights":cluster_weights})
+		savemat(pool.analysis_dir+"chi_mat%s.mat"%mat_suffix, {"chi_matrix":chi_matrix})
+		savemat(pool.analysis_dir+"qc_mat%s.mat"%mat_suffix, {"qc_matrix":qc_matrix, "weights":cluster_weights})
 
-	register_file_dependency(pool.chi_mat_fn, pool.s_corr_mat_fn)
-	register_file_dependency(pool.qc_mat_fn, pool.s_corr_mat_fn)
-
-	for fn in (pool.s_mat_fn, pool.s_corr_mat_fn):
-		register_file_dependency(pool.chi_mat_fn, fn)
-		register_file_dependency(pool.qc_mat_fn, fn)
+	for fn in (chi_mat_fn, qc_mat_fn):
+		register_pool_dependencies(fn, active_nodes, [s_mat_fn, s_corr_mat_fn])
 
 	# touch analysis directory (triggering update in zgf_browser)
 	atime = mtime = time.time()
@@ -215,24 +279,15 @@ def main():
 		print "\n### Preparing cluster summary ..."
 		chi_threshold = 1E-3
 		from pprint import pformat
+		
+		(edges, hist_cube) = cache_hist_cube(pool.hist_cube_fn, active_nodes)
+		# histograms of all clusters at once: sum_n weight_n * chi_nk * hist_n
+		hist_clusters = np.einsum("n,nk,ncb->kcb", corr_node_weights, chi_matrix, hist_cube)
 	
 		for i in range(n_clusters):
 			involved_nodes = [active_nodes[ni] for ni in np.argwhere(chi_matrix[:,i] > chi_threshold)]
 			max_chi_node = active_nodes[ np.argmax(chi_matrix[:,i]) ]
-			c_max = []
-
-			for c in  pool.converter:
-				coord_range = pool.coord_range(c)
-				scale = c.plot_scale
-				edges = scale(np.linspace(np.min(coord_range), np.max(coord_range), num=50))
-				hist_cluster = np.zeros(edges.size-1)
-
-				for (n, chi) in zip([n for n in active_nodes], chi_matrix[:,i]):
-					samples = scale( n.trajectory.getcoord(c) )
-					hist_node = np.histogram(samples, bins=edges, weights=n.frameweights, normed=True)[0]
-					hist_cluster += n.obs.weight_corrected * hist_node * chi
-
-				c_max.append( scale(np.linspace(np.min(coord_range), np.max(coord_range), num=50))[np.argmax(hist_cluster)] )
+			c_max = edges[ np.arange(len(edges)), np.argmax(hist_clusters[i], axis=1) ]
 
 			msg = "### Cluster %d (weight=%.4f, #involved nodes=%d, representative='%s'):"%(i+1, cluster_weights[i], len(involved_nodes), max_chi_node.name)
 			print "\n"+msg
@@ -245,35 +300,359 @@ def main():
 
 #===============================================================================
 # "cache" specialized for "calc_matrix" in order to save a proper npz
-def cache_matrix(filename, nodes, shift=0, overwrite=False, fast=False):
+def cache_matrix(filename, nodes, shift=0, overwrite=False, fast=False, n_procs=None):
+	"""
+	Loads the matrix from filename or (re)calculates it via L{calc_matrix}.
+	
+	Besides the matrix, the npz-file records the inputs (alpha, the nodes of the phi-denominators 
+	and the trajectories). Hence, an existing file is updated incrementally: only rows of new or 
+	re-sampled nodes are recalculated and new columns are added - as long as the changed 
+	phi-denominators are negligible on the trajectory of a row, see L{calc_matrix}.
+	
+	Completed rows are checkpointed next to filename, so an interrupted calculation resumes.
+	
+	@param shift: lag time in frames - or a list of lag times, then a stack of matrices is stored and returned
+	"""
+	old = None
 	if(path.exists(filename) and not overwrite):
-		return(np.load(filename)["matrix"])
+		old = np.load(filename)
+		if("trr_stamps" not in old.files):
+			return(old["matrix"]) # written by an older version, can not be updated
+	
 	t1 = time.time()
-	mat = calc_matrix(nodes, shift, fast)
+	checkpoint_fn = path.splitext(filename)[0]+".ckpt"
+	(mat, inputs) = calc_matrix(nodes, shift, fast, n_procs=n_procs, old=old, checkpoint_fn=checkpoint_fn)
 	t2 = time.time()
 	print("Matrix calculation took %f seconds.")%(t2-t1)
+	save_matrix(filename, mat, nodes, inputs)
+	remove_checkpoint(checkpoint_fn)
+	return(mat)
+
+
+#===============================================================================
+def save_matrix(filename, mat, nodes, inputs):
+	""" Stores a matrix as returned by L{calc_matrix} along with its inputs and registers its dependencies.
+	
+	A matrix with trajectory stamps (see L{matrix_inputs}) is brought up to date by L{cache_matrix} 
+	row by row, hence it must not depend on the trajectories or the pool - L{zgf_cleanup} would 
+	remove it as a whole, as soon as a single node gets re-sampled or refined.
+	The results derived from it depend on them instead, see L{register_pool_dependencies}.
+	"""
+	if("trr_stamps" in inputs):
+		if(path.exists(fn2dep(filename))):
+			os.remove(fn2dep(filename)) # dependencies of the previous nodes
+	else:
+		register_pool_dependencies(filename, nodes)
+	np.savez(filename, matrix=mat, node_names=[n.name for n in nodes], **inputs)
+
+
+#===============================================================================
+def register_pool_dependencies(filename, nodes, sources=()):
+	""" Replaces the dependencies of filename by the given source files, the pool and the trajectories of the nodes.
+	Hence L{zgf_cleanup} removes it, as soon as a node gets re-sampled or the pool gets refined.
+	"""
+	if(path.exists(fn2dep(filename))):
+		os.remove(fn2dep(filename)) # dependencies of the previous nodes
+	for fn in sources:
+		register_file_dependency(filename, fn)
+	register_file_dependency(filename, nodes[0].pool.filename)
 	for n in nodes:
 		register_file_dependency(filename, n.trr_fn)
-	np.savez(filename, matrix=mat, node_names=[n.name for n in nodes])
-	return(mat)
 
 
 #===============================================================================
-def calc_matrix(nodes, shift=0, cache_denom=False):
+def matrix_inputs(nodes, lags, cache_denom):
+	""" Returns everything a matrix calculated by L{calc_matrix} depends on - besides the trajectories' content """
+	pool = nodes[0].pool
+	denom_nodes = nodes if(cache_denom) else pool.where("isa_partition")
+	return({
+		'alpha': pool.alpha,
+		'lags': np.array(lags),
+		'fast': cache_denom,
+		'denom_names': [n.name for n in denom_nodes],
+		'denom_internals': np.row_stack([n.internals.array for n in denom_nodes]),
+		'trr_stamps': [file_stamp(n.trr_fn) for n in nodes],
+	})
+
+
+#===============================================================================
+def calc_matrix(nodes, shift=0, cache_denom=False, n_procs=None, old=None, reuse_tol=1E-8, checkpoint_fn=None):
+	"""
+	Calculates the S matrix row by row in a process pool - each worker reads the trajectory of its row's node.
+	
+	The phi-functions are evaluated once per frame, see L{get_phi_matrix<ZIBMolPy.phi.get_phi_matrix>}. 
+	When shift is a list of lag times, the lagged matrices S(tau) of all of them are accumulated in the same pass.
+	
+	Rows from a previous result are reused, if alpha, the lags and the trajectory are the same. 
+	When the nodes of the phi-denominators changed (e.g. after L{zgf_refine}), a row is only reused, 
+	if the phi-values of all added and removed nodes stay below reuse_tol on its trajectory. 
+	The entries of such a row change by less than this relative amount.
+	
+	@param shift: lag time in frames or a list of lag times
+	@param cache_denom: use the given nodes for the phi-denominators instead of the partition
+	@param old: content of a previous npz-file written by L{cache_matrix} or None
+	@param checkpoint_fn: file for a L{Checkpoint<ZIBMolPy.checkpoint.Checkpoint>} of the completed rows, None disables checkpointing
+	@return: matrix (or stack of matrices, if shift is a list) and its inputs, which have to be stored alongside
+	"""
+	lags = shift if(isinstance(shift, (list, tuple))) else [shift]
+	inputs = matrix_inputs(nodes, lags, cache_denom)
+	denom_nodes = nodes if(cache_denom) else nodes[0].pool.where("isa_partition")
+	
+	jobs = [ (i, None, None) for i in range(len(nodes)) ]
+	if(old != None and "lags" in old.files and old["alpha"] == inputs['alpha'] and list(old["lags"]) == lags and old["fast"] == cache_denom):
+		old_stack = old["matrix"].reshape((len(lags),)+old["matrix"].shape[-2:])
+		old_idx = dict( (name, i) for (i, name) in enumerate(old["node_names"]) )
+		old_denom = dict( zip(old["denom_names"], old["denom_internals"]) )
+		new_denom = dict( zip(inputs['denom_names'], inputs['denom_internals']) )
+		# nodes, whose phi-function entered or left the denominators
+		added = [ q for (name, q) in new_denom.items() if(name not in old_denom or np.any(old_denom[name] != q)) ]
+		removed = [ q for (name, q) in old_denom.items() if(name not in new_denom or np.any(new_denom[name] != q)) ]
+		cols = np.array([ old_idx.get(n.name, -1) for n in nodes ])
+		for (i, n) in enumerate(nodes):
+			if(n.name in old_idx and old["trr_stamps"][old_idx[n.name]] == inputs['trr_stamps'][i]):
+				old_rows = np.where(cols >= 0, old_stack[:, old_idx[n.name], cols], np.nan)
+				jobs[i] = (i, old_rows, (added, removed, reuse_tol))
+	
+	results = dict() # row-index -> (rows, reused)
+	if(checkpoint_fn != None):
+		old_matrix = None if(old == None) else old["matrix"]
+		key = ([n.name for n in nodes], sorted(inputs.items()), old_matrix, reuse_tol)
+		results = Checkpoint(checkpoint_fn, key, dependencies=[n.trr_fn for n in nodes])
+		jobs = [ j for j in jobs if(j[0] not in results) ]
+	
+	# each row is checkpointed as soon as it is available
+	for (i, rows, reused) in parallel_imap(calc_matrix_row, jobs, n_procs, shared=(nodes, denom_nodes, lags), ordered=False):
+		results[i] = (rows, reused)
+	
+	n_reused = len([ i for i in range(len(nodes)) if results[i][1] ])
+	print("Reused %d rows, calculated %d rows."%(n_reused, len(nodes)-n_reused))
+	mat = np.concatenate([ results[i][0][:,None,:] for i in range(len(nodes)) ], axis=1)
+	if(not isinstance(shift, (list, tuple))):
+		mat = mat[0]
+	return(mat, inputs)
+
+
+#===============================================================================
+def calc_matrix_approx(nodes, n_frames, cache_denom=False, n_boot=100):
+	"""
+	Approximates the S matrix from n_frames frames per node. The frames are drawn with probabilities 
+	proportional to their frame weights, hence the plain mean over the drawn frames estimates the 
+	weighted mean over all frames.
+	
+	Bootstrap replicas of the matrix are obtained from the same phi-values by resampling the drawn frames.
+	
+	@param cache_denom: use the given nodes for the phi-denominators instead of the partition
+	@return: matrix, standard errors of its entries and the bootstrap replicas (n_boot x N x N)
+	"""
+	denom_nodes = nodes if(cache_denom) else nodes[0].pool.where("isa_partition")
 	mat = np.zeros( (len(nodes), len(nodes)) )
+	replicas = np.zeros( (n_boot, len(nodes), len(nodes)) )
 	for (i, ni) in enumerate(nodes):
-		print("Working on: %s"%ni)
-		if(cache_denom):
-			phi_denom = get_phi_denom(ni.trajectory, nodes)
+		p = ni.frameweights / np.sum(ni.frameweights)
+		frames = np.random.choice(len(p), size=n_frames, p=p)
+		phi = get_phi_matrix(ni.trajectory.getframes([int(f) for f in frames]), nodes, denom_nodes)
+		mat[i] = np.mean(phi, axis=0)
+		
+		# counts[b,k]: how often the k-th drawn frame occurs in replica b
+		draws = np.random.randint(0, n_frames, size=(n_boot, n_frames)) + n_frames*np.arange(n_boot)[:,None]
+		counts = np.bincount(draws.ravel(), minlength=n_boot*n_frames).reshape(n_boot, n_frames)
+		replicas[:,i,:] = np.dot(counts, phi) / float(n_frames)
+	
+	return(mat, np.std(replicas, axis=0), replicas)
+
+
+#===============================================================================
+def bootstrap_eigvalues(replicas, node_weights, error, n_eigvals):
+	""" Standard errors of the leading eigenvalues of the symmetrized S matrix - from bootstrap replicas of S """
+	eigvalues = []
+	for s_matrix in replicas:
+		corr_s_matrix = symmetrize(s_matrix, node_weights, correct_weights=True, error=error)[0]
+		eigvalues.append( np.sort(np.linalg.eigvals(corr_s_matrix).real)[::-1][:n_eigvals] )
+	return( np.std(eigvalues, axis=0) )
+
+
+#===============================================================================
+def suggest_n_clusters(s_matrix, node_weights, error):
+	""" Returns the number of clusters suggested by the maximum EV-weighted gap - as in L{main} """
+	corr_s_matrix = symmetrize(s_matrix, node_weights, correct_weights=True, error=error)[0]
+	eigvalues = np.sort(np.linalg.eigvals(corr_s_matrix).real)[::-1]
+	wgaps = np.append(np.abs(eigvalues[1:]-eigvalues[:-1]), 0.0) * eigvalues
+	return( np.argmax(wgaps)+1 )
+
+
+#===============================================================================
+def pcca(eigvalues, eigvectors, weights, n_clusters, optimize=None, n_starts=1, n_procs=None, verbose=True):
+	"""
+	Performs PCCA+ on the sorted and orthogonalized eigenvectors of the symmetrized S matrix.
+	
+	@param eigvectors: as returned by L{orthogonalize<ZIBMolPy.algorithms.orthogonalize>}
+	@param weights: corrected node weights
+	@param optimize: None or the method of L{opt_soft<ZIBMolPy.algorithms.opt_soft>} for optimizing the chi matrix
+	@return: chi matrix, rotation matrix and Q_c matrix
+	"""
+	# perform PCCA+
+	# First two return-values "c_f" and "indicator" are not needed
+	(chi_matrix, rot_matrix) = cluster_by_isa(eigvectors, n_clusters)[2:]
+
+	if(optimize != None and n_clusters > 1): # a single cluster has nothing to optimize
+		outliers = 5
+		mean_weight = np.mean(weights)
+		threshold = mean_weight/100*outliers
+		if(verbose):
+			print "Light-weight node threshold (%d%% of mean corrected node weight): %.4f."%(outliers, threshold)
+
+		# accumulate nodes for optimization
+		edges = np.where(np.max(chi_matrix, axis=1) > 0.9999)[0] # edges of simplex
+		heavies = np.where( weights > threshold)[0] # heavy-weight nodes
+		filtered_eigvectors = eigvectors[ np.union1d(edges, heavies) ]
+
+		# perform the actual optimization
+		t = time.time()
+		rot_matrix = opt_soft(filtered_eigvectors, rot_matrix, n_clusters, method=optimize, n_starts=n_starts, n_procs=n_procs, verbose=verbose)
+		if(verbose):
+			print "Optimization took %.2f seconds."%(time.time()-t)
+
+		chi_matrix = np.dot(eigvectors[:,:n_clusters], rot_matrix)
+		
+		# deal with light-weight nodes: shift and scale
+		for i in np.where(weights <= threshold)[0]:
+			if(i in edges):
+				if(verbose):
+					print "Column %d belongs to (potentially dangerous) light-weight node, but its node is a simplex edge."%(i+1)
+				continue
+			if(verbose):
+				print "Column %d is shifted and scaled."%(i+1)
+			col_min = np.min( chi_matrix[i,:] )
+			chi_matrix[i,:] -= col_min
+			chi_matrix[i,:] /= 1-(n_clusters*col_min)
+			
+	qc_matrix = np.dot( np.dot( np.linalg.inv(rot_matrix), np.diag(eigvalues[range(n_clusters)]) ), rot_matrix ) - np.eye(n_clusters)
+	return(chi_matrix, rot_matrix, qc_matrix)
+
+
+#===============================================================================
+def cache_hist_cube(filename, nodes, num=50):
+	"""
+	Loads or calculates the weighted and normalized histograms of all nodes along all internal coordinates.
+	They do not depend on the clustering, hence the histograms of a cluster are just a contraction with chi.
+	
+	@param filename: npz-file for caching, None disables caching
+	@param num: number of bin edges per coordinate
+	@return: bin edges (n_coords x num) and histograms (N x n_coords x num-1)
+	"""
+	pool = nodes[0].pool
+	edges = []
+	for c in pool.converter:
+		coord_range = pool.coord_range(c)
+		edges.append( c.plot_scale(np.linspace(np.min(coord_range), np.max(coord_range), num=num)) )
+	edges = np.array(edges)
+	names = [n.name for n in nodes]
+	trr_stamps = [file_stamp(n.trr_fn) for n in nodes]
+	
+	if(filename != None and path.exists(filename)):
+		old = np.load(filename)
+		if(list(old["node_names"]) == names and list(old["trr_stamps"]) == trr_stamps and np.array_equal(old["edges"], edges)):
+			return(edges, old["cube"])
+	
+	cube = np.zeros( (len(nodes), len(edges), num-1) )
+	for (i, n) in enumerate(nodes):
+		for (j, c) in enumerate(pool.converter):
+			samples = c.plot_scale( n.trajectory.getcoord(c) )
+			cube[i, j] = np.histogram(samples, bins=edges[j], weights=n.frameweights, normed=True)[0]
+	
+	if(filename != None):
+		for n in nodes:
+			register_file_dependency(filename, n.trr_fn)
+		np.savez(filename, cube=cube, edges=edges, node_names=names, trr_stamps=trr_stamps)
+	return(edges, cube)
+
+
+#===============================================================================
+def parse_sweep(text):
+	""" Parses cluster counts given as range "2-6" or list "2,4,5" """
+	ks = []
+	for part in text.split(","):
+		if("-" in part):
+			(first, last) = part.split("-")
+			ks += range(int(first), int(last)+1)
+		else:
+			ks.append(int(part))
+	if(len(ks) == 0 or min(ks) < 1):
+		raise(Exception("Invalid cluster counts: "+text))
+	return(sorted(set(ks)))
+
+
+#===============================================================================
+def sweep_clusters(eigvalues, eigvectors, weights, ks, optimize=None, n_procs=None):
+	""" Performs PCCA+ for each of the cluster counts ks in a process pool - see L{pcca} 
+	@return: list of (k, chi matrix, rotation matrix, Q_c matrix) 
+	"""
+	return( parallel_map(sweep_run, ks, n_procs, shared=(eigvalues, eigvectors, weights, optimize)) )
+
+
+def sweep_run(shared, k):
+	""" PCCA+ with k clusters - runs within a worker process. """
+	(eigvalues, eigvectors, weights, optimize) = shared
+	return( (k,) + pcca(eigvalues, eigvectors.copy(), weights, k, optimize, n_procs=1, verbose=False) )
+
+
+#===============================================================================
+def pcca_quality(chi_matrix, qc_matrix, weights):
+	"""
+	Returns indicators of the quality of a PCCA+ result:
+	the crispness $\frac{1}{k} \operatorname{trace}(\operatorname{diag}(\chi^T w)^{-1} \chi^T \operatorname{diag}(w) \chi)$ (1 means crisp),
+	the minimum entry of chi (negative entries are infeasible) and the maximum absolute row sum of Q_c (should be 0).
+	"""
+	cluster_weights = np.dot(weights, chi_matrix)
+	crispness = np.sum( np.sum(chi_matrix*chi_matrix*weights[:,None], axis=0) / cluster_weights ) / chi_matrix.shape[1]
+	return(crispness, np.min(chi_matrix), np.max(np.abs(np.sum(qc_matrix, axis=1))))
+
+
+#===============================================================================
+def calc_matrix_row(shared, job):
+	""" Calculates a row of the S matrix for every lag (or just its new columns) - runs within a worker process. """
+	(i, old_rows, changes) = job
+	(nodes, denom_nodes, lags) = shared
+	ni = nodes[i]
+	
+	def lagged_averages(phi):
+		# S_ij(tau) = sum_n w_n*phi_j(x_(n+tau)) / sum_n w_n 
 		frame_weights = ni.frameweights
-		if shift > 0:
-			frame_weights = frame_weights[:-shift]
-		for (j, nj) in enumerate(nodes):
-			if(cache_denom):
-				mat[i, j] = np.average(get_phi_num(ni.trajectory, nj)[shift:] / phi_denom[shift:], weights=frame_weights)
-			else:
-				mat[i, j] = np.average(get_phi(ni.trajectory, nj)[shift:], weights=frame_weights)
-	return(mat)
+		rows = np.zeros( (len(lags), phi.shape[1]) )
+		for (k, lag) in enumerate(lags):
+			w = frame_weights[:len(frame_weights)-lag]
+			rows[k] = np.dot(w, phi[lag:]) / np.sum(w)
+		return(rows)
+	
+	x = None
+	if(old_rows is not None):
+		(added, removed, reuse_tol) = changes
+		new_cols = np.argwhere(np.isnan(old_rows[0])).ravel()
+		if(len(added)+len(removed)+len(new_cols) == 0):
+			return(i, old_rows, True)
+		
+		x = ni.trajectory
+		alpha = ni.pool.alpha
+		log_denom = get_phi_log_denom(x, denom_nodes)
+		
+		# phi-values of added nodes and of removed nodes (against the denominator extended by themselves)
+		changed_phi = np.zeros(x.n_frames)
+		for q in added:
+			changed_phi += np.exp( -alpha*(x - InternalArray(x.converter, q[None,:])).norm2() - log_denom )
+		for q in removed:
+			changed_phi += np.exp( -np.logaddexp(0, alpha*(x - InternalArray(x.converter, q[None,:])).norm2() + log_denom) )
+		
+		if(np.max(changed_phi) < reuse_tol):
+			rows = old_rows.copy()
+			if(len(new_cols) > 0):
+				phi = get_phi_matrix(x, [nodes[j] for j in new_cols], log_denom=log_denom)
+				rows[:, new_cols] = lagged_averages(phi)
+			return(i, rows, True)
+	
+	print("Working on: %s"%ni)
+	if(x is None):
+		x = ni.trajectory
+	return(i, lagged_averages(get_phi_matrix(x, nodes, denom_nodes)), False)
 
 
 #===============================================================================
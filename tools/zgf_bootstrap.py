@@ -0,0 +1,243 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+What it does
+============
+	Estimates confidence intervals for the results of L{zgf_analyze} by bootstrapping: for the S matrix, the corrected node weights, the $Q_c$ matrix and the cluster weights.
+
+	The percentile bands are stored in analysis/qc_mat_bootstrap.npz next to analysis/qc_mat.npz.
+
+How it works
+============
+	At the command line, type::
+		$ zgf_bootstrap [options]
+
+	The $\phi$-values of all nodes are evaluated once for every frame of every node and cached in analysis/phi_frames.npz. A bootstrap sample of $S$ is then just a reweighting of these cached values, one row per node:
+
+	\[ S_{ij}^{(b)} = \\frac{ \sum_n c_n^{(b)} \cdot \mathtt{frame\_weight}_i(q_n^{(i)}) \cdot \phi_j(q_n^{(i)}) }{ \sum_n c_n^{(b)} \cdot \mathtt{frame\_weight}_i(q_n^{(i)}) } \]
+
+	where $c_n^{(b)}$ counts how often frame $n$ was drawn. The counts of all samples are drawn at once. Each sample is symmetrized and clustered by PCCA+ (with the number of clusters of analysis/qc_mat.npz) in a process pool. The clusters of each sample are matched to the clusters of analysis/chi_mat.npz by their overlap.
+
+Resampling
+==========
+	Consecutive frames of a trajectory are correlated. Hence the frames are resampled in blocks (moving block bootstrap). By default the block length of each node is its integrated autocorrelation time of $\phi_i$ along its own trajectory.
+
+	Use the same options fast-mat, error and optimize-chi as for L{zgf_analyze} - otherwise the bands do not belong to the stored results.
+"""
+
+from os import path
+import sys
+import time
+from ZIBMolPy.utils import register_file_dependency, parallel_map
+from ZIBMolPy.phi import get_phi_matrix
+from ZIBMolPy.pool import Pool, NodeList
+from ZIBMolPy.algorithms import symmetrize, orthogonalize
+from ZIBMolPy.ui import Option, OptionsList
+from scipy.optimize import linear_sum_assignment
+import numpy as np
+
+import zgf_analyze
+
+options_desc = OptionsList([
+	Option("N", "n-samples", "int", "number of bootstrap samples", default=200, min_value=10),
+	Option("b", "block-length", "int", "length of resampled blocks in frames (0 = autocorrelation time of each node)", default=0, min_value=0),
+	Option("C", "confidence", "float", "confidence level of the percentile bands", default=0.9, min_value=0.01, max_value=0.99),
+	Option("e", "error", "choice", "error threshold for symmetrize", choices=("1E-02", "1E-03", "1E-04", "1E-05", "1E-06", "1E-07", "1E-08", "1E-09", "1E-10")),
+	Option("f", "fast-mat", "bool", "phi-denominators over the analyzed nodes only, instead of the whole partition", default=False),
+	Option("n", "optimize-chi", "bool", "optimize chi matrix", default=False),
+	Option("O", "optimize-method", "choice", "optimizer for chi matrix, nelder-mead is the old and slow one", choices=("lbfgs", "nelder-mead")),
+	Option("o", "overwrite-phi", "bool", "recalculate the cached phi-values", default=False),
+	Option("S", "seed", "int", "seed of the random number generator (0 = random)", default=0, min_value=0),
+	Option("P", "processes", "int", "number of processes (0 = number of cpus)", default=0, min_value=0),
+	])
+
+sys.modules[__name__].__doc__ += options_desc.epytext() # for epydoc
+
+def is_applicable():
+	pool = Pool()
+	return( path.exists(pool.qc_mat_fn) and path.exists(pool.chi_mat_fn) )
+
+#===============================================================================
+def main():
+	options = options_desc.parse_args(sys.argv)[0]
+	n_procs = options.processes or None
+	if(options.seed):
+		np.random.seed(options.seed)
+
+	pool = Pool()
+	ref_chi = np.load(pool.chi_mat_fn)
+	ref_qc = np.load(pool.qc_mat_fn)
+	n_clusters = int(ref_qc["n_clusters"])
+	found = [ pool.find(name) for name in ref_chi["node_names"] ]
+	if(None in found):
+		sys.exit("Nodes of %s are missing - rerun zgf_analyze."%pool.chi_mat_fn)
+	nodes = NodeList(found)
+	node_weights = np.array([node.obs.weight_direct for node in nodes])
+
+	print "\n### Getting phi-values of all frames ..."
+	phi_frames = cache_phi_frames(pool.phi_frames_fn, nodes, options.fast_mat, options.overwrite_phi, n_procs)
+
+	block_lengths = [ options.block_length or autocorr_time(phi[:,i]) for (i, phi) in enumerate(phi_frames) ]
+	print "Block lengths (frames) - min: %d, mean: %.1f, max: %d" % (np.min(block_lengths), np.mean(block_lengths), np.max(block_lengths))
+
+	print "\n### Resampling S matrix (%d samples) ..." % options.n_samples
+	t1 = time.time()
+	s_samples = resample_matrix(nodes, phi_frames, block_lengths, options.n_samples)
+	print "Resampling took %f seconds." % (time.time()-t1)
+
+	print "\n### Symmetrizing and clustering samples ..."
+	t1 = time.time()
+	optimize = options.optimize_method if(options.optimize_chi) else None
+	results = bootstrap_pcca(s_samples, node_weights, float(options.error), n_clusters, ref_chi["matrix"], optimize, n_procs)
+	print "Clustering took %f seconds." % (time.time()-t1)
+
+	ok = [ r for r in results if(r != None) ]
+	if(len(ok) < len(results)):
+		print "%d of %d samples failed and were skipped." % (len(results)-len(ok), len(results))
+	if(len(ok) == 0):
+		sys.exit("All samples failed.")
+
+	percentiles = [ 50*(1-options.confidence), 50, 50*(1+options.confidence) ]
+	bands = lambda samples: np.array(np.percentile(np.array(samples), percentiles, axis=0))
+	s_bands = bands(s_samples)
+	weight_bands = bands([ r[0] for r in ok ])
+	qc_bands = bands([ r[1] for r in ok ])
+	cluster_weight_bands = bands([ r[2] for r in ok ])
+
+	np.savez(pool.qc_bootstrap_fn, percentiles=percentiles, n_clusters=n_clusters, node_names=[n.name for n in nodes],
+		qc_matrix=qc_bands, cluster_weights=cluster_weight_bands, weight_corrected=weight_bands, s_matrix=s_bands,
+		n_samples=len(ok), block_lengths=block_lengths)
+	for fn in (pool.phi_frames_fn, pool.chi_mat_fn, pool.qc_mat_fn):
+		register_file_dependency(pool.qc_bootstrap_fn, fn)
+
+	# print summary
+	band = "%f [%f, %f]"
+	print "\n### Median and %g%% bands (percentiles %g and %g) from %d samples:" % (100*options.confidence, percentiles[0], percentiles[2], len(ok))
+	print "-- corrected node weights --"
+	for (i, n) in enumerate(nodes):
+		print ("%s: "+band) % (n.name, weight_bands[1,i], weight_bands[0,i], weight_bands[2,i])
+	print "-- cluster weights --"
+	for i in range(n_clusters):
+		print ("cluster %d: "+band) % (i+1, cluster_weight_bands[1,i], cluster_weight_bands[0,i], cluster_weight_bands[2,i])
+	print "-- Q_c matrix --"
+	for i in range(n_clusters):
+		print "  ".join([ band%(qc_bands[1,i,j], qc_bands[0,i,j], qc_bands[2,i,j]) for j in range(n_clusters) ])
+	print "\nBands stored in %s." % pool.qc_bootstrap_fn
+
+
+#===============================================================================
+def cache_phi_frames(filename, nodes, cache_denom=False, overwrite=False, n_procs=None):
+	"""
+	Loads the phi-values of all nodes on the frames of each node from filename or calculates them.
+	The npz-file records the same inputs as the S matrix, see L{zgf_analyze.matrix_inputs}.
+	@return: list of 2D arrays, one of shape (n_frames, len(nodes)) per node
+	"""
+	inputs = zgf_analyze.matrix_inputs(nodes, [0], cache_denom)
+	names = [n.name for n in nodes]
+	if(path.exists(filename) and not overwrite):
+		old = np.load(filename)
+		if(list(old["node_names"]) == names and all(np.array_equal(old[k], v) for (k, v) in inputs.items())):
+			return([ old["phi_%d"%i] for i in range(len(nodes)) ])
+
+	t1 = time.time()
+	denom_nodes = nodes if(cache_denom) else nodes[0].pool.where("isa_partition")
+	phi_frames = parallel_map(calc_phi_frames, range(len(nodes)), n_procs, shared=(nodes, denom_nodes))
+	print("Phi-value calculation took %f seconds.")%(time.time()-t1)
+
+	for n in nodes:
+		register_file_dependency(filename, n.trr_fn)
+	arrays = dict( ("phi_%d"%i, phi) for (i, phi) in enumerate(phi_frames) )
+	arrays.update(inputs)
+	np.savez(filename, node_names=names, **arrays)
+	return(phi_frames)
+
+
+#===============================================================================
+def calc_phi_frames(shared, i):
+	""" Calculates the phi-values of all nodes on the frames of node i - runs within a worker process. """
+	(nodes, denom_nodes) = shared
+	print("Working on: %s"%nodes[i])
+	return(get_phi_matrix(nodes[i].trajectory, nodes, denom_nodes))
+
+
+#===============================================================================
+def autocorr_time(series):
+	""" Returns the integrated autocorrelation time of series in frames (at least 1) - summed up to the first negative autocorrelation """
+	x = series - np.mean(series)
+	n = len(x)
+	f = np.fft.rfft(x, 2*n)
+	acf = np.fft.irfft(f*np.conjugate(f))[:n]
+	if(acf[0] <= 0):
+		return(1)
+	acf /= acf[0]
+	negatives = np.argwhere(acf <= 0).ravel()
+	cut = negatives[0] if(len(negatives) > 0) else n
+	tau = 1 + 2*np.sum(acf[1:cut])
+	return( max(1, int(np.ceil(tau))) )
+
+
+#===============================================================================
+def block_counts(n_frames, block_length, n_samples):
+	""" Moving block bootstrap: returns how often each frame was drawn, as array of shape (n_samples, n_frames) """
+	block_length = min(block_length, n_frames)
+	n_blocks = int(np.ceil(n_frames / float(block_length)))
+	starts = np.random.randint(0, n_frames-block_length+1, size=(n_samples, n_blocks))
+	frames = (starts[:,:,None] + np.arange(block_length)).reshape(n_samples, -1)[:, :n_frames]
+	# offset each sample, so that a single bincount does the counting for all of them
+	frames += n_frames*np.arange(n_samples)[:,None]
+	return( np.bincount(frames.ravel(), minlength=n_samples*n_frames).reshape(n_samples, n_frames) )
+
+
+#===============================================================================
+def resample_matrix(nodes, phi_frames, block_lengths, n_samples):
+	""" Returns bootstrap samples of the S matrix as array of shape (n_samples, N, N) """
+	samples = np.zeros( (n_samples, len(nodes), len(nodes)) )
+	for (i, (n, phi)) in enumerate(zip(nodes, phi_frames)):
+		weighted_counts = block_counts(len(phi), block_lengths[i], n_samples) * n.frameweights
+		samples[:,i,:] = np.dot(weighted_counts, phi) / np.sum(weighted_counts, axis=1)[:,None]
+	return(samples)
+
+
+#===============================================================================
+def bootstrap_pcca(s_samples, node_weights, error, n_clusters, ref_chi, optimize=None, n_procs=None):
+	""" Symmetrizes and clusters each sample in a process pool - see L{bootstrap_sample} """
+	shared = (s_samples, node_weights, error, n_clusters, ref_chi, optimize)
+	return( parallel_map(bootstrap_sample, range(len(s_samples)), n_procs, shared) )
+
+
+#===============================================================================
+def bootstrap_sample(shared, b):
+	"""
+	Symmetrizes sample b of the S matrix and performs PCCA+ like L{zgf_analyze} - runs within a worker process.
+	The clusters are ordered like the clusters of the reference chi matrix.
+	@return: corrected node weights, Q_c matrix and cluster weights - or None, if the sample could not be clustered
+	"""
+	(s_samples, node_weights, error, n_clusters, ref_chi, optimize) = shared
+	try:
+		(corr_s_matrix, corr_node_weights) = symmetrize(s_samples[b], node_weights, correct_weights=True, error=error)
+		(eigvalues, eigvectors) = np.linalg.eig(corr_s_matrix)
+		argsorted_eigvalues = np.argsort(-eigvalues)
+		eigvalues = eigvalues[argsorted_eigvalues]
+		eigvectors = orthogonalize(eigvalues, eigvectors[:, argsorted_eigvalues], corr_node_weights)
+		(chi_matrix, rot_matrix, qc_matrix) = zgf_analyze.pcca(eigvalues, eigvectors, corr_node_weights, n_clusters, optimize, n_procs=1, verbose=False)
+	except np.linalg.LinAlgError:
+		return(None)
+
+	order = match_clusters(chi_matrix, ref_chi, corr_node_weights)
+	return(corr_node_weights, qc_matrix[order][:,order], rot_matrix[0][order])
+
+
+#===============================================================================
+def match_clusters(chi_matrix, ref_chi, weights):
+	""" Returns the permutation of the columns of chi_matrix, which maximizes the weighted overlap with ref_chi """
+	overlap = np.dot(chi_matrix.T * weights, ref_chi)
+	(rows, cols) = linear_sum_assignment(-overlap)
+	return( rows[np.argsort(cols)] )
+
+
+#===============================================================================
+if(__name__ == "__main__"):
+	main()
+
+#EOF
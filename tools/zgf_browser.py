@@ -16,6 +16,7 @@ import pkgutil
 
 import ZIBMolPy.plots
 from ZIBMolPy.pool import Pool
+from ZIBMolPy.trajectory_cache import TrajectoryCache
 import pango # Pango is a library for rendering internationalized texts
 import gobject
 import gtk
@@ -138,10 +139,25 @@ class Blackboard(object):
 	def __init__(self):
 		self.listeners = []
 		self.pool = None
-		self.selected_node = None
+		self._selected_node = None
 		self.selected_coords = []
 		self.selected_plot_manager = None
 	
+	# the trajectory of the selected node is kept in the cache
+	@property
+	def selected_node(self):
+		return(self._selected_node)
+	
+	#pylint: disable=E1101, E0102
+	@selected_node.setter
+	def selected_node(self, node):
+		cache = TrajectoryCache()
+		if(self._selected_node != None):
+			cache.unpin(self._selected_node)
+		if(node != None):
+			cache.pin(node)
+		self._selected_node = node
+	
 	# multiple coordinates can be selected, hence selected_coords is a list
 	# for legacy and convenience, an interface for single selection is provided
 	@property
@@ -957,6 +973,10 @@ class NodeList(gtk.TreeView):
 			
 		M = self.get_model() # shortens the following code
 		
+		stale = []
+		if(self.board.cb_validate_locks.get_active()):
+			stale = self.board.pool.stale_locks()
+		
 		for (i,n) in enumerate(self.board.pool):
 			(ext_c, ext_m) = ("?", "?")
 			if(hasattr(n, "extensions_counter")):
@@ -968,9 +988,8 @@ class NodeList(gtk.TreeView):
 			color = self.colors['default']
 			if n.is_locked:
 				color = self.colors['active']
-				if(self.board.cb_validate_locks.get_active()):
-					if(not n.is_lock_valid):
-						color = self.colors['stale']
+				if(n in stale):
+					color = self.colors['stale']
 			elif(n.state == 'refined'):
 				color = self.colors['refined']
 
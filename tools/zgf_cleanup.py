@@ -20,11 +20,12 @@ def main():
 	
 	#check locks
 	pool = Pool()
+	stale = pool.stale_locks()
 	for n in pool:
 		sys.stdout.write("Node %s is %s and "%(n.name, n.state))
 		if(not n.is_locked ):
 			print("not locked.")
-		elif( n.is_lock_valid ):
+		elif( n not in stale ):
 			print("is locked and valid.")
 		else:
 			print("its lock is stale - removing it.")
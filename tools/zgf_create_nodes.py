@@ -32,9 +32,8 @@ Discretization parameters
 
 from ZIBMolPy.internals import DihedralCoordinate, LinearCoordinate
 from ZIBMolPy.phi import get_phi_contrib, get_phi_contrib_potential
-from ZIBMolPy.algorithms import kmeans
+from ZIBMolPy.algorithms import kmeans, closest_frames
 from ZIBMolPy.pool import Pool
-from ZIBMolPy.node import Node
 from ZIBMolPy.restraint import DihedralRestraint, DistanceRestraint
 from ZIBMolPy.ui import userinput, Option, OptionsList
 from ZIBMolPy.io.trr import TrrFile
@@ -65,6 +64,10 @@ options_desc = OptionsList([
 	Option("N", "methodnodes", "choice", "method to determine nodes", choices=("kmeans", "equidist", "maxdist", "all")),
 	Option("A", "methodalphas", "choice", "method to determine alphas", choices=("theta", "user") ),
 	Option("K", "numnodes", "int", "number of nodes to create", default=10, min_value=0),
+	Option("R", "kmeans-restarts", "int", "number of independent k-means runs (executed in parallel)", default=1, min_value=1),
+	Option("I", "kmeans-init", "choice", "initial k-means centers, kmeans++ spreads them out", choices=("random", "kmeans++")),
+	Option("M", "kmeans-mode", "choice", "k-means variant, minibatch streams the trajectory in batches", choices=("full", "minibatch")),
+	Option("b", "kmeans-batch-size", "int", "number of frames per batch for minibatch k-means", default=1000, min_value=1),
 	Option("E", "ext-max", "int", "max. number of extensions if not converged", default=5, min_value=0),
 	Option("L", "ext-length", "int", "length per extension in ps", default=100, min_value=1),
 	Option("P", "methodphifit", "choice", "method to determine phi fit", choices=("switch", "harmonic", "leastsq") ),
@@ -108,8 +111,10 @@ def main(argv=None):
 	
 	
 	print "### Generate nodes: %s ###" % options.methodnodes
+	chosen_frames = dict() # frame-index -> frame, if the method already knows them
 	if(options.methodnodes == "kmeans"):
-		chosen_idx = mknodes_kmeans(parent, options.numnodes)
+		(chosen_idx, frames) = mknodes_kmeans(parent, options.numnodes, options.kmeans_restarts, options.kmeans_mode, options.kmeans_batch_size, options.kmeans_init)
+		chosen_frames = dict(zip(chosen_idx, frames))
 	elif(options.methodnodes == "equidist"):
 		chosen_idx = mknodes_equidist(parent, options.numnodes)
 	elif(options.methodnodes == "maxdist"):
@@ -123,17 +128,16 @@ def main(argv=None):
 	if(options.write_preview):
 		write_node_preview(pool, parent, chosen_idx)
 	
-	for i in chosen_idx:
-		n = Node()
+	new_nodes = pool.create_nodes(len(chosen_idx), parent=parent,
+		state="creating-a-partition", # will be set to "created" at end of script
+		extensions_counter=0, extensions_max=options.ext_max,
+		extensions_length=options.ext_length, sampling_length=options.sampling_length)
+	for (n, i) in zip(new_nodes, chosen_idx):
 		n.parent_frame_num = i
-		n.parent = parent
-		n.state = "creating-a-partition" # will be set to "created" at end of script
-		n.extensions_counter = 0
-		n.extensions_max = options.ext_max
-		n.extensions_length = options.ext_length
-		n.sampling_length = options.sampling_length	
-		n.internals = parent.trajectory.getframe(i)
-		pool.append(n)
+		if(i in chosen_frames):
+			n.internals = chosen_frames[i]
+		else:
+			n.internals = parent.trajectory.getframe(i)
 		
 	print "\n### Obtain alpha: %s ###" % options.methodalphas
 	old_alpha = pool.alpha
@@ -158,21 +162,27 @@ def main(argv=None):
 	else:
 		raise(Exception("Method unkown: "+options.methodphifit))
 
-	for n in pool.where("state == 'creating-a-partition'"):
+	new_nodes = pool.where("state == 'creating-a-partition'")
+	for n in new_nodes:
 		n.state = "created"
-		n.save()
 		print "saving " +str(n)
+	new_nodes.save_all()
 		
 	zgf_cleanup.main()
 
 
 #==========================================================================
-def mknodes_kmeans(parent, numnodes):
-	frames_int = parent.trajectory
+def mknodes_kmeans(parent, numnodes, n_restarts=1, mode="full", batch_size=1000, init="random"):
 	fixed_clusters = [n.internals for n in parent.children]
-	means = kmeans(frames_int, numnodes, fixed_clusters=fixed_clusters)
+	if(mode == "minibatch"):
+		# the trajectory is streamed in chunks, it is never in memory as a whole
+		means = kmeans(lambda: parent.iter_trajectory(), numnodes, fixed_clusters=fixed_clusters, mode=mode, batch_size=batch_size, init=init)
+		return(closest_frames(parent.iter_trajectory(), means))
+	
+	frames_int = parent.trajectory
+	means = kmeans(frames_int, numnodes, fixed_clusters=fixed_clusters, n_restarts=n_restarts, init=init)
 	# k-means finished - examine results
-	chosen_idx = [ np.argmin( (frames_int-m).norm2() ) for m in means ]	
+	(chosen_idx, chosen_frames) = closest_frames(frames_int, means)
 	
 	print "\nDiscretization overview:"
 	frames_chosen = frames_int.getframes(chosen_idx)
@@ -183,7 +193,7 @@ def mknodes_kmeans(parent, numnodes):
 	print "- Relative variance per int of chosen nodes:"
 	print (frames_chosen.var() / frames_int.var()).array
 	
-	return(chosen_idx)
+	return(chosen_idx, chosen_frames)
 
 #==========================================================================
 def mknodes_equidist(parent, numnodes):
@@ -367,8 +377,9 @@ def calc_alpha_theta(pool):
 def calc_theta(active_nodes):
 	# compute theta = average of the distances from each node to its nearest neighbor
 	min_dists = []
+	all_internals = active_nodes.internals
 	for n in active_nodes:
-		diffs = (active_nodes.internals - n.internals).norm()
+		diffs = (all_internals - n.internals).norm()
 		nj = np.argsort(diffs)[1] # taking the second result (not the node itself)
 		min_dists.append(diffs[nj])
 	# return theta twice: 1. calculated as mean, 2. calculated as median of min_dists
@@ -104,7 +104,7 @@ def main():
 						continue
 				
 				
-					ready_nodes = pool.where("state == 'ready' and parent!=None and parent.name=='%s'"%node.name)
+					ready_nodes = node.children.where(state='ready')
 
 					print "Node "+str(node_index) #TODO this index is not the global node index... somewhat misleading
 					print "chi value: "+str(chi_matrix[node_index][i])
@@ -161,7 +161,7 @@ def main():
 		index_i=0
 		for node_i in active_nodes:
 			# get frameweights and ready_nodes
-			ready_nodes = pool.where("state == 'ready' and parent!=None and parent.name=='%s'"%node_i.name)
+			ready_nodes = node_i.children.where(state='ready')
 			frameweights_of_node_i= node_i.frameweights
 
 			for ready_node in ready_nodes:	
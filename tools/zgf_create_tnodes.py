@@ -36,7 +36,6 @@ Save mode
 
 
 from ZIBMolPy.pool import Pool
-from ZIBMolPy.node import Node
 from ZIBMolPy.phi  import get_phi
 from ZIBMolPy.ui import userinput, Option, OptionsList
 
@@ -137,20 +136,15 @@ def main():
 				neighbour_frames = get_indices_equidist(node, options.num_tnodes)
 		
 				# create transition node for node_index
-				for frame_number in neighbour_frames:
+				new_nodes = pool.create_nodes(len(neighbour_frames), parent=node, state="created",
+					extensions_counter=0, extensions_max=options.num_runs-1, 
+					extensions_length=options.sampling_length, sampling_length=options.sampling_length,
+					save_mode=options.save_mode)
+				for (n, frame_number) in zip(new_nodes, neighbour_frames):
 					print "Using frame %d as starting configuration."%frame_number
-					n = Node()
 					n.parent_frame_num = frame_number
-					n.parent = node
-					n.state = "created"
-					n.extensions_counter = 0
-					n.extensions_max = options.num_runs-1
-					n.extensions_length = options.sampling_length
-					n.sampling_length = options.sampling_length
 					n.internals = trajectory.getframe(frame_number)
-					n.save_mode = options.save_mode
-					pool.append(n)
-					n.save()
+				new_nodes.save_all()
 				print "%d transition nodes generated."%options.num_tnodes
 				print "-----"
 
@@ -175,20 +169,15 @@ def main():
 			neighbour_frames = get_indices_equidist(node, options.num_tnodes)
 
 			# create transition point for node_index
-			for frame_number in neighbour_frames:
+			new_nodes = pool.create_nodes(len(neighbour_frames), parent=node, state="created",
+				extensions_counter=0, extensions_max=options.num_runs-1, 
+				extensions_length=options.sampling_length, sampling_length=options.sampling_length,
+				save_mode=options.save_mode)
+			for (n, frame_number) in zip(new_nodes, neighbour_frames):
 				print "Using frame %d as starting configuration."%frame_number
-				n = Node()
 				n.parent_frame_num = frame_number
-				n.parent = node
-				n.state = "created"
-				n.extensions_counter = 0
-				n.extensions_max = options.num_runs-1
-				n.extensions_length = options.sampling_length
-				n.sampling_length = options.sampling_length
 				n.internals = trajectory.getframe(frame_number)
-				n.save_mode = options.save_mode
-				pool.append(n)
-				n.save()
+			new_nodes.save_all()
 			print "%d transition nodes generated."%options.num_tnodes
 			print "-----"
 
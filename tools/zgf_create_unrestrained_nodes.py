@@ -5,7 +5,6 @@
 
 
 from ZIBMolPy.pool import Pool
-from ZIBMolPy.node import Node
 from ZIBMolPy.ui import userinput, Option, OptionsList
 
 import sys
@@ -54,18 +53,13 @@ def main(argv=None):
 	
 	print "choosen_idx: ",chosen_idx
 	
-	for i in chosen_idx:
-		n = Node()
+	new_nodes = pool.create_nodes(len(chosen_idx), parent=parent, state="created",
+		extensions_counter=0, extensions_max=0, extensions_length=0,
+		sampling_length=parent.sampling_length * 3)
+	for (n, i) in zip(new_nodes, chosen_idx):
 		n.parent_frame_num = i
-		n.parent = parent
-		n.state = "created"
-		n.extensions_counter = 0
-		n.extensions_max = 0
-		n.extensions_length = 0
-		n.sampling_length = parent.sampling_length * 3
 		n.internals = parent.trajectory.getframe(i)
-		pool.append(n)
-		n.save()
+	new_nodes.save_all()
 	
 #==========================================================================
 if(__name__=="__main__"):
@@ -231,6 +231,7 @@ def process(node, options):
 				if(re.match(".+.pdb",fn)==None
 				and re.match("[^#].+.mdp",fn)==None
 				and re.match(".+.txt",fn)==None
+				and re.match(".+.bin",fn)==None
 				and re.match("[^#].+.tpr",fn)==None
 				and re.match(".+.top",fn)==None
 				and fn!="lock"):
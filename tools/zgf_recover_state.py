@@ -45,8 +45,9 @@ def main():
 	for n in needy_nodes:
 		print "Recovering node %s with state %s to state %s ..."%(n.name, n.state, options.recover_state)
 		n.state = options.recover_state
-		n.save()		
-		n.unlock()
+
+	needy_nodes.save_all()
+	needy_nodes.unlock()
 
 
 #===============================================================================
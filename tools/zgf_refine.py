@@ -39,7 +39,7 @@ options_desc = OptionsList([
 	])
 
 # reuse some options from zgf_create_nodes
-FORWARDED_ZGF_CREATE_NODES_OPTIONS = ("numnodes", "methodnodes", "methodalphas", "methodphifit", "random-seed")
+FORWARDED_ZGF_CREATE_NODES_OPTIONS = ("numnodes", "methodnodes", "kmeans-restarts", "kmeans-init", "kmeans-mode", "kmeans-batch-size", "methodalphas", "methodphifit", "random-seed")
 for x in FORWARDED_ZGF_CREATE_NODES_OPTIONS:
 	options_desc.append(copy(zgf_create_nodes.options_desc[x])) # need copy to safely ...
 options_desc["numnodes"].default = 2 # ... change default values
@@ -52,6 +52,11 @@ Choice of energy observables for reweighting
 
 You can pick from various options. You can decide if you want to use observables from the standard run (as stored in 'ener.edr') or from a rerun (as stored in 'rerun.edr') that you did with L{zgf_rerun}. You can also read bonded and non-bonded energy observables from different edr-files. If you are not happy with the standard choice of energy observables, you can provide a file with costum observables (non-bonded only).
 
+Checkpoints
+===========
+
+Completed nodes (and for the presampling reweighting completed frames) are checkpointed in the analysis/ directory. If zgf_reweight gets killed, e.g. by a walltime limit, rerun it with the same options and it resumes where it stopped.
+
 Check restraint energy
 ======================
 
@@ -64,11 +69,12 @@ from ZIBMolPy.restraint import DihedralRestraint, DistanceRestraint
 from ZIBMolPy.ui import Option, OptionsList
 from ZIBMolPy.phi import get_phi, get_phi_potential
 from ZIBMolPy.pool import Pool
+from ZIBMolPy.checkpoint import Checkpoint, file_stamp
+from ZIBMolPy.io.edr import EdrFile
 import zgf_cleanup
 
-from subprocess import Popen, PIPE, call, check_call
+from subprocess import Popen, call, check_call
 from datetime import datetime
-from tempfile import mktemp
 from warnings import warn
 import numpy as np
 import sys
@@ -130,12 +136,18 @@ def main():
 		for n in active_nodes:
 			check_restraint_energy(n)
 
+	# completed nodes or frames are checkpointed, so an interrupted run can be resumed
+	key = (options.method, [n.name for n in active_nodes], [file_stamp(n.trr_fn) for n in active_nodes], 
+		options.e_bonded, options.e_nonbonded, load_custom_energy_terms(options), options.presamp_temp)
+	dependencies = [n.trr_fn for n in active_nodes] + [pool.root.trr_fn]
+	ckpt = Checkpoint(pool.analysis_dir+"reweight_%s.ckpt"%options.method, key, dependencies)
+
 	if(options.method == "direct"):
-		reweight_direct(active_nodes, options)
+		reweight_direct(active_nodes, options, ckpt)
 	elif(options.method == "entropy"):
-		reweight_entropy(active_nodes, options)
+		reweight_entropy(active_nodes, options, ckpt)
 	elif(options.method == "presampling"):
-		reweight_presampling(active_nodes, options)
+		reweight_presampling(active_nodes, options, ckpt)
 	else:
 		raise(Exception("Method unkown: "+options.method))
 	
@@ -150,35 +162,49 @@ def main():
 			print("  %s with A: %f [kJ/mol] and weight: %f" % (n.name, n.obs.A, n.obs.weight_direct))
 	print "The above weighting uses bonded energies='%s' and nonbonded energies='%s'."%(options.e_bonded, options.e_nonbonded)
 
-	for n in active_nodes:
-		n.save()
-
+	active_nodes.save_all()
 	active_nodes.unlock()
+	ckpt.remove()
 
 
 #===============================================================================
-def reweight_direct(nodes, options):
+def load_custom_energy_terms(options):
+	if(options.e_nonbonded not in ("run_custom", "rerun_custom")):
+		return(None)
+	assert(path.exists(options.custom_energy))
+	return( [entry.strip() for entry in open(options.custom_energy).readlines() if entry != "\n"] )
+
+
+#===============================================================================
+def reweight_direct(nodes, options, ckpt):
 	print "Direct free energy reweighting: see Klimm, Bujotzek, Weber 2011"
 
-	custom_energy_terms = None
-	if(options.e_nonbonded in ("run_custom", "rerun_custom")):
-		assert(path.exists(options.custom_energy))
-		custom_energy_terms = [entry.strip() for entry in open(options.custom_energy).readlines() if entry != "\n"]
+	custom_energy_terms = load_custom_energy_terms(options)
 	
 	beta = nodes[0].pool.thermo_beta
 	
-	for n in nodes:
+	def phi_weighted_energies_of(n):
 		# get potential V and substract penalty potential
 		energies = load_energy(n, options.e_bonded, options.e_nonbonded, custom_energy_terms)
-
-		frame_weights = n.frameweights
-		phi_weighted_energies = energies + get_phi_potential(n.trajectory, n)
-
-		# define evaluation region where sampling is rather dense, e. g. around mean potential energy with standard deviation of potential energy
-		n.obs.mean_V = np.average(phi_weighted_energies, weights=frame_weights)
-		n.obs.std_V = np.sqrt(np.average(np.square(phi_weighted_energies - n.obs.mean_V), weights=frame_weights))
+		return(energies, energies + get_phi_potential(n.trajectory, n))
+	
+	for n in nodes:
+		energies = None
+		if(n.name not in ckpt):
+			(energies, phi_weighted_energies) = phi_weighted_energies_of(n)
+			frame_weights = n.frameweights
+
+			# define evaluation region where sampling is rather dense, e. g. around mean potential energy with standard deviation of potential energy
+			mean_V = np.average(phi_weighted_energies, weights=frame_weights)
+			std_V = np.sqrt(np.average(np.square(phi_weighted_energies - mean_V), weights=frame_weights))
+			ckpt[n.name] = (mean_V, std_V)
+		(n.obs.mean_V, n.obs.std_V) = ckpt[n.name]
 		n.tmp['weight'] = 0.0
 	
+	# the energies of the last node are used below - reload them, if it was restored from the checkpoint
+	if(energies is None):
+		(energies, phi_weighted_energies) = phi_weighted_energies_of(nodes[-1])
+	
 	# new part
 	mean_mean_V = np.mean([n.obs.mean_V for n in nodes])
 	std_mean_V = np.sqrt(np.mean([np.square(n.obs.mean_V - mean_mean_V) for n in nodes]))
@@ -219,19 +245,26 @@ def reweight_direct(nodes, options):
 
 
 #===============================================================================
-def reweight_entropy(nodes, options):
+def reweight_entropy(nodes, options, ckpt):
 	print "Entropy reweighting: see Klimm, Bujotzek, Weber 2011"
 
-	custom_energy_terms = None
-	if(options.e_nonbonded in ("run_custom", "rerun_custom")):
-		assert(path.exists(options.custom_energy))
-		custom_energy_terms = [entry.strip() for entry in open(options.custom_energy).readlines() if entry != "\n"]
+	custom_energy_terms = load_custom_energy_terms(options)
 
 	# calculate variance of internal coordinates
-	conjugate_var = np.mean([n.trajectory.merged_var_weighted() for n in nodes]) # this be our evaluation region
+	if("conjugate_var" not in ckpt):
+		ckpt["conjugate_var"] = np.mean([n.trajectory.merged_var_weighted() for n in nodes]) # this be our evaluation region
+	conjugate_var = ckpt["conjugate_var"]
 
 	# find refpoints and calculate nearpoints
 	for n in nodes:
+		if(n.name in ckpt):
+			print("Restoring reweighting of %s from checkpoint."%n.name)
+			(n.obs.mean_V, n.obs.std_V, n.tmp['medi_inv_nearpoints'], n.obs.S, n.obs.A, refpoints) = ckpt[n.name]
+			n.tmp['weight'] = 1.0
+			if(options.save_refpoints):
+				n.obs.refpoints = refpoints
+			continue
+		
 		log = open(n.reweighting_log_fn, "a") # using separate log-file
 		def output(message):
 			print(message)
@@ -280,6 +313,7 @@ def reweight_entropy(nodes, options):
 			n.obs.refpoints = refpoints
 
 		log.close()
+		ckpt[n.name] = (n.obs.mean_V, n.obs.std_V, n.tmp['medi_inv_nearpoints'], n.obs.S, n.obs.A, refpoints)
 
 	nodes.sort(key = lambda n: n.obs.A) # sort in ascending order by free energy values		
 	for (n1, n2) in zip(nodes[1:], nodes[:-1]): # calculate and normalize weights
@@ -287,13 +321,10 @@ def reweight_entropy(nodes, options):
 	
 
 #===============================================================================
-def reweight_presampling(nodes, options):
+def reweight_presampling(nodes, options, ckpt):
 	print "Presampling analysis reweighting: see formula 18 in Fackeldey, Durmaz, Weber 2011"
 
-	custom_energy_terms = None
-	if(options.e_nonbonded in ("run_custom", "rerun_custom")):
-		assert(path.exists(options.custom_energy))
-		custom_energy_terms = [entry.strip() for entry in open(options.custom_energy).readlines() if entry != "\n"]
+	custom_energy_terms = load_custom_energy_terms(options)
 	
 	root = nodes[0].pool.root
 	
@@ -306,33 +337,36 @@ def reweight_presampling(nodes, options):
 	
 	
 	# Calculating energies of all presampling frames
-	cmd0 = ["grompp"]
-
-	cmd0 += ["-f", "../../"+root.pool.mdp_fn]
-	cmd0 += ["-n", "../../"+root.pool.ndx_fn]
-	cmd0 += ["-c", "../../"+root.pdb_fn]
-	cmd0 += ["-p", "../../"+root.pool.top_fn]
-	cmd0 += ["-o", "../../"+root.dir+"/run_temp.tpr"]			
-	print("Calling: %s"%" ".join(cmd0))
-	p = Popen(cmd0, cwd=root.dir)
-	retcode = p.wait()
-	assert(retcode == 0) # grompp should never fail
-	os.rename(root.dir+"/run_temp.tpr",root.tpr_fn)
-	
-	# rerun mdrun
-	cmd = ["mdrun"]
-	
-	cmd += ["-s", "../../" + root.tpr_fn]
-	cmd += ["-rerun", "../../" + root.trr_fn]
-	
-	p = Popen(cmd, cwd=root.dir)
-	assert(p.wait() == 0)
+	if("energies" not in ckpt):
+		cmd0 = ["grompp"]
+
+		cmd0 += ["-f", "../../"+root.pool.mdp_fn]
+		cmd0 += ["-n", "../../"+root.pool.ndx_fn]
+		cmd0 += ["-c", "../../"+root.pdb_fn]
+		cmd0 += ["-p", "../../"+root.pool.top_fn]
+		cmd0 += ["-o", "../../"+root.dir+"/run_temp.tpr"]			
+		print("Calling: %s"%" ".join(cmd0))
+		p = Popen(cmd0, cwd=root.dir)
+		retcode = p.wait()
+		assert(retcode == 0) # grompp should never fail
+		os.rename(root.dir+"/run_temp.tpr",root.tpr_fn)
+	
+		# rerun mdrun
+		cmd = ["mdrun"]
+	
+		cmd += ["-s", "../../" + root.tpr_fn]
+		cmd += ["-rerun", "../../" + root.trr_fn]
+	
+		p = Popen(cmd, cwd=root.dir)
+		assert(p.wait() == 0)
 	
-	# remove unnecessary files
-	os.remove(root.dir + "/traj.trr")
+		# remove unnecessary files
+		os.remove(root.dir + "/traj.trr")
 	
-	# extract potential energy V of presampling frames
-	energies = load_energy(root, options.e_bonded, options.e_nonbonded, custom_energy_terms)
+		# extract potential energy V of presampling frames
+		energies = load_energy(root, options.e_bonded, options.e_nonbonded, custom_energy_terms)
+		ckpt["energies"] = energies
+	energies = ckpt["energies"]
 	
 	
 	# Beginning minimizations starting from every presampling frame
@@ -357,13 +391,10 @@ def reweight_presampling(nodes, options):
 	
 	
 	# loading times for starting minimizatioon from certain frame in trajectory
-	cmd2 = ["g_energy", "-dp", "-f", "ener.edr"]
-	
-	print "Loading times of the presampling frames"
-	p = Popen (cmd2, cwd=root.dir, stdin=PIPE)
-	p.communicate("1\n")
-	assert (p.wait() == 0)
-	times = np.loadtxt(root.dir + "/energy.xvg", comments="@", skiprows=10, usecols=[0])
+	if("times" not in ckpt):
+		print "Loading times of the presampling frames"
+		ckpt["times"] = EdrFile(root.dir + "/ener.edr").read_times()
+	times = ckpt["times"]
 	
 	phi_mat = get_phi_mat(presampling_internals, nodes)
 	presamp_partition = np.argmax(phi_mat, axis=1)
@@ -376,6 +407,8 @@ def reweight_presampling(nodes, options):
 		print "Running grompp to prepare for the minimizations"
 		print "Running mdrun for every presampling frame"
 		for i in xrange(times.size):
+			if(("minimized", i) in ckpt):
+				continue # done before the last run got interrupted
 			cmds = cmd3 + ["-p", "../../../" + nodes[presamp_partition[i]].top_fn]
 			cmds += ["-time", str(times[i])]
 			cmds += ["-o", "run" + str(i) + ".tpr"]
@@ -424,6 +457,7 @@ def reweight_presampling(nodes, options):
 			os.remove(mins_dir + "/traj" + str(i) + ".trr")
 			os.remove(mins_dir + "/confout" + str(i) + ".gro")
 			os.remove(mins_dir + "/md" + str(i) + ".log")
+			ckpt[("minimized", i)] = True
   
 		root.reweight_minimized = True
 		root.lock()
@@ -432,7 +466,7 @@ def reweight_presampling(nodes, options):
 	
 	
 	# stores according minimum in nodes
-	min_per_node(mins_dir, presamp_partition, nodes, options.e_bonded, options.e_nonbonded, custom_energy_terms)
+	min_per_node(mins_dir, presamp_partition, nodes, options.e_bonded, options.e_nonbonded, custom_energy_terms, ckpt)
 	
 		
 	# calculate free energy per node 
@@ -471,6 +505,7 @@ def reweight_presampling(nodes, options):
 #===============================================================================
 def load_energy(node, e_bonded_type, e_nonbonded_type, custom_e_terms=None):
 	
+	requests = [] # (kind, energy file, terms)
 	if(e_bonded_type != "none"):
 		
 		# get bonded energy
@@ -487,24 +522,7 @@ def load_energy(node, e_bonded_type, e_nonbonded_type, custom_e_terms=None):
 		if(e_bonded_type in ("run_standard_bondedterms", "rerun_standard_bondedterms")):
 			e_bonded_terms = ["Bond", "Angle", "Proper-Dih.", "Ryckaert-Bell.", "Improper-Dih."]
 
-		xvg_fn = mktemp(suffix=".xvg", dir=node.dir)
-		cmd = ["g_energy", "-dp", "-f", node.dir+"/"+edr_fn, "-o", xvg_fn, "-sum"]
-
-		print("Calling: "+(" ".join(cmd)))
-		p = Popen(cmd, stdin=PIPE)
-		p.communicate(input=("\n".join(e_bonded_terms)+"\n"))
-		assert(p.wait() == 0)
-
-		# skipping over "#"-comments at the beginning of xvg-file 
-		e_bonded = np.loadtxt(xvg_fn, comments="@", usecols=(1,), skiprows=10) 
-		os.remove(xvg_fn)
-		
-		# if len(energy file) != len(trajectory)
-		if(len(e_bonded)==node.trajectory.n_frames+1):
-			e_bonded = e_bonded[:-1]
-			
-	else:
-		e_bonded = np.zeros(node.trajectory.n_frames)
+		requests.append( ("bonded", edr_fn, e_bonded_terms) )
 
 	if(e_nonbonded_type != "none"):
 		# get non-bonded energy
@@ -538,23 +556,32 @@ def load_energy(node, e_bonded_type, e_nonbonded_type, custom_e_terms=None):
 			assert(custom_e_terms)
 			e_nonbonded_terms = custom_e_terms
 	
-		xvg_fn = mktemp(suffix=".xvg", dir=node.dir)
-		cmd = ["g_energy", "-dp", "-f", node.dir+"/"+edr_fn, "-o", xvg_fn, "-sum"]
-
-		print("Calling: "+(" ".join(cmd)))
-		p = Popen(cmd, stdin=PIPE)
-		p.communicate(input=("\n".join(e_nonbonded_terms)+"\n"))
-		assert(p.wait() == 0)
-	
-		# skipping over "#"-comments at the beginning of xvg-file 
-		e_nonbonded = np.loadtxt(xvg_fn, comments="@", usecols=(1,), skiprows=10) 
-		os.remove(xvg_fn)
+		requests.append( ("nonbonded", edr_fn, e_nonbonded_terms) )
+
+	# read every energy file only once - both sums come from the same read_terms call
+	sums = dict()
+	for edr_fn in set([ fn for (dummy, fn, dummy) in requests ]):
+		print("Reading: "+node.dir+"/"+edr_fn)
+		f = EdrFile(node.dir+"/"+edr_fn)
+		columns = dict()
+		for (kind, fn, terms) in requests:
+			if(fn != edr_fn):
+				continue
+			indices = f.find_terms(terms) # terms, which do not exist, are left out
+			if(len(indices) == 0):
+				raise(Exception("None of the energy terms found in %s: %s"%(f.filename, terms)))
+			columns[kind] = indices
+		needed = sorted(set(sum(columns.values(), [])))
+		energies = f.read_terms([ f.term_names[i] for i in needed ])[1]
 		
 		# if len(energy file) != len(trajectory)
-		if(len(e_nonbonded)==node.trajectory.n_frames+1):
-			e_nonbonded = e_nonbonded[:-1]
-	else:
-		e_nonbonded = np.zeros(node.trajectory.n_frames)
+		if(len(energies)==node.trajectory.n_frames+1):
+			energies = energies[:-1]
+		for (kind, indices) in columns.items():
+			sums[kind] = np.sum(energies[:, [needed.index(i) for i in indices]], axis=1)
+
+	e_bonded = sums.get("bonded", np.zeros(node.trajectory.n_frames))
+	e_nonbonded = sums.get("nonbonded", np.zeros(node.trajectory.n_frames))
 	
 	print len(e_bonded)
 	print len(e_nonbonded)
@@ -568,7 +595,7 @@ def load_energy(node, e_bonded_type, e_nonbonded_type, custom_e_terms=None):
 
 #===============================================================================
 def check_restraint_energy(node):
-	""" Uses U{g_energy <http://www.gromacs.org/Documentation/Gromacs_Utilities/g_energy>}
+	""" Uses L{EdrFile<ZIBMolPy.io.edr.EdrFile>}
 		to read the distance- and dihedral-restraint energies
 		used by gromacs	for every frame of the node's trajectory and compares them
 		with our own values, which are calulated in L{ZIBMolPy.restraint}.
@@ -578,7 +605,6 @@ def check_restraint_energy(node):
 	has_dih_restraints = any([isinstance(r, DihedralRestraint) for r in node.restraints])
 	has_dis_restraints = any([isinstance(r, DistanceRestraint) for r in node.restraints])
 	
-	# Caution: g_energy ignores the given order of energy_terms and instead uses its own  
 	energy_terms = []
 	if(has_dis_restraints):
 		#energy_terms += ["Dis.-Rest."]
@@ -586,20 +612,11 @@ def check_restraint_energy(node):
 	if(has_dih_restraints):
 		energy_terms += ["Dih.-Rest."]
 	
-	#xvg_fn = mktemp(suffix=".xvg", dir=node.dir)
-	xvg_fn = mktemp(suffix=".xvg")
-	cmd = ["g_energy", "-dp", "-f", node.dir+"/ener.edr", "-o", xvg_fn]
-	print("Calling: "+(" ".join(cmd)))
-	p = Popen(cmd, stdin=PIPE)
-	p.communicate(input=("\n".join(energy_terms)+"\n"))
-	assert(p.wait() == 0)
-	
-	# skipping over "#"-comments at the beginning of xvg-file 
-	energies = np.loadtxt(xvg_fn, comments="@", skiprows=10)
-	os.remove(xvg_fn)
+	print("Reading: "+node.dir+"/ener.edr")
+	energies = EdrFile(node.dir+"/ener.edr").read_terms(energy_terms)[1]
 	
 	assert(energies.shape[0] == node.trajectory.n_frames)
-	assert(energies.shape[1] == len(energy_terms)+1)
+	assert(energies.shape[1] == len(energy_terms))
 	
 	dih_penalty = np.zeros(node.trajectory.n_frames)
 	dis_penalty = np.zeros(node.trajectory.n_frames)
@@ -618,7 +635,7 @@ def check_restraint_energy(node):
 	dis_penalty_gmx = np.zeros(node.trajectory.n_frames)
 	
 	if(has_dih_restraints):
-		i = energy_terms.index("Dih.-Rest.") + 1 # index 0 = time of frame
+		i = energy_terms.index("Dih.-Rest.")
 		dih_penalty_gmx = energies[:,i]
 		dih_diffs = np.abs(dih_penalty - dih_penalty_gmx)
 		max_diff = np.argmax(dih_diffs)
@@ -630,8 +647,8 @@ def check_restraint_energy(node):
 		# TODO compare if we get the same dihedral angles from g_angle as we get from our internals
 		
 	if(has_dis_restraints):
-		#i = energy_terms.index("Dis.-Rest.") + 1 # index 0 = time of frame
-		i = energy_terms.index("Restraint-Pot.") + 1 # index 0 = time of frame
+		#i = energy_terms.index("Dis.-Rest.")
+		i = energy_terms.index("Restraint-Pot.")
 		dis_penalty_gmx = energies[:,i]
 		dis_diff = np.max(np.abs(dis_penalty - dis_penalty_gmx))
 		print "dis_diff: ", dis_diff
@@ -640,16 +657,23 @@ def check_restraint_energy(node):
 	return( dih_penalty_gmx + dis_penalty_gmx ) # values are returned for optional plotting
 
 
-def min_per_node(mins_dir, partition, nodes, e_bonded_type, e_nonbonded_type, custom_e_terms=None):
+def min_per_node(mins_dir, partition, nodes, e_bonded_type, e_nonbonded_type, custom_e_terms=None, ckpt=None):
 	""" Calculates the minium energy of the presampling frames belonging to the according node. A frame belongs to the node to which it has the strongest membership.
 	
 	@param mins_dir: directory in which the minimizations required for the presampling reweighting are performed
-	@param partition: 1D array, at index i is the index of the node corresponding to presampling frame i"""
+	@param partition: 1D array, at index i is the index of the node corresponding to presampling frame i
+	@param ckpt: L{Checkpoint<ZIBMolPy.checkpoint.Checkpoint>} for the energies of the frames or None"""
 	
 	mins = [[]] * len(nodes)
 	presamp_int = nodes[0].pool.root.trajectory
+	if(ckpt == None):
+		ckpt = dict()
 	
 	for i in xrange(partition.size):
+		if(("min_energy", i) in ckpt):
+			mins[partition[i]].append(ckpt[("min_energy", i)])
+			continue
+		
 		edr_fn = mins_dir + "/ener" + str(i) + ".edr"
 		
 		e_terms = []
@@ -695,21 +719,13 @@ def min_per_node(mins_dir, partition, nodes, e_bonded_type, e_nonbonded_type, cu
 		
 		if (len(e_terms) >= 0):
 			
-			xvg_fn = mktemp(suffix=".xvg", dir=mins_dir)
-			cmd = ["g_energy", "-dp", "-f", edr_fn, "-o", xvg_fn, "-sum"]
-	
-			print("Calling: "+(" ".join(cmd)))
-			p = Popen(cmd, stdin=PIPE)
-			p.communicate(input=("\n".join(e_terms)+"\n"))
-			assert(p.wait() == 0)
-		
-			# skipping over "#"-comments at the beginning of xvg-file 
-			e = np.loadtxt(xvg_fn, comments="@", usecols=(1,), skiprows=10) [-1]
-			os.remove(xvg_fn)
+			# energy of the last frame, i.e. of the minimized structure
+			e = EdrFile(edr_fn).sum_terms(e_terms)[-1]
 		else:
 			e = 0
 
-		mins[partition[i]].append(e + get_phi_potential(presamp_int.getframes([i]), nodes[partition[i]])[0])
+		ckpt[("min_energy", i)] = e + get_phi_potential(presamp_int.getframes([i]), nodes[partition[i]])[0]
+		mins[partition[i]].append(ckpt[("min_energy", i)])
 		
 	for i in xrange(len(nodes)):
 		nodes[i].tmp["opt_pot_e"] = min(mins[i])
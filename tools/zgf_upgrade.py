@@ -47,9 +47,14 @@ def main():
 	v = pool_desc['format_version']
 	if(v == 1):
 		upgrade_1to2()
-		set_pool_format_version(2)	
+		set_pool_format_version(2)
+		v = 2
+	
+	if(v == 2):
+		upgrade_2to3()
+		set_pool_format_version(3)
 		
-	elif(v == 2):
+	elif(v == 3):
 		print("Pool has latest format version")
 		sys.exit(0)
 	
@@ -123,6 +128,21 @@ def upgrade_1to2():
 				print("Renaming: %s -> %s"%(fn_old, fn_new))
 				os.rename(fn_old, fn_new)
 		
+
+#===============================================================================
+def upgrade_2to3():
+	print("Upgrading pool from version 2 to 3 ...")
+	
+	# Node.reload still understands the old text-based descriptors,
+	# Node.save writes the new binary ones and removes the old files.
+	from ZIBMolPy.pool import Pool
+	pool = Pool()
+	for n in pool:
+		print("Converting descriptor of "+n.name)
+		n.lock(guardtime=0)
+		n.save()
+		n.unlock()
+	
 		
 #===============================================================================
 if(__name__ == "__main__"):